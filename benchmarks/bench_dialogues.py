@@ -0,0 +1,261 @@
+"""
+Measures the throughput of the DialogueGenerator loop: dialogues/sec, generated tokens/sec and the p50/p95 latency
+of a turn (one inquirer and one responder step of the dialogues in flight), saved as JSON to compare runs.
+
+- stub: deterministic models that answer instantly, the numbers are the overhead of the orchestration
+- hf: a tiny causal language model on the llama templates, for end-to-end numbers. Without --hf-model, a randomly
+  initialized llama with a byte-level BPE tokenizer is built locally, so that no download is needed. A random model
+  never quotes a prompt nor ends the dialogue, so its whole response is taken as the prompt and every dialogue runs
+  num_turns turns of max_new_tokens tokens. --quantization and --low-cpu-mem-usage select the loading mode of the
+  models, whose load time and memory are reported with the results. --draft-model generates with a draft model
+  (assisted generation, batch size 1 only), --draft-model tiny builds one from the first layer of the tiny model, and
+  the acceptance rate of its tokens is reported with the results.
+
+    python benchmarks/bench_dialogues.py --backend stub --batch-size 1 8 --output stub.json
+    python benchmarks/bench_dialogues.py --backend hf --output hf.json
+    python benchmarks/bench_dialogues.py --backend hf --hf-model sshleifer/tiny-gpt2 --baseline hf.json
+    python benchmarks/bench_dialogues.py --backend hf --quantization int8_dynamic --baseline hf.json
+    python benchmarks/bench_dialogues.py --backend hf --batch-size 1 --draft-model tiny --baseline hf.json
+"""
+import argparse
+import json
+import math
+import tempfile
+import time
+from pathlib import Path
+
+from omegaconf import OmegaConf
+from urartu.common.device import Device
+
+from llm_roleplay.actions.dialogue_generator import DialogueGenerator
+from llm_roleplay.common.model import Model
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from llm_roleplay.models.model_pipeline import ModelPipeline
+
+CONFIGS_DIR = Path(__file__).resolve().parents[1].joinpath("llm_roleplay", "configs", "action_config")
+
+
+class StubModel(Model):
+    """
+    Answers every prompt with num_words distinct words right away, the inquirer within double quotes.
+    """
+
+    SUPPORTS_BATCHING = True
+
+    def get_prompt(self, turn, response_msg=None, persona=None, instructions=None):
+        if self.role == "model_inquirer" and turn == 0:
+            return f"{persona} {instructions[0]}"
+        return response_msg
+
+    def generate(self, prompt, generate_cfg):
+        offset = len(self.history) * self.cfg.num_words
+        response = " ".join(f"{self.role}{offset + idx}" for idx in range(self.cfg.num_words))
+        if self.role == "model_inquirer":
+            response = f'"{response}"'
+        return response, response
+
+    def update_history(self, prompt, output_extract):
+        self.history.append(f"{prompt} {output_extract}")
+
+
+class TinyInquirer(ModelCausalLanguage):
+    # the whole response of a random model is its prompt, and it never ends the dialogue early
+    def extract_prompt(self, prompt):
+        return prompt, 1
+
+    def is_non_coherent(self, text):
+        return False
+
+    def stop_dialog(self, prompt):
+        return False
+
+
+class TinyResponder(ModelPipeline):
+    def is_non_coherent(self, text):
+        return False
+
+
+class BenchDialogueGenerator(DialogueGenerator):
+    """
+    Times every turn of the dialogue loop and counts the generated tokens.
+    """
+
+    def initialize(self):
+        super().initialize()
+        self.turn_latencies = []
+        self.num_tokens = 0
+        self.turn_start = None
+        for model in (self.model_inquirer, self.model_responder):
+            self._count_tokens(model)
+
+    def _count_tokens(self, model):
+        generate_batch = model.generate_batch
+
+        def counted(prompts, histories, generate_cfg):
+            outputs = generate_batch(prompts=prompts, histories=histories, generate_cfg=generate_cfg)
+            for response, _ in outputs:
+                if isinstance(model, StubModel):
+                    self.num_tokens += len(response.split())
+                else:
+                    self.num_tokens += len(model.tokenizer.encode(response, add_special_tokens=False))
+            return outputs
+
+        model.generate_batch = counted
+
+    def inquirer_step(self, dialogues):
+        self.turn_start = time.perf_counter()
+        super().inquirer_step(dialogues)
+
+    def responder_step(self, dialogues):
+        super().responder_step(dialogues)
+        self.turn_latencies.append(time.perf_counter() - self.turn_start)
+
+
+def get_cfg(args, model_path, records_dir, batch_size):
+    cfg = OmegaConf.load(CONFIGS_DIR.joinpath("dialogue_generator.yaml"))
+    cfg.pop("hydra", None)
+    action_cfg = cfg.action_config
+    action_cfg.resume_dir = records_dir
+    action_cfg.tracking.level = "off"
+    action_cfg.task.num_turns = args.num_turns
+    action_cfg.task.batch_size = batch_size
+    action_cfg.task.persona.fixed = action_cfg.task.persona.fixed[: args.num_personas]
+    action_cfg.task.dataset.data.instruction = action_cfg.task.dataset.data.instruction[: args.num_samples]
+
+    if args.backend == "stub":
+        for role in ("model_inquirer", "model_responder"):
+            action_cfg.task[role] = {
+                "type": {"_target_": f"{StubModel.__module__}.{StubModel.__qualname__}"},
+                "name": "stub",
+                "num_words": args.max_new_tokens,
+                "non_coherent_max_n": 8,
+                "non_coherent_r": 2,
+                "regenerate_tries": None,
+                "generate": {},
+                "conv_template": {"model_output": "<MODEL_ANSWER>", "idx_of_possible_prompt": 0},
+            }
+        return cfg
+
+    generate_cfg = {"do_sample": False, "max_new_tokens": args.max_new_tokens, "min_new_tokens": args.max_new_tokens}
+    for role, model_cls in (("model_inquirer", TinyInquirer), ("model_responder", TinyResponder)):
+        model_cfg = OmegaConf.load(CONFIGS_DIR.joinpath("task", role, "llama.yaml"))
+        model_cfg.type._target_ = f"{model_cls.__module__}.{model_cls.__qualname__}"
+        model_cfg.name = model_path
+        model_cfg.dtype = "torch.float32"
+        model_cfg.generate = generate_cfg
+        model_cfg.quantization = args.quantization
+        model_cfg.low_cpu_mem_usage = args.low_cpu_mem_usage
+        model_cfg.draft_model = {"name": args.draft_model} if args.draft_model else None
+        action_cfg.task[role] = model_cfg
+    return cfg
+
+
+def create_tiny_model(path, texts):
+    from tests import tiny_model
+
+    # the tokenizer is trained on the texts, and the context fits num_turns turns of the dialogues
+    tiny_model.create_tiny_model(
+        path,
+        tiny_model.create_bpe_tokenizer(texts),
+        hidden_size=64,
+        intermediate_size=128,
+        max_position_embeddings=4096,
+    )
+
+
+def percentile(values, q):
+    # nearest rank
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)] if values else None
+
+
+def run(args, model_path, batch_size):
+    with tempfile.TemporaryDirectory() as records_dir:
+        cfg = get_cfg(args, model_path, records_dir, batch_size)
+        Device.set_device(args.device)
+        dialogue_generator = BenchDialogueGenerator(cfg, aim_run=None)
+        dialogue_generator.initialize()
+        dialogue_generator.wait_warm_up()
+        if args.backend == "hf":
+            # load the weights before timing
+            dialogue_generator.model_inquirer.model
+            dialogue_generator.model_responder.model
+
+        start = time.perf_counter()
+        dialogue_generator.generate()
+        seconds = time.perf_counter() - start
+
+    num_dialogues = len(dialogue_generator.dataset.dataset) * len(dialogue_generator.personas)
+    latencies_ms = [latency * 1e3 for latency in dialogue_generator.turn_latencies]
+    return {
+        "backend": args.backend,
+        "model": (args.hf_model or "random tiny llama") if args.backend == "hf" else "stub",
+        "loading": dialogue_generator.tracker.params.get("model_loading"),
+        "draft_acceptance_rate": dialogue_generator.tracker.params.get("draft_acceptance_rate"),
+        "batch_size": batch_size,
+        "num_dialogues": num_dialogues,
+        "num_turns": args.num_turns,
+        "num_tokens": dialogue_generator.num_tokens,
+        "seconds": seconds,
+        "dialogues_per_sec": num_dialogues / seconds,
+        "tokens_per_sec": dialogue_generator.num_tokens / seconds,
+        "turn_latency_ms": {"p50": percentile(latencies_ms, 50), "p95": percentile(latencies_ms, 95)},
+    }
+
+
+def compare(results, baseline):
+    baseline = {(result["backend"], result["batch_size"]): result for result in baseline}
+    for result in results:
+        previous = baseline.get((result["backend"], result["batch_size"]))
+        if previous is None:
+            continue
+        for name in ("dialogues_per_sec", "tokens_per_sec"):
+            print(f"batch_size={result['batch_size']} {name}: {result[name] / previous[name] - 1:+.1%} vs baseline")
+        for name in ("p50", "p95"):
+            change = result["turn_latency_ms"][name] / previous["turn_latency_ms"][name] - 1
+            print(f"batch_size={result['batch_size']} turn latency {name}: {change:+.1%} vs baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["stub", "hf"], default="stub")
+    parser.add_argument("--hf-model", help="name or path of the model of the hf backend, a tiny one is built if omitted")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--quantization", choices=["int8_dynamic"], help="quantization of the hf backend's models")
+    parser.add_argument("--low-cpu-mem-usage", action="store_true", help="load the hf backend's models shard by shard")
+    parser.add_argument("--draft-model", help="name or path of the draft model of the hf backend, or tiny")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--num-samples", type=int, default=10)
+    parser.add_argument("--num-personas", type=int, default=4)
+    parser.add_argument("--num-turns", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--output", type=Path, help="JSON file the results are written to")
+    parser.add_argument("--baseline", type=Path, help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_path = args.hf_model
+        if args.backend == "hf" and model_path is None:
+            # the tokenizer is trained on the texts of the dialogues, so that they take a realistic number of tokens
+            cfg = OmegaConf.load(CONFIGS_DIR.joinpath("dialogue_generator.yaml"))
+            texts = list(cfg.action_config.task.dataset.data.instruction)
+            for role in ("model_inquirer", "model_responder"):
+                conv_template = OmegaConf.load(CONFIGS_DIR.joinpath("task", role, "llama.yaml")).conv_template
+                texts += [text for text in conv_template.values() if isinstance(text, str)]
+            create_tiny_model(model_dir, texts)
+            model_path = model_dir
+        if args.draft_model == "tiny":
+            from tests.tiny_model import create_tiny_draft
+
+            args.draft_model = str(Path(model_dir, "draft"))
+            create_tiny_draft(args.draft_model, model_path)
+        results = [run(args, model_path, batch_size) for batch_size in args.batch_size]
+    print(json.dumps(results, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if args.baseline:
+        compare(results, json.loads(args.baseline.read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
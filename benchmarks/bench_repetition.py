@@ -0,0 +1,68 @@
+"""
+Compares has_repetition (what Model.is_non_coherent runs now) and the word by word RepetitionDetector with the
+n-gram comparison is_non_coherent used before them, on long outputs.
+
+    python benchmarks/bench_repetition.py --num-words 2000 5000 10000 --max-n 8 --r 2
+"""
+import argparse
+import random
+import timeit
+
+from llm_roleplay.common.repetition import RepetitionDetector, has_repetition
+
+
+def is_non_coherent_reference(text, max_n, r):
+    words = text.split()
+    for n in range(2, max_n + 1):
+        n_grams = []
+        for i in range(len(words)):
+            n_gram = tuple(words[i : i + n])
+            if n_grams and len(n_grams) >= max(r, n):
+                if n_grams[-1] == n_gram or n_grams[-n] == n_gram:
+                    last_rs = n_grams[-r:]
+                    if len(last_rs) == r and len(set(last_rs)) == 1:
+                        return True
+                    last_rs = n_grams[-n::-n][:r]
+                    if len(last_rs) == r and len(set(last_rs)) == 1:
+                        return True
+            n_grams.append(n_gram)
+    return False
+
+
+def get_texts(num_words, rng):
+    vocabulary = [f"word{idx}" for idx in range(5000)]
+    coherent = [rng.choice(vocabulary) for _ in range(num_words)]
+    # a coherent output that degenerates into a loop over its last words
+    degenerate = coherent[: num_words - 40] + coherent[num_words - 50 : num_words - 40] * 4
+    return {"coherent": " ".join(coherent), "degenerate": " ".join(degenerate)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-words", type=int, nargs="+", default=[2000, 5000, 10000])
+    parser.add_argument("--max-n", type=int, default=8)
+    parser.add_argument("--r", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'words':>8} {'text':>12} {'reference ms':>14} {'batch ms':>10} {'incremental ms':>16} {'speedup':>9}")
+    for num_words in args.num_words:
+        for name, text in get_texts(num_words, rng).items():
+            verdict = is_non_coherent_reference(text, args.max_n, args.r)
+            assert has_repetition(text.split(), args.max_n, args.r) == verdict, "verdicts differ"
+            assert RepetitionDetector(args.max_n, args.r).add_words(text.split()) == verdict, "verdicts differ"
+
+            def measure(check):
+                return min(timeit.repeat(check, number=1, repeat=args.repeats)) * 1e3
+
+            reference = measure(lambda: is_non_coherent_reference(text, args.max_n, args.r))
+            batch = measure(lambda: has_repetition(text.split(), args.max_n, args.r))
+            incremental = measure(lambda: RepetitionDetector(args.max_n, args.r).add_words(text.split()))
+            print(
+                f"{num_words:>8} {name:>12} {reference:>14.2f} {batch:>10.2f} {incremental:>16.2f} "
+                f"{reference / batch:>8.1f}x"
+            )
+
+if __name__ == "__main__":
+    main()
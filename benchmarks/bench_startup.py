@@ -0,0 +1,128 @@
+"""
+Measures how long a run takes to start, each measurement in a fresh interpreter:
+- import: importing the dialogue generator and the openai backend, and whether that imported transformers
+- startup: from initialize until the models and tokenizers of both roles are loaded and the first turn can run,
+  with the models warmed up in the background (warm_up) and loaded one after the other on first use (sequential)
+
+The hf models are a tiny random llama built locally as in bench_dialogues.py, unless --hf-model is given.
+
+    python benchmarks/bench_startup.py --output startup.json
+    python benchmarks/bench_startup.py --hf-model meta-llama/Llama-2-7b-chat-hf --repeat 1
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+
+IMPORT_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "transformers": "transformers" in sys.modules}}))
+"""
+
+
+def run_child(args, *child_args):
+    output = subprocess.run(
+        [sys.executable, *child_args], check=True, capture_output=True, text=True, cwd=BENCHMARKS_DIR.parent
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_import(args, module):
+    results = [run_child(args, "-c", IMPORT_CODE.format(module=module)) for _ in range(args.repeat)]
+    return {
+        "seconds": statistics.median(result["seconds"] for result in results),
+        "imports_transformers": any(result["transformers"] for result in results),
+    }
+
+
+def measure_startup(args, model_path, mode):
+    results = [
+        run_child(args, str(Path(__file__).resolve()), "--child", mode, "--model-path", model_path)
+        for _ in range(args.repeat)
+    ]
+    return {name: statistics.median(result[name] for result in results) for name in results[0]}
+
+
+def child(args):
+    from omegaconf import open_dict
+    from urartu.common.device import Device
+
+    from bench_dialogues import BenchDialogueGenerator, get_cfg
+
+    bench_args = argparse.Namespace(
+        backend="hf",
+        num_turns=1,
+        num_personas=4,
+        num_samples=10,
+        max_new_tokens=8,
+        quantization=None,
+        low_cpu_mem_usage=False,
+        draft_model=None,
+    )
+    with tempfile.TemporaryDirectory() as records_dir:
+        cfg = get_cfg(bench_args, args.model_path, records_dir, batch_size=1)
+        with open_dict(cfg):
+            cfg.action_config.warm_up = args.child == "warm_up"
+        Device.set_device("cpu")
+
+        start = time.perf_counter()
+        dialogue_generator = BenchDialogueGenerator(cfg, aim_run=None)
+        dialogue_generator.initialize()
+        initialized = time.perf_counter()
+        # what the first turn waits for before it can generate
+        dialogue_generator.wait_warm_up()
+        for model in (dialogue_generator.model_inquirer, dialogue_generator.model_responder):
+            model.model
+            model.tokenizer
+        ready = time.perf_counter()
+
+    print(json.dumps({"initialize_seconds": initialized - start, "startup_seconds": ready - start}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hf-model", help="name or path of the models, a tiny one is built if omitted")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per measurement, the median is kept")
+    parser.add_argument("--output", type=Path, help="JSON file the results are written to")
+    parser.add_argument("--child", choices=["warm_up", "sequential"], help=argparse.SUPPRESS)
+    parser.add_argument("--model-path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_path = args.hf_model
+        if model_path is None:
+            from omegaconf import OmegaConf
+
+            from bench_dialogues import CONFIGS_DIR, create_tiny_model
+
+            cfg = OmegaConf.load(CONFIGS_DIR.joinpath("dialogue_generator.yaml"))
+            create_tiny_model(Path(model_dir), list(cfg.action_config.task.dataset.data.instruction))
+            model_path = model_dir
+
+        results = {
+            "model": args.hf_model or "random tiny llama",
+            "import": {
+                "dialogue_generator": measure_import(args, "llm_roleplay.actions.dialogue_generator"),
+                "model_openai": measure_import(args, "llm_roleplay.models.model_openai"),
+            },
+            "startup": {mode: measure_startup(args, model_path, mode) for mode in ("sequential", "warm_up")},
+        }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,74 @@
+import copy
+import json
+import logging
+import multiprocessing
 import os
+import signal
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-import logging
 import hydra
-import jsonlines
 import torch
 from aim import Run, Text
-from omegaconf import DictConfig
+from omegaconf import DictConfig, open_dict
 from tqdm import tqdm
 from urartu.common.action import Action
 from urartu.common.dataset import Dataset
-from llm_roleplay.common.model import Model
+from urartu.common.device import Device
 
+from llm_roleplay.common.memory import MemoryManager
+from llm_roleplay.common.model import Model
 from llm_roleplay.common.persona import Persona
+from llm_roleplay.common.records import Checkpoints, RecordWriter, merge_records, read_records
+from llm_roleplay.common.response_cache import ResponseCache
+from llm_roleplay.common.timing import Timer
+from llm_roleplay.common.tracker import Tracker
+
+
+class Dialogue:
+    """
+    State of a single (sample, persona) dialogue, so that several of them can be kept in flight at the same time.
+    """
+
+    def __init__(self, idx, sample, persona_idx, persona, persona_hash, instructions, checkpoint=None):
+        self.idx = idx
+        self.sample = sample
+        self.persona_idx = persona_idx
+        self.persona = persona
+        self.persona_hash = persona_hash
+        self.instructions = instructions
+        # state of the last completed turn, if the dialogue was interrupted in a previous run
+        self.checkpoint = checkpoint
+
+        self.inquirer_history = None
+        self.responder_history = None
+        self.dialog = []
+
+        self.turn = 0
+        self.regeneratinon_idx = 0
+        self.inquirer_generate_cfg = None
+        self.inquirer_prompt = None
+        self.inquirer_output_extract = None
+        self.responder_output = None
+
+        self.awaiting_responder = False
+        self.finished = False
+        # peaks of the memory measured over the turns of the dialogue, see MemoryManager
+        self.memory = {}
+        # ms spent in every stage of the loop for the dialogue, see Timer
+        self.timing = {}
 
 
 class DialogueGenerator(Action):
     def __init__(self, cfg: DictConfig, aim_run: Run) -> None:
         super().__init__(cfg, aim_run)
+        # index of the worker process of a sharded run, see generate_sharded
+        self.shard_idx = None
 
     def track(self, prompt, name, context=None):
+        # tracks right away, the dialogue loop reports through self.tracker which batches the texts
         self.aim_run.track(
             Text(prompt),
             name=name,
@@ -27,214 +76,610 @@ class DialogueGenerator(Action):
         )
 
     def initialize(self):
-        self.aim_run["num_no_prompts"] = 0
-        self.aim_run["num_multiple_prompts"] = 0
-        self.aim_run["num_non_coherent"] = 0
-        self.aim_run["num_regenerate_worked"] = 0
-        self.aim_run["num_self_replies"] = 0
-        self.aim_run["num_non_coherent_model_responder"] = 0
-        self.aim_run["personas"] = {}
+        self.tracker = Tracker(self.aim_run, **(self.action_cfg.get("tracking") or {}))
+        for counter in [
+            "num_no_prompts",
+            "num_multiple_prompts",
+            "num_non_coherent",
+            "num_regenerations",
+            "num_regenerate_candidates",
+            "num_regenerate_worked",
+            "num_empty_retries",
+            "num_turns_evicted",
+            "num_tokens_evicted",
+            "num_self_replies",
+            "num_non_coherent_model_responder",
+            "num_tokens_saved",
+        ]:
+            self.tracker.increment(counter, 0)
+        self.tracker.set("personas", {})
+        self.memory_manager = MemoryManager(self.tracker, **(self.action_cfg.get("memory") or {}))
+        self.timer = Timer(**(self.action_cfg.get("timing") or {}))
+        self.tracker.timer = self.timer
 
         self.task_cfg = self.action_cfg.task
 
-        self.records_dir = Path(self.action_cfg.workdir).joinpath(
-            "dialogs",
-            f"{self.task_cfg.model_inquirer.name.split('/')[-1]}",
-            str(self.aim_run.hash),
-        )
+        # resuming continues the records of a previous run instead of starting a new directory
+        resume_dir = self.action_cfg.get("resume_dir")
+        if resume_dir:
+            self.records_dir = Path(resume_dir)
+        else:
+            self.records_dir = Path(self.action_cfg.workdir).joinpath(
+                "dialogs",
+                f"{self.task_cfg.model_inquirer.name.split('/')[-1]}",
+                str(self.aim_run.hash),
+            )
         os.makedirs(self.records_dir, exist_ok=True)
-
-        self.dataset = Dataset.get_dataset(self.task_cfg.dataset)
-        print("----------------------------------------------------------------")
-        print(self.dataset.dataset)
-        print("----------------------------------------------------------------")
-        self.personas = Persona.get_personas(self.task_cfg.persona)
+        self.checkpoints = Checkpoints(self.records_dir, self.cfg.seed)
+        if self.timer.profile_dir is None:
+            self.timer.profile_dir = self.records_dir.joinpath("profiles")
 
         self.model_inquirer = Model.get_model(self.task_cfg.model_inquirer, role="model_inquirer")
         self.model_responder = Model.get_model(self.task_cfg.model_responder, role="model_responder")
 
         self.model_inquirer.spec_tokens = self.task_cfg.spec_tokens
         self.model_responder.spec_tokens = self.task_cfg.spec_tokens
-        self.model_inquirer.aim_run = self.aim_run
-        self.model_responder.aim_run = self.aim_run
+        self.model_inquirer.tracker = self.tracker
+        self.model_responder.tracker = self.tracker
+        self.model_inquirer.timer = self.timer
+        self.model_responder.timer = self.timer
+        # responses of deterministic generate calls are reused across runs, see ResponseCache
+        response_cache_cfg = self.action_cfg.get("response_cache")
+        self.response_cache = ResponseCache(**response_cache_cfg) if response_cache_cfg else None
+        self.model_inquirer.response_cache = self.response_cache
+        self.model_responder.response_cache = self.response_cache
+
+        # number of processes the work units are split across, each loads its own models
+        self.num_workers = self.action_cfg.get("num_workers", 1)
+
+        # the models are loaded in the background while the dataset and the personas are prepared
+        self.warm_up_futures = []
+        if self.action_cfg.get("warm_up", False) and self.num_workers == 1:
+            self.warm_up()
 
-    def generate(self) -> Path:
-        for idx, sample in tqdm(enumerate(self.dataset.dataset), total=len(self.dataset.dataset), desc="samples"):
-            for persona, persona_hash in tqdm(self.personas, desc="personas", leave=False):
-                self.aim_run["personas"][persona_hash] = persona
+        self.dataset = Dataset.get_dataset(self.task_cfg.dataset)
+        print("----------------------------------------------------------------")
+        print(self.dataset.dataset)
+        print("----------------------------------------------------------------")
+        self.personas = Persona.get_personas(self.task_cfg.persona, seed=self.cfg.seed)
+
+        # number of dialogues kept in flight, their pending prompts are generated together in one padded batch
+        self.batch_size = self.task_cfg.get("batch_size", 1)
+        if self.batch_size > 1 and not (
+            self.model_inquirer.SUPPORTS_BATCHING and self.model_responder.SUPPORTS_BATCHING
+        ):
+            logging.warning("Batched generation is not supported by the configured models, using batch_size=1")
+            self.batch_size = 1
+
+    def warm_up(self):
+        """
+        Loads the models and tokenizers of both roles concurrently in background threads, see Model.warm_up. Roles
+        configured with the same weights share them, the second one waits for the first to load them.
+        """
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="warm_up")
+        self.warm_up_futures = [executor.submit(model.warm_up) for model in (self.model_inquirer, self.model_responder)]
+        executor.shutdown(wait=False)
+
+    def wait_warm_up(self):
+        for future in self.warm_up_futures:
+            future.result()
+        self.warm_up_futures = []
+
+    def get_completed_work(self) -> Counter:
+        """
+        Counts the recorded dialogues of every (sample index, persona hash) pair in the records directory.
+        Records written before they carried the indices, or whose persona has another index since, are matched by
+        their sample and persona.
+        """
+        sample_idxs = {
+            json.dumps(sample, sort_keys=True, default=str): idx for idx, sample in enumerate(self.dataset.dataset)
+        }
+        # rendering every persona is only needed for the records that aren't matched by their index
+        persona_hashes = None
+
+        completed = Counter()
+        for record in read_records(self.records_dir, self.cfg.seed):
+            sample_idx = record.get("sample_idx")
+            if sample_idx is None:
+                sample_idx = sample_idxs.get(json.dumps(record["sample"], sort_keys=True, default=str))
+            persona_idx = record.get("persona_idx")
+            persona, persona_hash = None, None
+            if persona_idx in range(len(self.personas)):
+                persona, persona_hash = self.personas[persona_idx]
+            if persona != record["persona"]:
+                if persona_hashes is None:
+                    persona_hashes = {persona: persona_hash for persona, persona_hash in self.personas}
+                persona_hash = persona_hashes.get(record["persona"], record.get("persona_hash"))
+            completed[(sample_idx, persona_hash)] += 1
+        return completed
+
+    def get_work(self, completed: Counter = None):
+        completed = completed or Counter()
+        checkpoints = self.checkpoints.load_all()
+
+        for idx in range(len(self.dataset.dataset)):
+            for persona_idx, (_, persona_hash) in enumerate(self.personas):
+                if not completed[(idx, persona_hash)]:
+                    yield self.get_dialogue(idx, persona_idx, checkpoints)
+
+    def get_dialogue(self, idx, persona_idx, checkpoints) -> Dialogue:
+        sample = self.dataset.dataset[idx]
+        persona, persona_hash = self.personas[persona_idx]
+        instructions = [instruct.lstrip().rstrip() for instruct in sample[self.task_cfg.dataset.input_key].split("\n")]
+        checkpoint = checkpoints.get((idx, persona_idx))
+        # the dialogue of another persona, checkpointed when the persona index pointed to it, starts over
+        if checkpoint is not None and checkpoint.get("persona_hash") != persona_hash:
+            checkpoint = None
+        return Dialogue(
+            idx,
+            sample,
+            persona_idx,
+            persona,
+            persona_hash,
+            instructions,
+            checkpoint=checkpoint,
+        )
 
-                self.model_inquirer.history = []
-                self.model_responder.history = []
-                dialog = []
-                raw_dialog = []
+    def start_dialogue(self, dialogue: Dialogue):
+        self.tracker.set("personas", dialogue.persona, key=dialogue.persona_hash)
+        if dialogue.checkpoint is not None:
+            dialogue.turn = dialogue.checkpoint["turn"]
+            dialogue.dialog = dialogue.checkpoint["dialog"]
+            dialogue.responder_output = dialogue.checkpoint["responder_output"]
+            dialogue.inquirer_history = self.model_inquirer.load_history(dialogue.checkpoint["inquirer_history"])
+            dialogue.responder_history = self.model_responder.load_history(dialogue.checkpoint["responder_history"])
+        else:
+            dialogue.inquirer_history = self.model_inquirer.new_history()
+            dialogue.responder_history = self.model_responder.new_history()
+        dialogue.finished = dialogue.turn >= self.task_cfg.num_turns
+        return dialogue
+
+    def save_checkpoint(self, dialogue: Dialogue):
+        self.checkpoints.save(
+            (dialogue.idx, dialogue.persona_idx),
+            {
+                "sample_idx": dialogue.idx,
+                "persona_idx": dialogue.persona_idx,
+                "persona_hash": dialogue.persona_hash,
+                "turn": dialogue.turn,
+                "dialog": dialogue.dialog,
+                "responder_output": dialogue.responder_output,
+                "inquirer_history": self.model_inquirer.dump_history(dialogue.inquirer_history),
+                "responder_history": self.model_responder.dump_history(dialogue.responder_history),
+            },
+        )
 
-                instructions = [
-                    instruct.lstrip().rstrip() for instruct in sample[self.task_cfg.dataset.input_key].split("\n")
-                ]
+    def generate(self) -> Path:
+        # records of the workers of an interrupted sharded run count as completed work as well
+        self.merge_shards()
+        completed = self.get_completed_work()
+        work = self.get_work(completed)
+
+        if self.num_workers > 1:
+            self.generate_sharded([(dialogue.idx, dialogue.persona_idx) for dialogue in work])
+        else:
+            self.run_dialogues(
+                work,
+                self.records_dir,
+                total=len(self.dataset.dataset) * len(self.personas),
+                initial=sum(completed.values()),
+            )
+        return self.records_dir
 
-                if self.action_cfg.task.model_inquirer.regenerate_tries:
-                    regeneratinon_idx = 0
-                inquirer_generate_cfg = None
-                responder_output = None
-                turn = 0
-                with tqdm(total=self.task_cfg.num_turns, desc="turns", leave=False) as pbar:
-                    while turn < self.task_cfg.num_turns:
-                        pbar.set_postfix(turn=turn + 1)
-                        # ------------------------------------------ Inquirer Model ------------------------------------------
-                        inquirer_prompt = self.model_inquirer.get_prompt(
-                            turn=turn,
-                            response_msg=responder_output,
-                            persona=persona,
-                            instructions=instructions,
-                        )
-
-                        self.track(
-                            prompt=inquirer_prompt,
-                            name="inquirer_input",
-                            context={
-                                "sample_id": idx,
-                                "turn": turn,
-                                "persona_hash": persona_hash,
-                            },
-                        )
-                        inquirer_output, _ = self.model_inquirer.generate(
-                            prompt=inquirer_prompt,
-                            generate_cfg=(
-                                inquirer_generate_cfg
-                                if inquirer_generate_cfg
-                                else self.action_cfg.task.model_inquirer.generate
-                            ),
-                        )
-                        if not inquirer_output:
-                            break
-                        self.track(
-                            prompt=inquirer_output,
-                            name="inquirer_output",
-                            context={
-                                "sample_id": idx,
-                                "turn": turn,
-                                "persona_hash": persona_hash,
-                            },
-                        )
-
-                        # --------------------- if model_inquirer failed to provide coherent text ---------------------
-                        if self.model_inquirer.is_non_coherent(inquirer_output):
-                            self.aim_run["num_non_coherent"] += 1
+    def run_dialogues(self, work, records_dir: Path, total: int, initial: int = 0, desc: str = "dialogues"):
+        """
+        Generates the dialogues of work, keeping batch_size of them in flight, and records them in records_dir.
+        """
+        self.wait_warm_up()
+        active = []
+        self.record_writer = RecordWriter(
+            records_dir, self.cfg.seed, timer=self.timer, **(self.action_cfg.get("records") or {})
+        )
+        # a preempted job gets SIGTERM, raising on it lets the record writer drain before the process exits
+        sigterm_handler = None
+        if threading.current_thread() is threading.main_thread():
+            sigterm_handler = signal.signal(signal.SIGTERM, DialogueGenerator._terminate)
+        try:
+            with tqdm(total=total, initial=initial, desc=desc, position=self.shard_idx or 0) as pbar:
+                while True:
+                    # ---------------------------- refill the slots of the finished dialogues ----------------------------
+                    while len(active) < self.batch_size:
+                        dialogue = next(work, None)
+                        if dialogue is None:
                             break
+                        active.append(self.start_dialogue(dialogue))
+                    if not active:
+                        break
+
+                    with self.timer.profile(self.memory_manager.num_turns):
+                        self.inquirer_step([dialogue for dialogue in active if not dialogue.finished])
+                        self.responder_step([dialogue for dialogue in active if dialogue.awaiting_responder])
+
+                    memory = self.memory_manager.step()
+                    for dialogue in active:
+                        dialogue.memory = MemoryManager.merge_peaks(dialogue.memory, memory)
+                        if dialogue.finished:
+                            self.memory_manager.track_dialogue(dialogue.memory)
+                            # dropping the checkpoint first never lets a resumed run continue a recorded dialogue
+                            self.checkpoints.remove((dialogue.idx, dialogue.persona_idx))
+                            with self.timer.stage("save_record", [dialogue]):
+                                self.save_dialogue(dialogue)
+                            pbar.update(1)
+                    active = [dialogue for dialogue in active if not dialogue.finished]
+                    if self.timer.enabled:
+                        timing = self.timer.summary()
+                        self.tracker.set("timing", timing)
+                        self.tracker.set("tokens_per_sec", self.get_tokens_per_sec(timing))
+                    if self.response_cache is not None:
+                        self.tracker.set("response_cache_hit_rate", self.get_response_cache_hit_rate())
+        finally:
+            self.record_writer.close()
+            if self.response_cache is not None:
+                self.tracker.set("response_cache", self.response_cache.stats())
+                self.response_cache.close()
+            self.tracker.close()
+            self.model_inquirer.release()
+            self.model_responder.release()
+            if sigterm_handler is not None:
+                signal.signal(signal.SIGTERM, sigterm_handler)
+
+    def get_tokens_per_sec(self, timing):
+        # generated tokens of a role, as counted by the hf backends, over the time spent in its generate calls
+        tokens_per_sec = {}
+        for role, stages in (
+            ("model_inquirer", ("generate_inquirer", "generate_candidates")),
+            ("model_responder", ("generate_responder",)),
+        ):
+            total_ms = sum(timing[stage]["total_ms"] for stage in stages if stage in timing)
+            num_tokens = self.tracker.counters.get(f"num_generated_tokens_{role}")
+            if total_ms and num_tokens:
+                tokens_per_sec[role] = num_tokens / total_ms * 1e3
+        return tokens_per_sec
+
+    def get_response_cache_hit_rate(self):
+        # of the generate calls that looked up their response, those that found it, per role
+        hit_rate = {}
+        for role in ("model_inquirer", "model_responder"):
+            num_hits = self.tracker.counters.get(f"num_response_cache_hits_{role}", 0)
+            num_lookups = num_hits + self.tracker.counters.get(f"num_response_cache_misses_{role}", 0)
+            if num_lookups:
+                hit_rate[role] = num_hits / num_lookups
+        return hit_rate
+
+    @staticmethod
+    def _terminate(signum, frame):
+        raise SystemExit(f"terminated by signal {signum}")
+
+    def get_devices(self):
+        devices = self.action_cfg.get("devices")
+        if devices:
+            return list(devices)
+        if torch.cuda.is_available():
+            return [f"cuda:{idx}" for idx in range(torch.cuda.device_count())]
+        return [Device.get_device()]
+
+    def get_shard_dir(self, shard_idx: int) -> Path:
+        return self.records_dir.joinpath("shards", str(shard_idx))
+
+    def merge_shards(self):
+        """
+        Moves the records of the workers into the records directory, in the order a single process records them.
+        """
+        shards_dir = self.records_dir.joinpath("shards")
+        if not shards_dir.is_dir():
+            return
+        num_merged = merge_records(
+            sorted(path for path in shards_dir.iterdir() if path.is_dir()),
+            self.records_dir,
+            self.cfg.seed,
+            key=lambda record: (record["sample_idx"], record["persona_idx"]),
+            **(self.action_cfg.get("records") or {}),
+        )
+        if num_merged:
+            logging.info(f"Merged {num_merged} dialogues recorded by the workers into {self.records_dir}")
+
+    def generate_sharded(self, units):
+        """
+        Splits the (sample index, persona index) work units across num_workers processes, each with its own models on
+        its own device, taking the devices in turn. Every worker records its dialogues in its shard directory, which
+        are merged into the records directory once all of them finished, or by the next run if they were interrupted.
+        """
+        devices = self.get_devices()
+        for idx, persona_idx in units:
+            persona, persona_hash = self.personas[persona_idx]
+            self.tracker.set("personas", persona, key=persona_hash)
+
+        # CUDA can't be used in a forked process
+        context = multiprocessing.get_context("spawn")
+        try:
+            with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=context) as executor:
+                futures = [
+                    executor.submit(
+                        generate_shard,
+                        self.cfg,
+                        str(self.records_dir),
+                        shard_idx,
+                        units[shard_idx :: self.num_workers],
+                        devices[shard_idx % len(devices)],
+                    )
+                    for shard_idx in range(self.num_workers)
+                ]
+                for future in futures:
+                    for name, value in future.result().items():
+                        self.tracker.increment(name, value)
+            if self.response_cache is not None:
+                self.tracker.set("response_cache_hit_rate", self.get_response_cache_hit_rate())
+            self.merge_shards()
+        finally:
+            self.tracker.close()
+            if self.response_cache is not None:
+                self.response_cache.close()
+
+    def inquirer_step(self, dialogues):
+        for dialogue in dialogues:
+            self.model_inquirer.history = dialogue.inquirer_history
+            with self.timer.stage("get_prompt", [dialogue]):
+                dialogue.inquirer_prompt = self.model_inquirer.get_prompt(
+                    turn=dialogue.turn,
+                    response_msg=dialogue.responder_output,
+                    persona=dialogue.persona,
+                    instructions=dialogue.instructions,
+                )
+
+            self.tracker.track(
+                text=dialogue.inquirer_prompt,
+                name="inquirer_input",
+                context={
+                    "sample_id": dialogue.idx,
+                    "turn": dialogue.turn,
+                    "persona_hash": dialogue.persona_hash,
+                },
+            )
+
+        # dialogues that are regenerating their prompt use their own generation config and can't share a batch
+        num_candidates = self.action_cfg.task.model_inquirer.get("regenerate_candidates")
+        groups = {}
+        for dialogue in dialogues:
+            if dialogue.inquirer_generate_cfg and num_candidates:
+                self.regenerate_inquirer_output(dialogue, num_candidates)
+                continue
+            if dialogue.inquirer_generate_cfg:
+                group_key, generate_cfg = id(dialogue), dialogue.inquirer_generate_cfg
+            else:
+                group_key, generate_cfg = None, self.action_cfg.task.model_inquirer.generate
+            groups.setdefault(group_key, (generate_cfg, []))[1].append(dialogue)
+
+        for generate_cfg, group in groups.values():
+            with self.timer.stage("generate_inquirer", group):
+                outputs = self.model_inquirer.generate_batch(
+                    prompts=[dialogue.inquirer_prompt for dialogue in group],
+                    histories=[dialogue.inquirer_history for dialogue in group],
+                    generate_cfg=generate_cfg,
+                )
+            for dialogue, (inquirer_output, _) in zip(group, outputs):
+                self.process_inquirer_output(dialogue, inquirer_output)
+
+    def regenerate_inquirer_output(self, dialogue: Dialogue, num_candidates: int):
+        """
+        Samples the candidates of a regeneration together and goes on with the first one that has a prompt, or that
+        stops the dialogue, instead of regenerating the whole response once per try.
+        """
+
+        def accept(candidate):
+            if not candidate or self.model_inquirer.is_non_coherent(candidate):
+                return False
+            return self.model_inquirer.stop_dialog(candidate) or self.model_inquirer.has_prompt(candidate)
+
+        self.model_inquirer.history = dialogue.inquirer_history
+        with self.timer.stage("generate_candidates", [dialogue]):
+            inquirer_output, _, num_generated = self.model_inquirer.generate_candidates(
+                prompt=dialogue.inquirer_prompt,
+                generate_cfg=dialogue.inquirer_generate_cfg,
+                num_candidates=num_candidates,
+                accept=accept,
+            )
+        self.tracker.increment("num_regenerate_candidates", num_generated)
+        self.process_inquirer_output(dialogue, inquirer_output)
+
+    def process_inquirer_output(self, dialogue: Dialogue, inquirer_output):
+        if not inquirer_output:
+            dialogue.finished = True
+            return
+        self.tracker.track(
+            text=inquirer_output,
+            name="inquirer_output",
+            context={
+                "sample_id": dialogue.idx,
+                "turn": dialogue.turn,
+                "persona_hash": dialogue.persona_hash,
+            },
+        )
 
-                        # --------------------- if model_inquirer wants to stop the dialog ---------------------
-                        if self.model_inquirer.stop_dialog(inquirer_output):
-                            break
+        # --------------------- if model_inquirer failed to provide coherent text ---------------------
+        with self.timer.stage("is_non_coherent", [dialogue]):
+            non_coherent = self.model_inquirer.is_non_coherent(inquirer_output)
+        if non_coherent:
+            self.tracker.increment("num_non_coherent")
+            dialogue.finished = True
+            return
+
+        # --------------------- if model_inquirer wants to stop the dialog ---------------------
+        if self.model_inquirer.stop_dialog(inquirer_output):
+            dialogue.finished = True
+            return
+
+        with self.timer.stage("extract_prompt", [dialogue]):
+            inquirer_output_extract, num_prompts = self.model_inquirer.extract_prompt(prompt=inquirer_output)
+
+        if self.action_cfg.task.model_inquirer.regenerate_tries:
+            # --------------------- if model_inquirer failed to provide prompt ---------------------
+            if inquirer_output_extract is None:
+                if dialogue.regeneratinon_idx < self.action_cfg.task.model_inquirer.regenerate_tries:
+                    if self.action_cfg.task.model_inquirer.get("regenerate_candidates"):
+                        dialogue.inquirer_generate_cfg = self.model_inquirer.get_candidates_cfg()
+                    else:
+                        dialogue.inquirer_generate_cfg = self.model_inquirer.get_generation_cfg()
+                    dialogue.regeneratinon_idx += 1
+                    self.tracker.increment("num_regenerations")
+                    return
+                else:
+                    self.tracker.increment("num_no_prompts")
+                    dialogue.finished = True
+                    return
+            else:
+                if dialogue.regeneratinon_idx != 0:
+                    self.tracker.increment("num_regenerate_worked")
+                    dialogue.regeneratinon_idx = 0
+                    dialogue.inquirer_generate_cfg = None
+
+        if inquirer_output_extract is None:
+            self.tracker.increment("num_no_prompts")
+            dialogue.finished = True
+            return
+
+        self.tracker.track(
+            text=inquirer_output_extract,
+            name="inquirer_output_extract",
+            context={
+                "sample_id": dialogue.idx,
+                "turn": dialogue.turn,
+                "num_prompts": num_prompts,
+                "persona_hash": dialogue.persona_hash,
+            },
+        )
 
-                        inquirer_output_extract, num_prompts = self.model_inquirer.extract_prompt(
-                            prompt=inquirer_output
-                        )
-
-                        if self.action_cfg.task.model_inquirer.regenerate_tries:
-                            # --------------------- if model_inquirer failed to provide prompt ---------------------
-                            if inquirer_output_extract is None:
-                                if regeneratinon_idx < self.action_cfg.task.model_inquirer.regenerate_tries:
-                                    inquirer_generate_cfg = self.model_inquirer.get_generation_cfg()
-                                    regeneratinon_idx += 1
-                                    continue
-                                else:
-                                    self.aim_run["num_no_prompts"] += 1
-                                    break
-                            else:
-                                if regeneratinon_idx != 0:
-                                    self.aim_run["num_regenerate_worked"] += 1
-                                    regeneratinon_idx = 0
-                                    inquirer_generate_cfg = None
-
-                        if inquirer_output_extract is None:
-                            self.aim_run["num_no_prompts"] += 1
-                            break
+        # As the context for model_inquirer is getting bigger much faster -> Starts answering it's own questions
+        # To prevent this keep in the inquirer_history only the output prompt(the thing that model_responder will see).
+        self.model_inquirer.history = dialogue.inquirer_history
+        with self.timer.stage("update_history", [dialogue]):
+            self.model_inquirer.update_history(
+                prompt=dialogue.inquirer_prompt,
+                output_extract=inquirer_output_extract,
+            )
+
+        dialogue.inquirer_output_extract = inquirer_output_extract
+        dialogue.awaiting_responder = True
+
+    def responder_step(self, dialogues):
+        if not dialogues:
+            return
+
+        responder_prompts = []
+        for dialogue in dialogues:
+            self.model_responder.history = dialogue.responder_history
+            with self.timer.stage("get_prompt", [dialogue]):
+                responder_prompt = self.model_responder.get_prompt(
+                    turn=dialogue.turn, response_msg=dialogue.inquirer_output_extract
+                )
+            responder_prompts.append(responder_prompt)
+
+            self.tracker.track(
+                text=responder_prompt,
+                name="responder_input",
+                context={
+                    "sample_id": dialogue.idx,
+                    "turn": dialogue.turn,
+                    "persona_hash": dialogue.persona_hash,
+                },
+            )
+
+        with self.timer.stage("generate_responder", dialogues):
+            outputs = self.model_responder.generate_batch(
+                prompts=responder_prompts,
+                histories=[dialogue.responder_history for dialogue in dialogues],
+                generate_cfg=self.action_cfg.task.model_responder.generate,
+            )
+        for dialogue, responder_prompt, (responder_output, responder_model_output_template) in zip(
+            dialogues, responder_prompts, outputs
+        ):
+            self.process_responder_output(dialogue, responder_prompt, responder_output, responder_model_output_template)
+
+    def process_responder_output(
+        self, dialogue: Dialogue, responder_prompt, responder_output, responder_model_output_template
+    ):
+        dialogue.awaiting_responder = False
+        if not responder_output:
+            dialogue.finished = True
+            return
+        self.tracker.track(
+            text=responder_output,
+            name="responder_output",
+            context={
+                "sample_id": dialogue.idx,
+                "turn": dialogue.turn,
+                "persona_hash": dialogue.persona_hash,
+            },
+        )
 
-                        self.track(
-                            prompt=inquirer_output_extract,
-                            name="inquirer_output_extract",
-                            context={
-                                "sample_id": idx,
-                                "turn": turn,
-                                "num_prompts": num_prompts,
-                                "persona_hash": persona_hash,
-                            },
-                        )
-
-                        # As the context for model_inquirer is getting bigger much faster -> Starts answering it's own questions
-                        # To prevent this keep in the inquirer_history only the output prompt(the thing that model_responder will see).
-                        self.model_inquirer.update_history(
-                            prompt=inquirer_prompt,
-                            output_extract=inquirer_output_extract,
-                        )
-
-                        # ------------------------------------------ Responder Model ------------------------------------------
-
-                        responder_prompt = self.model_responder.get_prompt(
-                            turn=turn, response_msg=inquirer_output_extract
-                        )
-
-                        self.track(
-                            prompt=responder_prompt,
-                            name="responder_input",
-                            context={
-                                "sample_id": idx,
-                                "turn": turn,
-                                "persona_hash": persona_hash,
-                            },
-                        )
-                        responder_output, responder_model_output_template = self.model_responder.generate(
-                            prompt=responder_prompt,
-                            generate_cfg=self.action_cfg.task.model_responder.generate,
-                        )
-                        if not responder_output:
-                            break
-                        self.track(
-                            prompt=responder_output,
-                            name="responder_output",
-                            context={
-                                "sample_id": idx,
-                                "turn": turn,
-                                "persona_hash": persona_hash,
-                            },
-                        )
-
-                        # --------------------- if model_responder failed to provide coherent text ---------------------
-                        if self.model_responder.is_non_coherent(responder_output):
-                            self.aim_run["num_non_coherent_model_responder"] += 1
-                            break
+        # --------------------- if model_responder failed to provide coherent text ---------------------
+        with self.timer.stage("is_non_coherent", [dialogue]):
+            non_coherent = self.model_responder.is_non_coherent(responder_output)
+        if non_coherent:
+            self.tracker.increment("num_non_coherent_model_responder")
+            dialogue.finished = True
+            return
+
+        self.model_responder.history = dialogue.responder_history
+        with self.timer.stage("update_history", [dialogue]):
+            self.model_responder.update_history(
+                prompt=responder_prompt,
+                output_extract=responder_model_output_template,
+            )
+
+        # --------------------------------------- Saving the dialogue ---------------------------------------
+        dialogue.dialog.append(
+            {
+                "turn": dialogue.turn,
+                "model_inquirer": dialogue.inquirer_output_extract,
+                "model_responder": responder_output,
+            }
+        )
+        dialogue.responder_output = responder_output
+
+        dialogue.turn += 1
+        if dialogue.turn >= self.task_cfg.num_turns:
+            dialogue.finished = True
+        else:
+            with self.timer.stage("checkpoint", [dialogue]):
+                self.save_checkpoint(dialogue)
+
+    def save_dialogue(self, dialogue: Dialogue):
+        self.record_writer.write(
+            {
+                "sample_idx": dialogue.idx,
+                "persona_idx": dialogue.persona_idx,
+                "persona_hash": dialogue.persona_hash,
+                "persona": dialogue.persona,
+                "sample": dialogue.sample,
+                "num_turns": dialogue.turn,
+                "dialog": dialogue.dialog,
+                "memory": dialogue.memory,
+                "timing": Timer.round_timing(dialogue.timing),
+            }
+        )
 
-                        self.model_responder.update_history(
-                            prompt=responder_prompt,
-                            output_extract=responder_model_output_template,
-                        )
-
-                        # --------------------------------------- Saving the dialogue ---------------------------------------
-                        dialog.append(
-                            {
-                                "turn": turn,
-                                "model_inquirer": inquirer_output_extract,
-                                "model_responder": responder_output,
-                            }
-                        )
-                        raw_dialog.append(inquirer_output_extract)
-                        raw_dialog.append(responder_output)
-
-                        torch.cuda.empty_cache()
-                        turn += 1
-                        pbar.update(1)
-
-                with jsonlines.open(self.records_dir.joinpath(f"{self.cfg.seed}.jsonl"), mode="a") as writer:
-                    writer.write(
-                        {
-                            "persona": persona,
-                            "sample": sample,
-                            "num_turns": turn,
-                            "dialog": dialog,
-                        }
-                    )
 
-        return self.records_dir
+def generate_shard(cfg: DictConfig, records_dir: str, shard_idx: int, units, device: str):
+    """
+    Runs in a worker process of a sharded run: generates the dialogues of the work units in the shard directory of
+    the records directory, and returns the tracked counters, as the aim run stays with the main process.
+    """
+    Device.set_device(device)
+    cfg = copy.deepcopy(cfg)
+    with open_dict(cfg):
+        # the worker continues the records directory of the main process, in which it has its own shard
+        cfg.action_config.resume_dir = records_dir
+        cfg.action_config.num_workers = 1
+    dialogue_generator = DialogueGenerator(cfg, aim_run=None)
+    dialogue_generator.shard_idx = shard_idx
+    dialogue_generator.initialize()
+
+    checkpoints = dialogue_generator.checkpoints.load_all()
+    work = (dialogue_generator.get_dialogue(idx, persona_idx, checkpoints) for idx, persona_idx in units)
+    dialogue_generator.run_dialogues(
+        work, dialogue_generator.get_shard_dir(shard_idx), total=len(units), desc=f"dialogues of worker {shard_idx}"
+    )
+    return dict(dialogue_generator.tracker.counters)
 
 
 def main(cfg: DictConfig, aim_run: Run):
@@ -0,0 +1,104 @@
+from collections import deque
+from typing import Any, Callable, List, Optional, Tuple
+
+
+class History:
+    """
+    Conversation history of one model role within a single dialogue.
+
+    It iterates over its messages like the plain list the backends used to keep, so `"".join(history)` still gives
+    the conversation text. Next to the messages it carries the state that belongs to the conversation:
+    - message_ids: token ids of every message, kept by backends that feed the conversation to the model as tokens
+    - num_tokens: running total of the messages' token counts, if the backend passes count_tokens. A message stored
+      with its token ids is counted by them instead
+    - past_key_values, cached_ids: the key/value cache of the model and the token ids it was computed for
+    - generation: (prompt, prompt_ids, response_ids) of the last generate call, consumed by update_history
+    """
+
+    def __init__(self, messages: Optional[List[Any]] = None, count_tokens: Optional[Callable[[Any], int]] = None):
+        self.messages = deque()
+        self.message_ids: Optional[deque] = None
+        self.count_tokens = count_tokens
+        self.message_num_tokens = deque()
+        self.num_tokens = 0
+        self.past_key_values = None
+        self.cached_ids: List[int] = []
+        self.generation: Optional[Tuple[str, List[int], List[int]]] = None
+
+        for message in messages or []:
+            self.append(message)
+
+    @property
+    def token_ids(self) -> Optional[List[int]]:
+        if self.message_ids is None:
+            return None
+        return [token_id for ids in self.message_ids for token_id in ids]
+
+    def append(self, message, token_ids: Optional[List[int]] = None):
+        if token_ids is not None and (self.message_ids is not None or not self.messages):
+            if self.message_ids is None:
+                self.message_ids = deque()
+            self.message_ids.append(token_ids)
+        else:
+            # the token ids no longer cover the whole conversation
+            self.message_ids = None
+
+        if self.count_tokens is not None:
+            num_tokens = len(token_ids) if token_ids is not None else self.count_tokens(message)
+            self.message_num_tokens.append(num_tokens)
+            self.num_tokens += num_tokens
+        self.messages.append(message)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def evict_pair(self, start: int = 1) -> int:
+        """
+        Removes the two messages (a prompt and its response) at position start and returns their number of tokens.
+        Messages before start stay pinned, as they are usually few this takes constant time.
+        """
+        return self.evict(start, num_messages=2)
+
+    def evict(self, start: int = 1, num_messages: int = 1) -> int:
+        """
+        Removes num_messages messages at position start and returns their number of tokens, see evict_pair.
+        """
+        num_tokens = 0
+        for _ in range(num_messages):
+            del self.messages[start]
+            if self.message_ids is not None:
+                del self.message_ids[start]
+            if self.count_tokens is not None:
+                num_tokens += self.message_num_tokens[start]
+                del self.message_num_tokens[start]
+        self.num_tokens -= num_tokens
+        return num_tokens
+
+    def clear(self):
+        self.messages.clear()
+        self.message_ids = None
+        self.message_num_tokens.clear()
+        self.num_tokens = 0
+        self.drop_cache()
+
+    def drop_cache(self):
+        self.past_key_values = None
+        self.cached_ids = []
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, idx):
+        return self.messages[idx]
+
+    def __delitem__(self, idx):
+        del self.messages[idx]
+        if self.message_ids is not None:
+            del self.message_ids[idx]
+        if self.count_tokens is not None:
+            self.num_tokens -= self.message_num_tokens[idx]
+            del self.message_num_tokens[idx]
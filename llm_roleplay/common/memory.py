@@ -0,0 +1,110 @@
+import os
+import resource
+import sys
+from typing import Dict, Optional
+
+import torch
+
+from llm_roleplay.common.tracker import Tracker
+
+MB = 1024 * 1024
+
+
+class MemoryManager:
+    """
+    Frees the cached accelerator memory according to a policy instead of after every turn, and measures the memory
+    used by the generation, so that batch sizes and hosts can be chosen from data:
+    - never: leaves the caching allocator alone
+    - every: frees the cache every every_n_turns turns
+    - threshold: frees the cache once the memory reserved on the accelerator is above threshold_mb
+    Every turn, the current and peak RSS of the process and memory allocated on the accelerator are tracked, and
+    the peaks of a dialogue are kept until it finishes. Values are in MB, the accelerator ones are None without CUDA.
+    """
+
+    POLICIES = ("never", "every", "threshold")
+
+    def __init__(
+        self,
+        tracker: Optional[Tracker] = None,
+        policy: str = "every",
+        every_n_turns: int = 1,
+        threshold_mb: Optional[float] = None,
+    ):
+        if policy not in MemoryManager.POLICIES:
+            raise ValueError(f"unknown memory policy: {policy}, expected one of {MemoryManager.POLICIES}")
+        if policy == "threshold" and threshold_mb is None:
+            raise ValueError("the threshold memory policy requires threshold_mb")
+        self.tracker = tracker if tracker is not None else Tracker()
+        self.policy = policy
+        self.every_n_turns = max(1, every_n_turns)
+        self.threshold_mb = threshold_mb
+        self.num_turns = 0
+        self.peaks: Dict[str, Optional[float]] = {}
+
+    def step(self) -> Dict[str, Optional[float]]:
+        """
+        Called once a turn of the dialogues in flight was generated, returns the memory measured for it.
+        """
+        self.num_turns += 1
+        stats = MemoryManager.measure()
+        for name, value in stats.items():
+            self.tracker.track_metric(value, name=f"memory_{name}", context={"subset": "turn"})
+        self.peaks = MemoryManager.merge_peaks(self.peaks, stats)
+        self.tracker.set("memory", self.peaks)
+
+        if self.should_free(stats):
+            torch.cuda.empty_cache()
+            self.tracker.increment("num_cache_frees")
+        if torch.cuda.is_available():
+            # the next turn's peak is measured from here
+            torch.cuda.reset_peak_memory_stats()
+        return stats
+
+    def should_free(self, stats: Dict[str, Optional[float]]) -> bool:
+        if self.policy == "every":
+            return self.num_turns % self.every_n_turns == 0
+        if self.policy == "threshold":
+            return stats["accelerator_reserved_mb"] is not None and stats["accelerator_reserved_mb"] > self.threshold_mb
+        return False
+
+    def track_dialogue(self, peaks: Dict[str, Optional[float]]):
+        for name, value in peaks.items():
+            self.tracker.track_metric(value, name=f"memory_{name}", context={"subset": "dialogue"})
+
+    @staticmethod
+    def merge_peaks(peaks: Dict[str, Optional[float]], stats: Dict[str, Optional[float]]):
+        """
+        Returns the peaks updated with the stats of a turn, a dialogue keeps its own peaks across the turns it spans.
+        """
+        merged = dict(peaks)
+        # the RSS peak of the process never resets, the largest RSS measured after a turn is used instead
+        for name, stat in (("rss_peak_mb", "rss_mb"), ("accelerator_peak_mb", "accelerator_peak_mb")):
+            value = stats.get(stat)
+            if value is not None:
+                merged[name] = max(merged.get(name) or 0.0, value)
+        return merged
+
+    @staticmethod
+    def measure() -> Dict[str, Optional[float]]:
+        stats = {
+            "rss_mb": MemoryManager._current_rss_mb(),
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            / (MB if sys.platform == "darwin" else 1024),
+            "accelerator_mb": None,
+            "accelerator_peak_mb": None,
+            "accelerator_reserved_mb": None,
+        }
+        if torch.cuda.is_available():
+            stats["accelerator_mb"] = torch.cuda.memory_allocated() / MB
+            stats["accelerator_peak_mb"] = torch.cuda.max_memory_allocated() / MB
+            stats["accelerator_reserved_mb"] = torch.cuda.memory_reserved() / MB
+        return stats
+
+    @staticmethod
+    def _current_rss_mb() -> Optional[float]:
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+        except (OSError, ValueError, IndexError):
+            return None
@@ -1,46 +1,598 @@
+import contextlib
 import copy
 import logging
 import random
 import re
 import string
-import hydra
-from typing import Any, Dict, List
+import time
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 
+import hydra
+import torch
+from omegaconf import OmegaConf
 from urartu.common.device import Device
+from urartu.utils.dtype import eval_dtype
+
+from llm_roleplay.common.history import History
+from llm_roleplay.common.memory import MemoryManager
+from llm_roleplay.common.registry import ModelRegistry
+from llm_roleplay.common.repetition import RepetitionDetector, has_repetition
+from llm_roleplay.common.response_cache import ResponseCache
+from llm_roleplay.common.template import Template, compile_templates
+from llm_roleplay.common.timing import Timer
+from llm_roleplay.common.tracker import Tracker
+
+if TYPE_CHECKING:
+    from transformers import StoppingCriteriaList
+
+    from llm_roleplay.common.stopping import GenerationTimer
+
+# a prompt of the inquirer's response is quoted
+PROMPT_PATTERN = re.compile(r'"((?:.|[\n\t\r\b\\"])*?)"')
 
 
 class Model:
+    SELF_REPLY_TOKENS: Dict[str, str] = {}
+    # whether generate_batch runs the prompts of several dialogues together instead of one after another
+    SUPPORTS_BATCHING = False
+    # spec tokens that get_prompt and format_response fill into every conv template of a role
+    TEMPLATE_PLACEHOLDERS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+        "model_inquirer": {
+            "first_turn_input": ("persona_placeholder", "objective_placeholder", "conv_stop_placeholder"),
+            "n_th_turn_input": ("user_msg",),
+            "response_forwarding": ("next_prompt", "response_placeholder", "conv_stop_placeholder"),
+            "mid_response_forwarding": ("next_prompt", "response_placeholder", "conv_stop_placeholder"),
+            "model_output": ("model_answer",),
+        },
+        "model_responder": {
+            "first_turn_input": ("objective_placeholder",),
+            "n_th_turn_input": ("user_msg",),
+            "model_output": ("model_answer",),
+        },
+    }
+
     def __init__(self, cfg: List[Dict[str, Any]], role=None):
         self.cfg = cfg
         self.conv_template = cfg.conv_template
-        self.spec_tokens = None
-        self.aim_run = None
         self.role = role
-        self.history = []
+        self.spec_tokens = None
+        self.tracker = Tracker()
+        self.timer = Timer(enabled=False)
+        # shared by the roles, set by the owner of the tracker like the timer
+        self.response_cache: Optional[ResponseCache] = None
+        self.history = self.new_history()
         self._model = None
+        self._draft_model = None
+        self._generation_config = None
+        self._registry_keys = []
 
     @staticmethod
     def get_model(cfg, role):
         return hydra.utils.instantiate(cfg.type, cfg, role)
 
+    @property
+    def spec_tokens(self):
+        return self._spec_tokens
+
+    @spec_tokens.setter
+    def spec_tokens(self, spec_tokens):
+        # the conv templates are parsed once, and checked for placeholders they'd keep unfilled, with the spec tokens
+        self._spec_tokens = spec_tokens
+        self.templates: Dict[str, Template] = {}
+        if spec_tokens is not None:
+            self.templates = compile_templates(
+                self.conv_template,
+                spec_tokens,
+                self.TEMPLATE_PLACEHOLDERS.get(self.role, {}),
+                f"conv_template of {self.role}",
+            )
+
     @property
     def model(self):
         raise NotImplementedError("property 'model' instantiation is not implemented")
 
-    def get_prompt(self, turn, response_msg, persona=None, instructions=None):
-        raise NotImplementedError("method 'get_prompt' is not implemented")
+    @property
+    def tokenizer(self):
+        raise NotImplementedError("property 'tokenizer' instantiation is not implemented")
+
+    @property
+    def generation_config(self):
+        # read from the checkpoint instead of the loaded model, a rerun answered by the response cache loads no weights
+        if self._generation_config is None:
+            import transformers
+
+            try:
+                self._generation_config = transformers.GenerationConfig.from_pretrained(
+                    self.cfg.name, cache_dir=self.cfg.cache_dir, token=self.cfg.api_token
+                )
+            except OSError:
+                # the checkpoint has no generation config, transformers generates with the defaults then
+                self._generation_config = transformers.GenerationConfig()
+        return self._generation_config
+
+    @property
+    def draft_model(self):
+        if self._draft_model is None and self.cfg.get("draft_model"):
+            self._draft_model = self.load_draft_model()
+        return self._draft_model
+
+    def acquire(self, key, load):
+        """
+        Returns the instance that the registry holds for key, loading it if no other role did, see ModelRegistry.
+        """
+        instance = ModelRegistry.acquire(key, load)
+        self._registry_keys.append(key)
+        return instance
+
+    def release(self):
+        # drops this role's references to the shared instances, they are freed once no role uses them anymore
+        for key in self._registry_keys:
+            ModelRegistry.release(key)
+        self._registry_keys = []
+        self._model = None
+        self._draft_model = None
+
+    def warm_up(self):
+        """
+        Loads the model, the tokenizer and the draft model ahead of the first generate call. A failure is only logged,
+        the first call that needs them loads them again and raises it.
+        """
+        try:
+            with self.timer.stage(f"warm_up_{self.role}"):
+                self.model
+                self.tokenizer
+                self.draft_model
+        except Exception as e:
+            logging.warning(f"Warming up {self.role} failed: {e}")
+
+    def load_causal_lm(self, cfg=None, loading_key=None):
+        """
+        Returns the causal language model of the config, shared by every role configured with the same weights.
+        cfg defaults to the config of the model, its loading stats are reported under loading_key, the role by default.
+        """
+        # transformers takes seconds to import, it's only imported by the backends that load from it
+        import transformers
+
+        cfg = self.cfg if cfg is None else cfg
+        device = Device.get_device()
+        quantization = cfg.get("quantization")
+        max_memory = cfg.get("max_memory")
+        key = ("causal_lm", cfg.name, str(cfg.dtype), str(device), quantization, str(max_memory))
+
+        def load():
+            dtype = eval_dtype(cfg.dtype)
+            device_map = device
+            load_kwargs = {}
+            if quantization == "int8_dynamic":
+                # auto places on the cpu as well without an accelerator
+                if str(device) != "cpu" and torch.cuda.is_available():
+                    raise ValueError(f"int8_dynamic quantization only runs on cpu, not on {device}")
+                if dtype != torch.float32:
+                    logging.warning(f"Loading {cfg.name} in torch.float32 instead of {dtype} to quantize it")
+                    dtype = torch.float32
+            elif quantization is not None:
+                raise ValueError(f"unknown quantization: {quantization}")
+            if max_memory:
+                # the layers that don't fit into max_memory are offloaded, which needs the placement of accelerate
+                device_map = "auto"
+                load_kwargs["max_memory"] = dict(max_memory)
+                load_kwargs["offload_folder"] = cfg.get("offload_folder")
+            if cfg.get("low_cpu_mem_usage"):
+                # the checkpoint is loaded into the model shard by shard, safetensors are memory mapped, instead of
+                # first materializing randomly initialized weights next to it
+                load_kwargs["low_cpu_mem_usage"] = True
+
+            start = time.perf_counter()
+            rss_before = MemoryManager.measure()["rss_mb"]
+            causal_lm = transformers.AutoModelForCausalLM.from_pretrained(
+                cfg.name,
+                cache_dir=cfg.cache_dir,
+                device_map=device_map,
+                torch_dtype=dtype,
+                token=cfg.api_token,
+                **load_kwargs,
+            )
+            for param in causal_lm.parameters():
+                param.requires_grad = False
+            causal_lm.eval()
+            if quantization == "int8_dynamic":
+                causal_lm = torch.ao.quantization.quantize_dynamic(causal_lm, {torch.nn.Linear}, dtype=torch.qint8)
+
+            stats = MemoryManager.measure()
+            self.tracker.set(
+                "model_loading",
+                {
+                    "name": cfg.name,
+                    "quantization": quantization,
+                    "low_cpu_mem_usage": cfg.get("low_cpu_mem_usage", False),
+                    "max_memory": str(max_memory) if max_memory else None,
+                    "seconds": time.perf_counter() - start,
+                    "rss_mb": stats["rss_mb"],
+                    "rss_load_mb": stats["rss_mb"] - rss_before if rss_before is not None else None,
+                    "rss_peak_mb": stats["rss_peak_mb"],
+                    "accelerator_mb": stats["accelerator_mb"],
+                },
+                key=loading_key or self.role,
+            )
+            return causal_lm
+
+        return self.acquire(key, load)
+
+    def load_draft_model(self):
+        """
+        Returns the small model of the draft_model config, which proposes the next tokens that the causal language
+        model verifies in one forward pass (assisted generation). It must share the tokenizer of the model, as its
+        tokens are verified as they are. Its cache_dir and dtype default to the model's, the api_token is the model's.
+        """
+        draft_cfg = self.cfg.draft_model
+        if draft_cfg.name == self.cfg.name:
+            raise ValueError(f"draft model {draft_cfg.name} is the model itself")
+        cfg = OmegaConf.create(
+            {
+                "name": draft_cfg.name,
+                "cache_dir": draft_cfg.get("cache_dir", self.cfg.cache_dir),
+                "dtype": draft_cfg.get("dtype", self.cfg.dtype),
+                "api_token": self.cfg.api_token,
+                "quantization": draft_cfg.get("quantization"),
+                "low_cpu_mem_usage": self.cfg.get("low_cpu_mem_usage", False),
+            }
+        )
+        if self.load_tokenizer(draft_cfg.name).get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"draft model {draft_cfg.name} doesn't share the tokenizer of {self.cfg.name}")
+
+        draft_model = self.load_causal_lm(cfg, loading_key=f"{self.role}_draft")
+        # the heuristic schedule adapts the number of proposed tokens to the acceptance, starting from this one
+        draft_model.generation_config.num_assistant_tokens = draft_cfg.get("num_assistant_tokens", 5)
+        draft_model.generation_config.num_assistant_tokens_schedule = draft_cfg.get(
+            "num_assistant_tokens_schedule", "heuristic"
+        )
+        return draft_model
+
+    def load_tokenizer(self, name=None):
+        import transformers
+
+        name = name or self.cfg.name
+
+        def load():
+            tokenizer = transformers.AutoTokenizer.from_pretrained(name)
+            # batched generation pads the prompts on the left so that all of them end at the same position
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            tokenizer.padding_side = "left"
+            return tokenizer
+
+        return self.acquire(("tokenizer", name), load)
+
+    def new_history(self) -> History:
+        # the history window evicts by the token counts of the messages, they're only kept if it's configured
+        if self.cfg.get("history_window"):
+            return History(count_tokens=self.count_tokens)
+        return History()
+
+    def count_tokens(self, message: str) -> int:
+        return len(self.tokenizer.encode(message, add_special_tokens=False))
+
+    def dump_history(self, history: History) -> List[Any]:
+        """
+        Returns the messages of the history in a JSON serializable form, for checkpointing a dialogue.
+        """
+        return list(history)
+
+    def load_history(self, messages: List[Any]) -> History:
+        # the token ids and caches are rebuilt lazily on the next generate call
+        history = self.new_history()
+        history.extend(messages)
+        return history
+
+    def get_prompt(self, turn, response_msg=None, persona=None, instructions=None):
+        if self.role == "model_inquirer":
+            assert persona is not None, "persona cannot be None"
+            assert instructions is not None, "instructions cannot be None"
+
+            if turn == 0:
+                return self.templates["first_turn_input"].render(
+                    persona_placeholder=persona,
+                    objective_placeholder=str(instructions[0]),
+                    conv_stop_placeholder=self.spec_tokens.conv_stop_token,
+                )
+
+            assert response_msg is not None, "response_msg cannot be None"
+            if len(instructions) > 1 and turn < len(instructions):
+                response_forwarding, next_prompt = self.templates["mid_response_forwarding"], instructions[turn]
+            else:
+                response_forwarding, next_prompt = self.templates["response_forwarding"], ""
+            return self.templates["n_th_turn_input"].render(
+                user_msg=response_forwarding.render(
+                    next_prompt=next_prompt,
+                    response_placeholder=response_msg,
+                    conv_stop_placeholder=self.spec_tokens.conv_stop_token,
+                )
+            )
+        elif self.role == "model_responder":
+            assert response_msg is not None, "response_msg cannot be None"
+
+            if turn == 0:
+                return self.templates["first_turn_input"].render(objective_placeholder=response_msg)
+            return self.templates["n_th_turn_input"].render(user_msg=response_msg)
+        else:
+            raise NotImplementedError(f"unknown role: {self.role}")
 
     def generate(self, prompt):
         raise NotImplementedError("method 'generate' is not implemented")
 
+    def generate_batch(self, prompts: List[str], histories: List[List[Any]], generate_cfg):
+        """
+        Generates a response for every (prompt, history) pair, where each pair belongs to a different dialogue.
+        Backends that can pad the prompts into a single generate call override this, the default runs them one by one.
+        """
+        outputs = []
+        for prompt, history in zip(prompts, histories):
+            self.history = history
+            outputs.append(self.generate(prompt=prompt, generate_cfg=generate_cfg))
+        return outputs
+
     def update_history(self, prompt, output_extract):
         raise NotImplementedError("method 'update_history' is not implemented")
 
+    def does_sample(self, generate_cfg) -> bool:
+        # a do_sample left out of the generate config is the one of the model's generation config, llama-2-chat samples
+        do_sample = generate_cfg.get("do_sample")
+        if do_sample is None:
+            do_sample = self.generation_config.do_sample
+        return bool(do_sample)
+
+    def is_deterministic(self, generate_cfg) -> bool:
+        # greedy, beam and contrastive search always give the same response to the same inputs
+        return not self.does_sample(generate_cfg)
+
+    def get_cache_key(self, inputs, generate_cfg) -> Optional[str]:
+        """
+        Returns the key of the response to inputs, the conversation and the prompt as the model takes them, in the
+        response cache. None if there's no cache or the generate config samples, as its responses can't be reused.
+        """
+        if self.response_cache is None:
+            return None
+        if not self.is_deterministic(generate_cfg):
+            self.tracker.increment(f"num_response_cache_bypassed_{self.role}")
+            return None
+        return ResponseCache.get_key(self.role, self.cfg, inputs, generate_cfg)
+
+    def get_cached_response(self, key: Optional[str]) -> Optional[Any]:
+        if key is None:
+            return None
+        with self.timer.stage("response_cache"):
+            response = self.response_cache.get(key)
+        self.tracker.increment(f"num_response_cache_{'misses' if response is None else 'hits'}_{self.role}")
+        return response
+
+    def cache_response(self, key: Optional[str], response: Any):
+        if key is not None:
+            with self.timer.stage("response_cache"):
+                self.response_cache.put(key, response)
+
+    def get_input_ids(self, prompt: str) -> Tuple[List[int], List[int]]:
+        """
+        Returns the token ids of the conversation so far and of the new prompt, for backends that keep their history
+        as token ids. Only the new prompt is tokenized, unless the history was filled without its token ids.
+        """
+        with self.timer.stage("tokenize"):
+            if self.history.message_ids is None and self.history:
+                self.history.message_ids = deque(
+                    self.tokenizer.encode(message, add_special_tokens=idx == 0)
+                    for idx, message in enumerate(self.history)
+                )
+            prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=not self.history)
+            self.fit_history(len(prompt_ids))
+            return self.history.token_ids or [], prompt_ids
+
+    def fit_history(self, num_prompt_tokens: int):
+        """
+        Keeps the history and the new prompt within the max_tokens of the history_window config by evicting the oldest
+        turns. The first one, which holds the persona and the objective, stays pinned. Turns are evicted down to
+        low_watermark * max_tokens at once, so that the key/value cache, whose tokens after the first turn no longer
+        match once a turn is evicted, is only rebuilt every few turns instead of every turn.
+        """
+        history_window = self.cfg.get("history_window")
+        if not history_window or self.history.num_tokens + num_prompt_tokens <= history_window.max_tokens:
+            return
+
+        max_tokens = history_window.max_tokens * history_window.get("low_watermark", 1.0)
+        num_evicted = 0
+        while self.history.num_tokens + num_prompt_tokens > max_tokens and len(self.history) > 1:
+            self.tracker.increment("num_tokens_evicted", self.history.evict(start=1))
+            num_evicted += 1
+        self.tracker.increment("num_turns_evicted", num_evicted)
+
+    def get_message_ids(self, prompt: str, message: str) -> Optional[List[int]]:
+        """
+        Returns the token ids of a message that update_history stores for the prompt. The generated tokens are reused
+        when they are what is being stored, otherwise only the part of the message after the prompt is tokenized.
+        Without a generation for the prompt nothing is tokenized here, get_input_ids tokenizes the history when needed.
+        """
+        generation, self.history.generation = self.history.generation, None
+        if generation is None or generation[0] != prompt:
+            return None
+
+        _, prompt_ids, response_ids = generation
+        special_ids = set(self.tokenizer.all_special_ids)
+        while response_ids and response_ids[-1] in special_ids:
+            response_ids = response_ids[:-1]
+        with self.timer.stage("tokenize"):
+            if self.tokenizer.decode(response_ids, skip_special_tokens=True).strip() == message[len(prompt) :].strip():
+                return prompt_ids + response_ids
+            return prompt_ids + self.tokenizer.encode(message[len(prompt) :], add_special_tokens=False)
+
+    def generate_ids_batch(self, causal_lm, prompts: List[str], histories: List[History], generate_cfg):
+        """
+        Generates the responses of several dialogues with one padded generate call of the causal language model.
+        Responses found in the response cache are left out of the call.
+        """
+        prompts_ids, model_prompts, cache_keys, responses_ids = [], [], [], []
+        for prompt, history in zip(prompts, histories):
+            self.history = history
+            history_ids, prompt_ids = self.get_input_ids(prompt)
+            prompts_ids.append(prompt_ids)
+            model_prompts.append(history_ids + prompt_ids)
+            cache_keys.append(self.get_cache_key(model_prompts[-1], generate_cfg))
+            responses_ids.append(self.get_cached_response(cache_keys[-1]))
+
+        missing = [idx for idx, response_ids in enumerate(responses_ids) if response_ids is None]
+        if missing:
+            model_prompts = [model_prompts[idx] for idx in missing]
+            with self.timer.generation() as generation_timer:
+                generated_ids = Model.generate_padded(
+                    causal_lm,
+                    self.tokenizer,
+                    model_prompts,
+                    generate_cfg,
+                    stopping_criteria=self.get_stopping_criteria(
+                        max(map(len, model_prompts)), generate_cfg, generation_timer
+                    ),
+                ).tolist()
+
+            self.count_generated(generated_ids)
+            for idx, response_ids in zip(missing, generated_ids):
+                # the cache of a single dialogue can't be extended by a padded batch
+                histories[idx].drop_cache()
+                self.cache_response(cache_keys[idx], response_ids)
+                responses_ids[idx] = response_ids
+
+        outputs = []
+        for prompt, history, prompt_ids, response_ids in zip(prompts, histories, prompts_ids, responses_ids):
+            history.generation = (prompt, prompt_ids, response_ids)
+            self.history = history
+            with self.timer.stage("detokenize"):
+                turn_response = self.tokenizer.decode(response_ids, skip_special_tokens=True).strip()
+            outputs.append(self.format_response(turn_response))
+        return outputs
+
+    def generate_candidates(
+        self, prompt: str, generate_cfg, num_candidates: int, accept: Callable[[str], bool]
+    ) -> Tuple[str, str, int]:
+        """
+        Samples up to num_candidates responses to the prompt and returns the first one that accept takes, or the last
+        one if none is taken, with the number of candidates that were generated. Backends that can sample several
+        sequences in one generate call override this, the default generates them one by one.
+        """
+        for num_generated in range(1, num_candidates + 1):
+            turn_response, model_output_template = self.generate(prompt=prompt, generate_cfg=generate_cfg)
+            if accept(turn_response):
+                break
+        return turn_response, model_output_template, num_generated
+
+    def generate_candidates_ids(
+        self, causal_lm, prompt: str, generate_cfg, num_candidates: int, accept: Callable[[str], bool]
+    ) -> Tuple[str, str, int]:
+        """
+        Samples the candidates of generate_candidates as the num_return_sequences of a single generate call.
+        """
+        history_ids, prompt_ids = self.get_input_ids(prompt)
+        input_ids = history_ids + prompt_ids
+        generate_cfg = {**generate_cfg, "num_return_sequences": num_candidates}
+        with self.timer.generation() as generation_timer:
+            candidates_ids = Model.generate_padded(
+                causal_lm,
+                self.tokenizer,
+                [input_ids],
+                generate_cfg,
+                stopping_criteria=self.get_stopping_criteria(len(input_ids), generate_cfg, generation_timer),
+            ).tolist()
+
+        self.count_generated(candidates_ids)
+
+        # the cache of the dialogue can't be extended by the sequences of several candidates
+        self.history.drop_cache()
+        for response_ids in candidates_ids:
+            with self.timer.stage("detokenize"):
+                turn_response = self.tokenizer.decode(response_ids, skip_special_tokens=True).strip()
+            turn_response, model_output_template = self.format_response(turn_response)
+            if accept(turn_response):
+                break
+        self.history.generation = (prompt, prompt_ids, response_ids)
+        return turn_response, model_output_template, len(candidates_ids)
+
+    def get_draft_model(self, generate_cfg):
+        # assisted generation verifies the draft of a single greedy or sampled sequence
+        if (
+            generate_cfg.get("num_beams", 1) in (None, 1)
+            and not generate_cfg.get("penalty_alpha")
+            and generate_cfg.get("num_return_sequences", 1) in (None, 1)
+        ):
+            return self.draft_model
+        return None
+
+    @contextlib.contextmanager
+    def count_forwards(self, causal_lm, draft_model):
+        """
+        Counts the forward passes of the causal language model and of the draft model during assisted generation.
+        Each pass of the draft model proposes one token, each pass of the causal language model verifies the proposed
+        tokens and adds one of its own.
+        """
+        num_forwards = Counter()
+        if draft_model is None:
+            yield num_forwards
+            return
+
+        hooks = [
+            module.register_forward_hook(lambda *_, name=name: num_forwards.update([name]))
+            for name, module in (("draft", draft_model), ("target", causal_lm))
+        ]
+        try:
+            yield num_forwards
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+    def count_drafted(self, num_forwards: Counter, num_generated: int):
+        """
+        Counts the drafted tokens of an assisted generate call and the ones that were accepted, for the acceptance rate
+        of the role's draft model.
+        """
+        if not num_forwards:
+            return
+        # the tokens that the verification passes didn't add themselves were accepted from the draft
+        num_accepted = min(max(num_generated - num_forwards["target"], 0), num_forwards["draft"])
+        self.tracker.increment(f"num_drafted_tokens_{self.role}", num_forwards["draft"])
+        self.tracker.increment(f"num_accepted_tokens_{self.role}", num_accepted)
+        num_drafted = self.tracker.counters[f"num_drafted_tokens_{self.role}"]
+        if num_drafted:
+            self.tracker.set(
+                "draft_acceptance_rate",
+                self.tracker.counters[f"num_accepted_tokens_{self.role}"] / num_drafted,
+                key=self.role,
+            )
+
+    def count_generated(self, responses_ids: List[List[int]]):
+        """
+        Counts the generated tokens of a generate call for the throughput of the role, without the padding and eos
+        tokens after the responses that finished before the others.
+        """
+        special_ids = set(self.tokenizer.all_special_ids)
+        num_tokens = 0
+        for response_ids in responses_ids:
+            end = len(response_ids)
+            while end and response_ids[end - 1] in special_ids:
+                end -= 1
+            num_tokens += end
+        self.tracker.increment(f"num_generated_tokens_{self.role}", num_tokens)
+
+    def format_response(self, turn_response: str) -> Tuple[str, str]:
+        # ----------------------------------- prevent potential self-reply -----------------------------------
+        for self_reply_token in self.SELF_REPLY_TOKENS.values():
+            if self_reply_token in turn_response:
+                turn_response = turn_response.split(self_reply_token)[0]
+                self.tracker.increment("num_self_replies")
+
+        turn_response = turn_response.lstrip()
+        model_output_template = self.templates["model_output"].render(model_answer=turn_response)
+        return turn_response, model_output_template
+
     def extract_prompt(self, prompt: str) -> str:
         if '"' in prompt:
-            prompts = re.findall(r'"((?:.|[\n\t\r\b\\"])*?)"', prompt)
+            prompts = PROMPT_PATTERN.findall(prompt)
             if len(prompts) > 1:
-                self.aim_run["num_multiple_prompts"] += 1
+                self.tracker.increment("num_multiple_prompts")
                 logging.warning(f"More than one ({len(prompts)}) prompt detected!")
                 return prompts[self.conv_template.idx_of_possible_prompt], len(prompts)
             elif prompts == []:
@@ -52,52 +604,62 @@ class Model:
             logging.warning("No prompt detected!")
             return None, 0
 
+    def has_prompt(self, text: str) -> bool:
+        # whether extract_prompt finds a prompt in the text, without counting nor logging anything
+        return PROMPT_PATTERN.search(text) is not None
+
     def stop_dialog(self, prompt):
+        words = re.split(r"\s+|\n", prompt.strip())
+        return self.is_stop_word(words[0]) or self.is_stop_word(words[-1])
+
+    def is_stop_word(self, word: str) -> bool:
         translator = str.maketrans("", "", string.punctuation)
-        prompt_first_token = (
-            re.split(r"\s+|\n", prompt.strip())[0].strip().translate(translator).strip()
-        )
-        prompt_last_token = (
-            re.split(r"\s+|\n", prompt.strip())[-1]
-            .strip()
-            .translate(translator)
-            .strip()
-        )
-        if (
-            self.spec_tokens.conv_stop_token == prompt_first_token
-            or self.spec_tokens.conv_stop_token == prompt_last_token
-            or self.spec_tokens.conv_stop_token.capitalize() == prompt_first_token
-            or self.spec_tokens.conv_stop_token.capitalize() == prompt_last_token
-        ):
-            return True
-        return False
+        word = word.strip().translate(translator).strip()
+        return word in (self.spec_tokens.conv_stop_token, self.spec_tokens.conv_stop_token.capitalize())
 
     def is_non_coherent(self, text):
         """
         max_n: from 2-grams to max_n-grams
         r: number of consecutive repititions
         """
-        words = text.split()
-        for n in range(2, self.cfg.non_coherent_max_n + 1):
-            n_grams = []
-            for i in range(len(words)):
-                n_gram = tuple(words[i : i + n])
-                if n_grams and len(n_grams) >= max(self.cfg.non_coherent_r, n):
-                    if n_grams[-1] == n_gram or n_grams[-n] == n_gram:
-                        last_rs = n_grams[-self.cfg.non_coherent_r :]
-                        if (
-                            len(last_rs) == self.cfg.non_coherent_r
-                            and len(set(last_rs)) == 1
-                        ):
-                            return True
-                        last_rs = n_grams[-n::-n][: self.cfg.non_coherent_r]
-                        if (
-                            len(last_rs) == self.cfg.non_coherent_r
-                            and len(set(last_rs)) == 1
-                        ):
-                            return True
-                n_grams.append(n_gram)
-        return False
+        return has_repetition(text.split(), self.cfg.non_coherent_max_n, self.cfg.non_coherent_r)
+
+    def get_repetition_detector(self) -> RepetitionDetector:
+        # can also be fed the words of a response while it is being generated
+        return RepetitionDetector(self.cfg.non_coherent_max_n, self.cfg.non_coherent_r)
+
+    def get_stopping_criteria(
+        self, prompt_length: int, generate_cfg, generation_timer: Optional["GenerationTimer"] = None
+    ) -> Optional["StoppingCriteriaList"]:
+        """
+        Returns the criteria that stop the sequences of a generate call, whose prompts are prompt_length tokens long,
+        once their response is settled. Beam search reorders the sequences at every step, it's left to run to the end.
+        The generation timer of the call, if it's timed, is added as well.
+        """
+        from transformers import StoppingCriteriaList
+
+        from llm_roleplay.common.stopping import DialogueStoppingCriteria
+
+        criteria = [generation_timer] if generation_timer is not None else []
+        stop_early = self.cfg.get("stop_early", True)
+        # only the quoted prompt is taken from the inquirer's response, it can stop once that prompt is complete
+        prompt_idx = None
+        if self.role == "model_inquirer" and self.cfg.get("stream_prompt", False):
+            prompt_idx = self.conv_template.get("idx_of_possible_prompt", 0)
+            # a prompt counted from the end, e.g. -1 for the last one, is only known once the response is complete
+            if prompt_idx < 0:
+                prompt_idx = None
+        if (stop_early or prompt_idx is not None) and generate_cfg.get("num_beams", 1) in (None, 1):
+            criteria.append(
+                DialogueStoppingCriteria(
+                    self,
+                    prompt_length,
+                    max_new_tokens=generate_cfg.get("max_new_tokens"),
+                    stop_early=stop_early,
+                    prompt_idx=prompt_idx,
+                )
+            )
+        return StoppingCriteriaList(criteria) if criteria else None
 
     def get_generation_cfg(self) -> Dict[str, Any]:
         generation_cfg = copy.deepcopy(self.cfg.generate)
@@ -110,16 +672,52 @@ class Model:
 
         return generation_cfg
 
+    def get_candidates_cfg(self) -> Dict[str, Any]:
+        # the candidates are sampled plainly, beam and contrastive search would multiply the cost of every candidate
+        generation_cfg = copy.deepcopy(self.cfg.generate)
+
+        generation_cfg["do_sample"] = True
+        generation_cfg["temperature"] = random.uniform(0.5, 1)
+        generation_cfg.pop("num_beams", None)
+        generation_cfg.pop("penalty_alpha", None)
+
+        return generation_cfg
+
     @staticmethod
-    def collate_tokenize(data, tokenizer, input_key):
+    def collate_tokenize(data, tokenizer, input_key, device=None):
         input_batch = []
         for element in data:
-            if isinstance(element[input_key], list):
+            if isinstance(element[input_key], list) and element[input_key] and isinstance(element[input_key][0], int):
+                # already tokenized, only needs to be padded
+                input_text = element[input_key]
+            elif isinstance(element[input_key], list):
                 input_text = " ".join(element[input_key])
             else:
                 input_text = element[input_key]
             input_batch.append(input_text)
-        tokenized = tokenizer(
-            input_batch, padding="longest", truncation=True, return_tensors="pt"
-        ).to(Device.get_device())
-        return tokenized
+        if input_batch and not isinstance(input_batch[0], str):
+            tokenized = tokenizer.pad({"input_ids": input_batch}, padding="longest", return_tensors="pt")
+        else:
+            tokenized = tokenizer(input_batch, padding="longest", truncation=True, return_tensors="pt")
+        return tokenized.to(device if device is not None else Device.get_device())
+
+    @staticmethod
+    def generate_padded(model, tokenizer, model_prompts: List[Any], generate_cfg, stopping_criteria=None):
+        """
+        Runs a single generate call over the left-padded batch of prompts (texts or token ids) and returns only the
+        newly generated tokens of every sequence, as with left padding all prompts end at the same position.
+        """
+        prompt_tokenized = Model.collate_tokenize(
+            [{"input": model_prompt} for model_prompt in model_prompts],
+            tokenizer,
+            input_key="input",
+            device=model.device,
+        )
+        generate_kwargs = dict(generate_cfg)
+        generate_kwargs.setdefault("pad_token_id", tokenizer.pad_token_id)
+        if stopping_criteria is not None:
+            generate_kwargs["stopping_criteria"] = stopping_criteria
+
+        output_tokenized = model.generate(**prompt_tokenized, **generate_kwargs)
+
+        return output_tokenized[:, prompt_tokenized["input_ids"].shape[1] :]
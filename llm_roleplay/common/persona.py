@@ -1,38 +1,138 @@
 import hashlib
-import random
-from typing import Dict, List, Tuple
+import json
+import logging
+import math
+from typing import Dict, Iterable, List, Mapping, Sequence, Tuple
+
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+
+from llm_roleplay.common.template import PLACEHOLDER_PATTERN, Template
+
+
+class Personas(Sequence):
+    """
+    The (persona, persona hash) pairs of a run, indexed by persona index. A persona is only rendered when it's
+    accessed, so that a run of millions of sampled personas holds no more than their features in memory.
+    """
+
+    def __init__(self, template: Template, features: Sequence[Mapping[str, str]]):
+        self.template = template
+        self.features = features
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def __getitem__(self, idx: int) -> Tuple[str, str]:
+        features = self.features[idx]
+        return self.template.render(**features), Persona.get_hash(features)
+
+
+class FeatureCombinations(Sequence):
+    """
+    The features of sampled personas, each kept as the index of its combination of feature values in the product of
+    the feature value lists, with the features in the given order, e.g. with ages [18, 25] and genders [f, m, n] the
+    combination index 4 is age 25 and gender m.
+    """
+
+    def __init__(self, values: Dict[str, List[str]], order: List[str], combination_idxs: np.ndarray):
+        self.values = values
+        self.order = order
+        self.shape = [len(values[feature_name]) for feature_name in order]
+        self.combination_idxs = combination_idxs
+
+    def __len__(self) -> int:
+        return len(self.combination_idxs)
+
+    def __getitem__(self, idx: int) -> Dict[str, str]:
+        value_idxs = dict(zip(self.order, np.unravel_index(self.combination_idxs[idx], self.shape)))
+        return {feature_name: values[value_idxs[feature_name]] for feature_name, values in self.values.items()}
 
 
 class Persona:
     @staticmethod
-    def get_personas(cfg) -> List[Tuple[str, Dict[str, str]]]:
+    def get_personas(cfg, seed=None) -> Personas:
         if "fixed" in cfg:
-            personas: List[Tuple[str, Dict[str, str]]] = []
+            template = Persona.get_template(
+                cfg.prompt, {feature_name for person in cfg.fixed for feature_name in person["person"].keys()}
+            )
+            # a persona listed several times would only repeat its dialogues, it's kept once
+            features = {}
             for person in cfg.fixed:
-                persona = cfg.prompt
-                features = person["person"]
+                person_features = Persona.to_dict(person["person"])
+                missing = set(template.names) - set(person_features.keys())
+                if missing:
+                    raise ValueError(f"persona {person_features} has no {sorted(missing)} for the persona prompt")
+                features.setdefault(Persona.get_hash(person_features), person_features)
+            if len(features) < len(cfg.fixed):
+                logging.warning(f"Skipping {len(cfg.fixed) - len(features)} personas listed more than once")
+            return Personas(template, list(features.values()))
+        else:
+            return Persona.generate_personas(cfg, seed)
 
-                for feature_name in features.keys():
-                    persona = persona.replace(
-                        f"<{feature_name.upper()}>", features[feature_name]
-                    )
+    @staticmethod
+    def generate_personas(cfg, seed=None) -> Personas:
+        """
+        Samples num_personas distinct combinations of the feature values, without replacement. With
+        sampling: stratified, they're spread evenly across the combinations of the stratify_by features, e.g. as many
+        personas of every gender and education. The same seed samples the same personas, so that resuming a run or
+        its workers take the same ones.
+        """
+        template = Persona.get_template(cfg.prompt, cfg.features.keys())
+        # a value listed twice would be sampled as two combinations of the same persona
+        values = {feature_name: list(dict.fromkeys(cfg.features[feature_name])) for feature_name in cfg.features}
 
-                persona_hash = hashlib.md5(str(features).encode()).hexdigest()
-                personas.append((persona, persona_hash))
-            return personas
+        sampling = cfg.get("sampling", "random")
+        if sampling == "random":
+            strata = []
+        elif sampling == "stratified":
+            strata = list(cfg.get("stratify_by") or [])
+            unknown = set(strata) - set(values)
+            if not strata or unknown:
+                raise ValueError(f"stratify_by should name some of the features {list(values)}, got {strata}")
         else:
-            return Persona.generate_personas(cfg)
+            raise ValueError(f"unknown persona sampling: {sampling}")
+
+        # the combinations of a stratum are contiguous, as the stratify_by features vary slowest
+        order = strata + [feature_name for feature_name in values if feature_name not in strata]
+        num_strata = math.prod(len(values[feature_name]) for feature_name in strata)
+        stratum_size = math.prod(len(values[feature_name]) for feature_name in order[len(strata) :])
+
+        num_personas = cfg.num_personas
+        if num_personas > num_strata * stratum_size:
+            logging.warning(
+                f"Only {num_strata * stratum_size} distinct personas can be sampled, not {num_personas}, taking all"
+            )
+            num_personas = num_strata * stratum_size
+
+        rng = np.random.default_rng(seed)
+        # the personas that don't divide evenly go to randomly chosen strata, at most one more to each
+        stratum_counts = np.full(num_strata, num_personas // num_strata)
+        stratum_counts[rng.choice(num_strata, num_personas % num_strata, replace=False)] += 1
+        combination_idxs = np.concatenate(
+            [
+                stratum_idx * stratum_size + rng.choice(stratum_size, count, replace=False)
+                for stratum_idx, count in enumerate(stratum_counts)
+            ]
+        )
+        # the strata are interleaved, so that any part of the run covers all of them
+        rng.shuffle(combination_idxs)
+        return Personas(template, FeatureCombinations(values, order, combination_idxs))
+
+    @staticmethod
+    def get_hash(features: Mapping[str, str]) -> str:
+        # the same features have the same hash whatever the order they're listed in
+        return hashlib.md5(json.dumps(Persona.to_dict(features), sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def to_dict(features: Mapping[str, str]) -> Dict[str, str]:
+        if isinstance(features, DictConfig):
+            return OmegaConf.to_container(features, resolve=True)
+        return dict(features)
 
     @staticmethod
-    def generate_personas(cfg) -> List[Tuple[str, Dict[str, str]]]:
-        personas: List[Tuple[str, Dict[str, str]]] = []
-        for _ in range(cfg.num_personas):
-            persona = cfg.prompt
-            chosen_features = {}
-            for feature_name in cfg.features.keys():
-                feature = random.choice(cfg.features[feature_name])
-                persona = persona.replace(f"<{feature_name.upper()}>", feature)
-                chosen_features[feature_name] = feature
-            persona_hash = hashlib.md5(str(chosen_features).encode()).hexdigest()
-            personas.append((persona, persona_hash))
-        return personas
+    def get_template(prompt: str, feature_names: Iterable[str]) -> Template:
+        # the feature <NAME> of the prompt is filled with the value of name, every placeholder must be a feature
+        placeholders = {feature_name: f"<{feature_name.upper()}>" for feature_name in feature_names}
+        Template.validate(prompt, PLACEHOLDER_PATTERN.findall(prompt), placeholders.values(), "persona prompt")
+        return Template(prompt, placeholders)
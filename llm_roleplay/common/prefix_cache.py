@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+
+class PrefixCache:
+    """
+    Key/value states of token prefixes shared between dialogues, e.g. the head of the inquirer's first-turn template
+    followed by the same persona, which would otherwise be prefilled again for every dialogue.
+
+    The states are stored in blocks of block_size tokens, keyed by the hash of the prefix before the block and the
+    block's tokens, so prompts that share a prefix share its blocks. Least recently used blocks are evicted once they
+    take more than max_memory_mb.
+    """
+
+    def __init__(self, max_memory_mb: float = 1024, block_size: int = 16):
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.block_size = block_size
+        self.blocks: "OrderedDict[Tuple[Optional[int], Tuple[int, ...]], Tuple[Tuple[Any, Any], ...]]" = OrderedDict()
+        self.memory = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def _block_keys(self, token_ids: List[int]):
+        parent = None
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            key = (parent, tuple(token_ids[start : start + self.block_size]))
+            yield start, key
+            parent = hash(key)
+
+    def _touch(self, keys):
+        # children are touched before their parents, so that a prefix is never evicted before its continuations
+        for key in reversed(keys):
+            self.blocks.move_to_end(key)
+
+    def lookup(self, token_ids: List[int]):
+        """
+        Returns the number of leading tokens of token_ids whose key/value states are cached, and the states themselves
+        in the format generate accepts as past_key_values (None on a miss).
+        """
+        keys = []
+        for _, key in self._block_keys(token_ids):
+            if key not in self.blocks:
+                break
+            keys.append(key)
+
+        if not keys:
+            self.misses += 1
+            return 0, None
+
+        self._touch(keys)
+        self.hits += 1
+        num_tokens = len(keys) * self.block_size
+        self.hit_tokens += num_tokens
+
+        blocks = [self.blocks[key] for key in keys]
+        return num_tokens, PrefixCache.from_layers(
+            [
+                (
+                    torch.cat([block[layer][0] for block in blocks], dim=-2),
+                    torch.cat([block[layer][1] for block in blocks], dim=-2),
+                )
+                for layer in range(len(blocks[0]))
+            ]
+        )
+
+    def insert(self, token_ids: List[int], past_key_values):
+        """
+        Stores the key/value states of the full blocks of token_ids, past_key_values has to cover at least these tokens.
+        """
+        past_key_values = PrefixCache.to_layers(past_key_values)
+        num_cached = past_key_values[0][0].shape[-2]
+
+        keys = []
+        for start, key in self._block_keys(token_ids[:num_cached]):
+            keys.append(key)
+            if key in self.blocks:
+                continue
+            # clone, so that the block doesn't keep the whole cache of the dialogue alive
+            block = tuple(
+                (
+                    key_states[:, :, start : start + self.block_size, :].clone(),
+                    value_states[:, :, start : start + self.block_size, :].clone(),
+                )
+                for key_states, value_states in past_key_values
+            )
+            self.blocks[key] = block
+            self.memory += sum(
+                states.numel() * states.element_size() for layer_states in block for states in layer_states
+            )
+        self._touch(keys)
+
+        while self.memory > self.max_memory and self.blocks:
+            _, block = self.blocks.popitem(last=False)
+            self.memory -= sum(
+                states.numel() * states.element_size() for layer_states in block for states in layer_states
+            )
+
+    @staticmethod
+    def to_layers(past_key_values) -> List[Tuple[Any, Any]]:
+        """
+        Returns the (key states, value states) of every layer of a cache returned by generate.
+        """
+        if hasattr(past_key_values, "layers"):
+            return [(layer.keys, layer.values) for layer in past_key_values.layers]
+        if hasattr(past_key_values, "to_legacy_cache"):
+            return list(past_key_values.to_legacy_cache())
+        return list(past_key_values)
+
+    @staticmethod
+    def from_layers(layers: List[Tuple[Any, Any]]):
+        """
+        Returns the (key states, value states) of every layer as a cache generate accepts as past_key_values, the
+        tuples themselves with a version of transformers that has no DynamicCache.
+        """
+        if DynamicCache is None:
+            return tuple(layers)
+        past_key_values = DynamicCache()
+        for layer_idx, (key_states, value_states) in enumerate(layers):
+            past_key_values.update(key_states, value_states, layer_idx)
+        return past_key_values
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "num_blocks": len(self.blocks),
+            "memory_mb": self.memory / (1024 * 1024),
+        }
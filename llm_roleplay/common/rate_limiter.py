@@ -0,0 +1,42 @@
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    Sliding one-minute window limit on the number of requests and the number of tokens sent to an endpoint.
+    Meant to be shared by the coroutines of a single event loop, a request waits until it fits into both limits.
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = deque()  # (timestamp, num_tokens) of the requests within the window
+        self.num_tokens = 0
+
+    def _prune(self, now: float):
+        while self.requests and now - self.requests[0][0] >= RateLimiter.WINDOW:
+            _, num_tokens = self.requests.popleft()
+            self.num_tokens -= num_tokens
+
+    def _fits(self, num_tokens: int) -> bool:
+        if self.requests_per_minute and len(self.requests) >= self.requests_per_minute:
+            return False
+        # a single request larger than the token limit is let through once the window is empty
+        if self.tokens_per_minute and self.requests and self.num_tokens + num_tokens > self.tokens_per_minute:
+            return False
+        return True
+
+    async def acquire(self, num_tokens: int = 0):
+        while True:
+            now = time.monotonic()
+            self._prune(now)
+            if self._fits(num_tokens):
+                self.requests.append((now, num_tokens))
+                self.num_tokens += num_tokens
+                return
+            await asyncio.sleep(max(RateLimiter.WINDOW - (now - self.requests[0][0]), 0.01))
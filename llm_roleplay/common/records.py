@@ -0,0 +1,254 @@
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import jsonlines
+
+from llm_roleplay.common.timing import Timer
+
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError as error:
+        raise ImportError("zstd compression of the records requires the 'zstandard' package") from error
+    return zstandard
+
+
+def _part_idx(path: Path, seed) -> Optional[int]:
+    match = re.match(rf"^{re.escape(str(seed))}(?:\.(\d+))?\.jsonl(\.gz|\.zst)?$", path.name)
+    if match is None:
+        return None
+    return int(match.group(1) or 0)
+
+
+def record_files(records_dir: Path, seed) -> List[Path]:
+    """
+    Returns the record files of the seed in the order they were written: {seed}.jsonl, then the rotated parts
+    {seed}.1.jsonl, {seed}.2.jsonl, ..., each optionally compressed (.gz, .zst).
+    """
+    parts = [(_part_idx(path, seed), path) for path in Path(records_dir).glob(f"{seed}.*")]
+    return [path for part_idx, path in sorted(part for part in parts if part[0] is not None)]
+
+
+def open_records(path: Path, mode: str = "rt"):
+    """
+    Opens a record file as text, with the compression given by its suffix.
+    """
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, mode, encoding="utf-8")
+    if path.suffix == ".zst":
+        zstandard = _import_zstd()
+        if "r" in mode:
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+            return io.TextIOWrapper(reader, encoding="utf-8")
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, mode.replace("t", "") + "b"))
+        return io.TextIOWrapper(writer, encoding="utf-8", write_through=True)
+    return open(path, mode, encoding="utf-8")
+
+
+def read_records(records_dir: Path, seed) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the dialogue records that were written to the records directory for the seed.
+    """
+    for path in record_files(records_dir, seed):
+        with open_records(path) as file:
+            try:
+                # a record cut off by a killed job is skipped, its dialogue runs again when resuming
+                for record in jsonlines.Reader(file).iter(skip_invalid=True):
+                    yield record
+            except Exception as error:
+                logging.warning(f"Stopped reading the truncated record file {path}: {error}")
+
+
+class RecordWriter:
+    """
+    Appends the dialogue records of a seed to its record files on a background thread, the generation loop only
+    puts finished records on a queue. Waiting records are written together and flushed to disk (flush and fsync)
+    once flush_every of them are pending or flush_interval seconds passed since the last flush. A file that reached
+    max_file_size_mb is rotated to a new part. Closing the writer drains the queue.
+    """
+
+    def __init__(
+        self,
+        records_dir: Path,
+        seed,
+        compression: Optional[str] = None,
+        max_file_size_mb: Optional[float] = None,
+        flush_every: int = 64,
+        flush_interval: float = 10.0,
+        timer: Optional[Timer] = None,
+    ):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"unknown records compression: {compression}")
+        if compression == "zstd":
+            _import_zstd()
+        self.records_dir = Path(records_dir)
+        self.seed = seed
+        os.makedirs(self.records_dir, exist_ok=True)
+        self.suffix = COMPRESSION_SUFFIXES[compression]
+        self.max_file_size = max_file_size_mb * 1024**2 if max_file_size_mb else None
+        self.flush_every = max(flush_every, 1)
+        self.flush_interval = flush_interval
+        self.timer = timer if timer is not None else Timer(enabled=False)
+
+        # a resumed run keeps appending to the last part, unless it was written with another compression
+        existing = record_files(self.records_dir, seed)
+        self.part_idx = 0
+        if existing:
+            self.part_idx = _part_idx(existing[-1], seed)
+            if not existing[-1].name.endswith(f".jsonl{self.suffix}"):
+                self.part_idx += 1
+
+        self.file = None
+        self.num_pending = 0
+        self.last_flush = time.monotonic()
+        self.error: Optional[BaseException] = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def path(self) -> Path:
+        name = f"{self.seed}.jsonl" if self.part_idx == 0 else f"{self.seed}.{self.part_idx}.jsonl"
+        return self.records_dir.joinpath(f"{name}{self.suffix}")
+
+    def write(self, record: Dict[str, Any]):
+        if self.error is not None:
+            raise RuntimeError("writing the records failed") from self.error
+        self.queue.put(record)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("writing the records failed") from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        try:
+            closing = False
+            while not closing:
+                timeout = max(self.flush_interval - (time.monotonic() - self.last_flush), 0.0)
+                try:
+                    records = [self.queue.get(timeout=timeout if self.num_pending else None)]
+                except queue.Empty:
+                    records = []
+                # take whatever else is already waiting, so that it's written in one go
+                while True:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in records:
+                    closing = True
+                    records = [record for record in records if record is not None]
+
+                for start in range(0, len(records), self.flush_every):
+                    self._write(records[start : start + self.flush_every])
+                    if self.num_pending >= self.flush_every:
+                        self._flush()
+                if self.num_pending and (closing or time.monotonic() - self.last_flush >= self.flush_interval):
+                    self._flush()
+        except BaseException as error:
+            logging.error(f"Writing the records to {self.path} failed: {error}")
+            self.error = error
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _write(self, records: List[Dict[str, Any]]):
+        if not records:
+            return
+        with self.timer.stage("record_write"):
+            if self.file is None:
+                self.file = open_records(self.path, "at")
+            self.file.write("".join(f"{json.dumps(record)}\n" for record in records))
+        self.num_pending += len(records)
+
+    def _flush(self):
+        with self.timer.stage("record_flush"):
+            self.file.flush()
+            if self.suffix == ".zst":
+                # end the frame, so that the records flushed so far can be read back even if the job is killed later
+                self.file.buffer.flush(_import_zstd().FLUSH_FRAME)
+            os.fsync(self.file.fileno())
+        self.num_pending = 0
+        self.last_flush = time.monotonic()
+
+        if self.max_file_size and os.path.getsize(self.path) >= self.max_file_size:
+            self.file.close()
+            self.file = None
+            self.part_idx += 1
+
+
+def merge_records(sources: List[Path], records_dir: Path, seed, key: Callable[[Dict[str, Any]], Any], **writer_kwargs):
+    """
+    Appends the records of the seed in the source directories to the records directory, sorted by key so that the
+    result doesn't depend on which source a record came from, then removes the merged source files.
+    The sources are only removed once the merged records are on disk, a merge that is interrupted repeats them.
+    """
+    paths = [path for source in sources for path in record_files(source, seed)]
+    if not paths:
+        return 0
+    records = sorted((record for source in sources for record in read_records(source, seed)), key=key)
+    with RecordWriter(records_dir, seed, **writer_kwargs) as record_writer:
+        for record in records:
+            record_writer.write(record)
+    for path in paths:
+        path.unlink()
+    return len(records)
+
+
+class Checkpoints:
+    """
+    Latest state of every dialogue that is still in progress, one file per (sample index, persona index) that is
+    replaced after every completed turn and removed once the dialogue is recorded. Resuming a run continues these
+    dialogues from their last completed turn.
+    """
+
+    def __init__(self, records_dir: Path, seed):
+        self.checkpoints_dir = Path(records_dir).joinpath("checkpoints", str(seed))
+        os.makedirs(self.checkpoints_dir, exist_ok=True)
+
+    def _path(self, key: Tuple[int, int]) -> Path:
+        sample_idx, persona_idx = key
+        return self.checkpoints_dir.joinpath(f"{sample_idx}_{persona_idx}.json")
+
+    def save(self, key: Tuple[int, int], state: Dict[str, Any]):
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        # replace atomically, so that a preempted job never leaves a half written checkpoint behind
+        os.replace(tmp_path, path)
+
+    def remove(self, key: Tuple[int, int]):
+        self._path(key).unlink(missing_ok=True)
+
+    def load_all(self) -> Dict[Tuple[int, int], Dict[str, Any]]:
+        checkpoints = {}
+        for path in self.checkpoints_dir.glob("*.json"):
+            with open(path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+            checkpoints[(state["sample_idx"], state["persona_idx"])] = state
+        return checkpoints
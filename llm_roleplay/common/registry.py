@@ -0,0 +1,67 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable
+
+
+class _Entry:
+    def __init__(self):
+        # resolved with the instance once it's loaded, the roles acquiring it meanwhile wait for it
+        self.instance: Future = Future()
+        self.refcount = 0
+
+
+class ModelRegistry:
+    """
+    Process-wide store of loaded weights and tokenizers, so that the inquirer and the responder share one instance
+    when they are configured with the same checkpoint (e.g. llama talking to llama) instead of loading it twice.
+    Instances are looked up by a key, e.g. (name, dtype, device, quantization) for a model, and are reference counted:
+    every acquire is paired with a release, and the instance is dropped once the last role released it.
+    Only what's immutable is shared, the histories and conv templates stay with the roles.
+    """
+
+    _lock = threading.Lock()
+    _entries: Dict[Hashable, _Entry] = {}
+
+    @classmethod
+    def acquire(cls, key: Hashable, load: Callable[[], Any]) -> Any:
+        """
+        Returns the instance registered under key, calling load to create it if there is none. Instances of different
+        keys are loaded concurrently, only the callers of the same key wait for its load.
+        """
+        with cls._lock:
+            entry = cls._entries.get(key)
+            loading = entry is None
+            if loading:
+                entry = cls._entries[key] = _Entry()
+            else:
+                logging.info(f"Sharing the already loaded {key}")
+            entry.refcount += 1
+
+        if loading:
+            try:
+                entry.instance.set_result(load())
+            except BaseException as e:
+                # the next acquire loads it again
+                with cls._lock:
+                    if cls._entries.get(key) is entry:
+                        del cls._entries[key]
+                entry.instance.set_exception(e)
+                raise
+        return entry.instance.result()
+
+    @classmethod
+    def release(cls, key: Hashable) -> None:
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount -= 1
+            if entry.refcount <= 0:
+                del cls._entries[key]
+
+    @classmethod
+    def refcount(cls, key: Hashable) -> int:
+        with cls._lock:
+            entry = cls._entries.get(key)
+            return entry.refcount if entry is not None else 0
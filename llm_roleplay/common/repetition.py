@@ -0,0 +1,119 @@
+import itertools
+import operator
+from collections import deque
+from typing import Iterable, List
+
+
+def has_repetition(words: List[str], max_n: int, r: int) -> bool:
+    """
+    Gives the verdict of RepetitionDetector for a complete list of words. Instead of going word by word, the word
+    comparisons are made at C speed: equal neighbours and equal words n apart become byte strings, in which the runs
+    that can satisfy the conditions are found with bytes.find and checked with prefix sums.
+    """
+    num_words = len(words)
+    # same[k]: words k and k + 1 are equal
+    same = bytes(map(operator.eq, words, words[1:]))
+    same_prefix = [0, *itertools.accumulate(same)]
+
+    for n in range(2, max_n + 1):
+        if num_words < max(r, n) + n:
+            break
+        # period[j]: words j and j + n are equal
+        period = bytes(map(operator.eq, words, words[n:]))
+        period_prefix = None
+        window = b"\x01" * n
+
+        # g[i] == g[i - 1] starts a run of n equal neighbours at i - 1, g[i] == g[i - n] a run of n periods at i - n
+        for runs, offset in ((same, 1), (period, n)):
+            start = runs.find(window)
+            while start != -1:
+                i = start + offset
+                if max(r, n) <= i <= num_words - n:
+                    # g[i - r], ..., g[i - 1] are equal iff words i - r to i + n - 2 are
+                    if r == 1 or same_prefix[i + n - 2] - same_prefix[i - r] == r + n - 2:
+                        return True
+                    # g[i - n], ..., g[i - r * n] are equal iff word j equals word j + n for i - r * n <= j < i - n
+                    if i >= r * n:
+                        if period_prefix is None:
+                            period_prefix = [0, *itertools.accumulate(period)]
+                        if period_prefix[i - n] - period_prefix[i - r * n] == (r - 1) * n:
+                            return True
+                start = runs.find(window, start + 1)
+    return False
+
+
+class RepetitionDetector:
+    """
+    Detects the n-gram repetitions of Model.is_non_coherent (2 <= n <= max_n, r repetitions) with one pass over the
+    words, so that it can be fed the words of a response while it's being generated.
+
+    With g[i] the n-gram starting at word i, is_non_coherent flags a text if at some i >= max(r, n)
+    - g[i] repeats g[i - 1] or g[i - n], and
+    - g[i - r], ..., g[i - 1] are all equal, or i >= r * n and g[i - n], g[i - 2n], ..., g[i - r * n] are all equal.
+    All these n-grams are complete once word i + n - 1 is known, and instead of comparing them the detector counts
+    - the run of identical words, as consecutive n-grams are equal iff n + 1 words in a row are, and
+    - for every n, the run of words equal to the word n before them, as g[j] == g[j + n] iff the n words from j are.
+    This takes O(max_n) time per word. As a verdict never depends on the words after it, it's the same whether the
+    words are fed one by one or all at once, and it doesn't change once a repetition was detected.
+    """
+
+    def __init__(self, max_n: int, r: int):
+        self.max_n = max_n
+        self.r = r
+        self.num_words = 0
+        self.words = deque(maxlen=max_n + 1)
+        self.same_run = 0  # number of identical words ending at the last word
+        self.prev_same_run = 0
+        # for every n, the runs of words equal to the word n before them, ending at each of the last n + 1 positions
+        self.period_runs = {n: deque(maxlen=n + 1) for n in range(2, max_n + 1)}
+        self.partial_word = ""
+        self.detected = False
+
+    def add_word(self, word: str) -> bool:
+        if self.detected:
+            return True
+
+        self.prev_same_run = self.same_run
+        self.same_run = self.same_run + 1 if self.words and self.words[-1] == word else 1
+        self.words.append(word)
+        self.num_words += 1
+
+        for n, runs in self.period_runs.items():
+            if self.num_words <= n:
+                break
+            runs.append((runs[-1] if runs else 0) + 1 if self.words[-1 - n] == word else 0)
+
+            # g[i] is the n-gram that the last word completed
+            i = self.num_words - n
+            if i < max(self.r, n):
+                continue
+            if self.same_run >= n + 1 or runs[-1] >= n:
+                if self.r == 1 or self.prev_same_run >= self.r + n - 1:
+                    self.detected = True
+                    return True
+                if i >= self.r * n and runs[-1 - n] >= (self.r - 1) * n:
+                    self.detected = True
+                    return True
+        return False
+
+    def add_words(self, words: Iterable[str]) -> bool:
+        for word in words:
+            if self.add_word(word):
+                return True
+        return False
+
+    def add_text(self, text: str) -> bool:
+        """
+        Adds a piece of text, like the newly decoded part of a response. Its last word is held back until the
+        whitespace after it arrives, or until finish is called.
+        """
+        text = self.partial_word + text
+        words = text.split()
+        self.partial_word = words.pop() if words and not text[-1].isspace() else ""
+        return self.add_words(words)
+
+    def finish(self) -> bool:
+        if self.partial_word:
+            self.add_word(self.partial_word)
+            self.partial_word = ""
+        return self.detected
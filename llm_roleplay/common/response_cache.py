@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from omegaconf import DictConfig, ListConfig, OmegaConf
+
+
+class ResponseCache:
+    """
+    Stores the responses of deterministic generate calls on disk, so that rerunning a job (another seed of the sweep,
+    or after a crash) takes them from there instead of generating them again. A response is stored under the hash of
+    everything it's generated from, see get_key. Once the stored responses take more than max_size_mb, the least
+    recently used ones are evicted. The SQLite database can be shared by the worker processes of a sharded run.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 1024.0):
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 2**20)
+        self.lock = threading.Lock()
+        # autocommit, and the workers of a sharded run wait for each other's writes instead of failing
+        self.connection = sqlite3.connect(path, timeout=60.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        # the size of all responses is kept by triggers, so that a put doesn't sum the whole table. Unlike a count in
+        # this process, it stays right while the workers of a sharded run write to the same database. The responses of
+        # a database without it are summed once.
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS total_size (size INTEGER NOT NULL)")
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses "
+                "BEGIN UPDATE total_size SET size = size + new.size; END"
+            )
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses "
+                "BEGIN UPDATE total_size SET size = size + new.size - old.size; END"
+            )
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses "
+                "BEGIN UPDATE total_size SET size = size - old.size; END"
+            )
+            self.connection.execute(
+                "INSERT INTO total_size (size) SELECT COALESCE(SUM(size), 0) FROM responses "
+                "WHERE NOT EXISTS (SELECT 1 FROM total_size)"
+            )
+
+    @staticmethod
+    def get_key(*parts: Any) -> str:
+        """
+        Returns the key of a response generated from the parts, e.g. the role and config of the model, the
+        conversation and prompt as the model takes them and the generate config.
+        """
+        parts = [
+            OmegaConf.to_container(part, resolve=True) if isinstance(part, (DictConfig, ListConfig)) else part
+            for part in parts
+        ]
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        value = json.dumps(value)
+        with self.lock:
+            # an upsert, as the row a REPLACE deletes doesn't fire the delete trigger
+            self.connection.execute(
+                "INSERT INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE "
+                "SET value = excluded.value, size = excluded.size, last_used = excluded.last_used",
+                (key, value, len(value), time.time()),
+            )
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            num_entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            size = self._total_size()
+        return {"num_entries": num_entries, "size_mb": size / 2**20}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _total_size(self) -> int:
+        return self.connection.execute("SELECT size FROM total_size").fetchone()[0]
+
+    def _evict(self):
+        size = self._total_size()
+        if size <= self.max_size:
+            return
+
+        evicted = []
+        cursor = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used")
+        for key, entry_size in cursor:
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        cursor.close()
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
@@ -0,0 +1,130 @@
+import time
+from typing import List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+from llm_roleplay.common.repetition import RepetitionDetector
+from llm_roleplay.common.timing import Timer
+
+
+class _RowState:
+    def __init__(self, detector: RepetitionDetector):
+        self.detector = detector
+        self.token_ids: List[int] = []  # tokens not yet decoded into complete words
+        self.num_decoded = 0  # length of the text of token_ids that was already taken
+        self.text = ""  # end of the text of the complete words so far, long enough to hold a self-reply marker
+        self.first_word_checked = False
+        self.num_quotes = 0  # double quotes in the complete words so far
+        self.stopped = False
+
+
+class DialogueStoppingCriteria(StoppingCriteria):
+    """
+    Stops every sequence of a generate call as soon as the outcome of its response is settled, instead of decoding
+    up to max_new_tokens and throwing the rest away:
+    - a self-reply marker appeared, format_response cuts the response there
+    - the response of the inquirer starts with the conv stop token, stop_dialog ends the dialogue on it
+    - the response repeats itself, is_non_coherent flags it (see RepetitionDetector)
+    With prompt_idx, the response of the inquirer also stops once the quoted prompt that extract_prompt selects is
+    complete: the prompt_idx-th one from the start, after that many quotes were closed.
+    The new tokens are decoded word by word like transformers' TextStreamer, so only the current line is decoded.
+    """
+
+    def __init__(
+        self,
+        model,
+        prompt_length: int,
+        max_new_tokens: Optional[int] = None,
+        stop_early: bool = True,
+        prompt_idx: Optional[int] = None,
+    ):
+        self.model = model
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.stop_early = stop_early
+        if prompt_idx is not None and prompt_idx < 0:
+            raise ValueError(f"prompt_idx counts the prompts from the start, got {prompt_idx}")
+        # extract_prompt pairs the quotes in order, the prompt_idx-th prompt is complete with its closing quote
+        self.num_quotes = 2 * (prompt_idx + 1) if prompt_idx is not None else None
+        self.markers = list(model.SELF_REPLY_TOKENS.values()) if stop_early else []
+        self.window = max((len(marker) for marker in self.markers), default=1)
+        self.check_stop_word = stop_early and model.role == "model_inquirer"
+        self.num_seen = prompt_length
+        self.rows = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.rows is None:
+            self.rows = [_RowState(self.model.get_repetition_detector()) for _ in range(input_ids.shape[0])]
+
+        new_ids = input_ids[:, self.num_seen :].tolist()
+        self.num_seen = input_ids.shape[1]
+        for row, token_ids in zip(self.rows, new_ids):
+            if not row.stopped:
+                reason = self._update(row, token_ids)
+                if reason is not None:
+                    row.stopped = True
+                    self.model.tracker.increment(f"num_stopped_{reason}")
+                    if self.max_new_tokens:
+                        # at most, the sequence might have ended on its own before max_new_tokens
+                        self.model.tracker.increment(
+                            "num_tokens_saved", self.max_new_tokens - (self.num_seen - self.prompt_length)
+                        )
+        return torch.tensor([row.stopped for row in self.rows], dtype=torch.bool, device=input_ids.device)
+
+    def _update(self, row: _RowState, token_ids: List[int]) -> Optional[str]:
+        row.token_ids.extend(token_ids)
+        text = self.model.tokenizer.decode(row.token_ids, skip_special_tokens=True)
+        tail = text[row.num_decoded :]
+
+        if self.num_quotes is not None and row.num_quotes + tail.count('"') >= self.num_quotes:
+            return "prompt_closed"
+        if any(marker in row.text + tail for marker in self.markers):
+            return "self_reply"
+
+        # take the complete words, a line break completes the line and the next one is decoded on its own
+        if text.endswith("\n"):
+            words, row.token_ids, row.num_decoded = tail, [], 0
+        else:
+            words = tail[: tail.rfind(" ") + 1]
+            row.num_decoded += len(words)
+        if not words:
+            return None
+        row.text = (row.text + words)[-self.window :]
+        row.num_quotes += words.count('"')
+        if not self.stop_early:
+            return None
+
+        if self.check_stop_word and not row.first_word_checked and words.split():
+            row.first_word_checked = True
+            if self.model.is_stop_word(words.split()[0]):
+                return "conv_stop"
+        if row.detector.add_text(words):
+            return "non_coherent"
+        return None
+
+
+class GenerationTimer(StoppingCriteria):
+    """
+    Splits a generate call into prefill, up to the first generated token, and the decoding of the rest: generate
+    calls its stopping criteria once per generated token, and this one never stops a sequence.
+    """
+
+    def __init__(self, timer: Timer):
+        self.timer = timer
+        self.start = None
+        self.first_token = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.first_token is not None:
+            self.timer.add("decode", (time.perf_counter() - self.first_token) * 1e3)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            self.timer.add("prefill", (self.first_token - self.start) * 1e3)
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,72 @@
+import re
+from typing import Dict, Iterable, List, Mapping
+
+# how the placeholders of the conv templates and of the persona prompt look, e.g. <PERSONA> or <NATIVE_ENGLISH>
+PLACEHOLDER_PATTERN = re.compile(r"<[A-Z_]+>")
+
+
+class Template:
+    """
+    A text parsed once into its literal segments and the placeholders between them, so that rendering it is a single
+    join instead of one str.replace scan of the whole text per placeholder.
+        template = Template("You are <PERSONA>.", {"persona": "<PERSONA>"})
+        template.render(persona="a teacher")
+    Only the given placeholders are parsed, any other text, e.g. the <<SYS>> of llama's template, is taken literally.
+    The values are inserted as they are, placeholders within them are not rendered.
+    """
+
+    __slots__ = ("text", "segments", "names")
+
+    def __init__(self, text: str, placeholders: Mapping[str, str]):
+        self.text = text
+        self.segments: List[str] = []
+        self.names: List[str] = []
+
+        names = {placeholder: name for name, placeholder in placeholders.items()}
+        if names:
+            # the longest placeholders first, so that one that starts another is not matched within it
+            pattern = re.compile("|".join(map(re.escape, sorted(names, key=len, reverse=True))))
+            start = 0
+            for match in pattern.finditer(text):
+                self.segments.append(text[start : match.start()])
+                self.names.append(names[match.group()])
+                start = match.end()
+            self.segments.append(text[start:])
+        else:
+            self.segments.append(text)
+
+    def render(self, **values: str) -> str:
+        parts = [self.segments[0]]
+        for name, segment in zip(self.names, self.segments[1:]):
+            parts.append(values[name])
+            parts.append(segment)
+        return "".join(parts)
+
+    @staticmethod
+    def validate(text: str, known: Iterable[str], allowed: Iterable[str], description: str):
+        """
+        Raises a ValueError if the text has any of the known placeholders that it isn't rendered with, as it would
+        then end up in the text unfilled.
+        """
+        unfilled = set(PLACEHOLDER_PATTERN.findall(text)) & (set(known) - set(allowed))
+        if unfilled:
+            raise ValueError(f"{description} has the placeholders {sorted(unfilled)}, which are never filled in it")
+
+
+def compile_templates(
+    texts: Mapping[str, str], spec_tokens: Mapping[str, str], placeholders: Dict[str, Iterable[str]], description: str
+) -> Dict[str, Template]:
+    """
+    Parses the texts of the given names with the spec tokens each of them is rendered with, see Template. A spec token
+    that looks like a placeholder but isn't rendered in a text fails the validation.
+    """
+    known = [value for value in spec_tokens.values() if PLACEHOLDER_PATTERN.fullmatch(str(value))]
+    templates = {}
+    for name, keys in placeholders.items():
+        text = texts.get(name)
+        if not isinstance(text, str):
+            continue
+        keys = [key for key in keys if key in spec_tokens]
+        Template.validate(text, known, [spec_tokens[key] for key in keys], f"{description}.{name}")
+        templates[name] = Template(text, {key: spec_tokens[key] for key in keys})
+    return templates
@@ -0,0 +1,160 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+import torch
+
+# upper bounds of the histogram buckets in ms, the last bucket takes everything above them
+BUCKETS_MS = [bound * 10**exp for exp in range(-2, 5) for bound in (1, 2, 5)]
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.num = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.num += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket the quantile falls in
+        rank = q * self.num
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS_MS[idx] if idx < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.num,
+            "total_ms": self.total_ms,
+            "mean_ms": self.total_ms / self.num,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "max_ms": self.max_ms,
+            "histogram": {
+                (f"<={BUCKETS_MS[idx]:g}ms" if idx < len(BUCKETS_MS) else f">{BUCKETS_MS[-1]:g}ms"): count
+                for idx, count in enumerate(self.counts)
+                if count
+            },
+        }
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "dialogues", "start", "record_function")
+
+    def __init__(self, timer: "Timer", name: str, dialogues: Optional[Iterable[Any]]):
+        self.timer = timer
+        self.name = name
+        self.dialogues = dialogues
+        self.record_function = None
+
+    def __enter__(self):
+        if self.timer.profiler is not None:
+            # names the stage in the trace of a profiled turn
+            self.record_function = torch.profiler.record_function(self.name)
+            self.record_function.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed_ms = (time.perf_counter() - self.start) * 1e3
+        if self.record_function is not None:
+            self.record_function.__exit__(*exc_info)
+        self.timer.add(self.name, elapsed_ms, self.dialogues)
+
+
+class Timer:
+    """
+    Times the stages of the dialogue loop and of the model backends with
+        with timer.stage("extract_prompt", [dialogue]):
+            ...
+    Every stage gets a histogram of its durations, and the dialogues a stage ran for add its duration to their
+    timing, i.e. a batched stage counts fully for every dialogue of the batch. A disabled timer costs one call that
+    returns a shared no-op context.
+    With profile_every_n_turns, every n-th turn of the loop runs under torch.profiler, whose trace is written to
+    profile_dir and shows the stages by name.
+    """
+
+    _NO_STAGE = contextlib.nullcontext()
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        profile_every_n_turns: Optional[int] = None,
+        profile_dir: Optional[str] = None,
+    ):
+        self.enabled = enabled
+        self.profile_every_n_turns = profile_every_n_turns if enabled else None
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.histograms: Dict[str, _Histogram] = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+
+    def stage(self, name: str, dialogues: Optional[Iterable[Any]] = None):
+        if not self.enabled:
+            return Timer._NO_STAGE
+        return _Stage(self, name, dialogues)
+
+    def generation(self):
+        """
+        Returns a context to run a generate call in, whose criteria include the one it gives, see GenerationTimer.
+        """
+        if not self.enabled:
+            return Timer._NO_STAGE
+        # a stopping criteria of transformers, which is only imported by the backends that generate with it
+        from llm_roleplay.common.stopping import GenerationTimer
+
+        return GenerationTimer(self)
+
+    def add(self, name: str, elapsed_ms: float, dialogues: Optional[Iterable[Any]] = None):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _Histogram()
+            histogram.add(elapsed_ms)
+        for dialogue in dialogues or ():
+            dialogue.timing[name] = dialogue.timing.get(name, 0.0) + elapsed_ms
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in self.histograms.items()}
+
+    @contextlib.contextmanager
+    def profile(self, turn_idx: int):
+        """
+        Runs a turn of the loop under torch.profiler if it's one of the sampled turns.
+        """
+        if not self.profile_every_n_turns or turn_idx % self.profile_every_n_turns:
+            yield
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities) as profiler:
+            self.profiler = profiler
+            try:
+                yield
+            finally:
+                self.profiler = None
+        profile_dir = self.profile_dir or Path("profiles")
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        path = profile_dir.joinpath(f"turn_{turn_idx}.json")
+        profiler.export_chrome_trace(str(path))
+        logging.info(f"Profile of turn {turn_idx} written to {path}")
+
+    @staticmethod
+    def round_timing(timing: Dict[str, float]) -> Dict[str, float]:
+        return {name: round(elapsed_ms, 3) for name, elapsed_ms in timing.items()}
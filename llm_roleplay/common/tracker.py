@@ -0,0 +1,111 @@
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from aim import Run, Text
+
+from llm_roleplay.common.timing import Timer
+
+
+class Tracker:
+    """
+    Buffers what the dialogue loop reports to the aim run, so that generating a turn never waits for aim.
+    Counters and run parameters are kept in memory, texts are queued, and a background thread pushes them to the run
+    every flush_interval seconds and once more on close. The level sets what reaches the run:
+    - off: nothing, the counters are only logged on close
+    - counters: counters, run parameters and metrics
+    - full: counters, run parameters, metrics and texts
+    """
+
+    LEVELS = ("off", "counters", "full")
+
+    def __init__(self, aim_run: Optional[Run] = None, level: str = "full", flush_interval: float = 10.0):
+        if level not in Tracker.LEVELS:
+            raise ValueError(f"unknown tracking level: {level}, expected one of {Tracker.LEVELS}")
+        self.aim_run = aim_run
+        self.level = level if aim_run is not None else "off"
+        self.flush_interval = flush_interval
+
+        self.counters = Counter()
+        self.params: Dict[str, Any] = {}
+        self.texts = []
+        self.metrics = []
+        self.dirty = False
+        self.lock = threading.Lock()
+        # times the pushes to the run, set by the owner of the timer of the loop
+        self.timer = Timer(enabled=False)
+
+        self.closed = threading.Event()
+        self.thread = None
+        if self.level != "off":
+            self.thread = threading.Thread(target=self._run, name="tracker", daemon=True)
+            self.thread.start()
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+            self.dirty = True
+
+    def set(self, name: str, value: Any, key: Optional[str] = None):
+        """
+        Sets the run parameter name to value, or only its item key if given.
+        """
+        with self.lock:
+            if key is None:
+                self.params[name] = value
+            else:
+                self.params.setdefault(name, {})[key] = value
+            self.dirty = True
+
+    def track(self, text: str, name: str, context: Optional[Dict[str, Any]] = None):
+        if self.level == "full":
+            with self.lock:
+                self.texts.append((text, name, context))
+
+    def track_metric(self, value: Optional[float], name: str, context: Optional[Dict[str, Any]] = None):
+        # a missing measurement, e.g. of an accelerator that isn't there, is skipped
+        if self.level != "off" and value is not None:
+            with self.lock:
+                self.metrics.append((value, name, context))
+
+    def flush(self):
+        with self.lock:
+            texts, self.texts = self.texts, []
+            metrics, self.metrics = self.metrics, []
+            values = None
+            if self.dirty:
+                values = {**self.counters, **{name: Tracker._copy(value) for name, value in self.params.items()}}
+                self.dirty = False
+
+        if self.level == "off":
+            return
+        with self.timer.stage("tracking"):
+            if values is not None:
+                for name, value in values.items():
+                    self.aim_run[name] = value
+            for value, name, context in metrics:
+                self.aim_run.track(value, name=name, context=context)
+            for text, name, context in texts:
+                self.aim_run.track(Text(text), name=name, context=context)
+
+    def close(self):
+        if self.thread is not None:
+            self.closed.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.level == "off" and self.counters:
+            logging.info(f"Tracked counters: {dict(self.counters)}")
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                # losing a tracking update is not worth failing the generation for
+                logging.warning(f"Flushing the tracked values failed: {error}")
+
+    @staticmethod
+    def _copy(value):
+        return dict(value) if isinstance(value, dict) else value
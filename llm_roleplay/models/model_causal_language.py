@@ -1,11 +1,9 @@
 import random
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from urartu.common.device import Device
-from urartu.utils.dtype import eval_dtype
 
 from llm_roleplay.common.model import Model
+from llm_roleplay.common.prefix_cache import PrefixCache
 
 
 class ModelCausalLanguage(Model):
@@ -13,145 +11,154 @@ class ModelCausalLanguage(Model):
         "llama": "[INST",
         "vicuna": "### Human:",
     }
+    SUPPORTS_BATCHING = True
 
     def __init__(self, cfg, role) -> None:
         super().__init__(cfg, role)
         self._tokenizer = None
+        self.prefix_cache = PrefixCache(**cfg.prefix_cache) if cfg.get("prefix_cache") else None
 
     @property
     def model(self):
         if self._model is None:
-            self._model = AutoModelForCausalLM.from_pretrained(
-                self.cfg.name,
-                cache_dir=self.cfg.cache_dir,
-                device_map=Device.get_device(),
-                torch_dtype=eval_dtype(self.cfg.dtype),
-                token=self.cfg.api_token,
-            )
-
-            for param in self._model.parameters():
-                param.requires_grad = False
-            self._model.eval()
+            self._model = self.load_causal_lm()
         return self._model
 
     @property
     def tokenizer(self):
         if self._tokenizer is None:
-            self._tokenizer = AutoTokenizer.from_pretrained(self.cfg.name)
+            self._tokenizer = self.load_tokenizer()
         return self._tokenizer
 
-    def get_prompt(self, turn, response_msg=None, persona=None, instructions=None):
-        if self.role == "model_inquirer":
-            assert persona is not None, "persona cannot be None"
-            assert instructions is not None, "instructions cannot be None"
-
-            if turn == 0:
-                return (
-                    self.conv_template.first_turn_input.replace(
-                        self.spec_tokens.persona_placeholder, persona
-                    )
-                    .replace(
-                        self.spec_tokens.objective_placeholder,
-                        f"{instructions[0]}",
-                        # f"{instructions[0][0].lower()}{instructions[0][1:]} {sample['input']}",
-                    )
-                    .replace(
-                        self.spec_tokens.conv_stop_placeholder,
-                        self.spec_tokens.conv_stop_token,
-                    )
-                )
-            else:
-                assert response_msg is not None, "response_msg cannot be None"
-
-                if len(instructions) > 1 and turn < len(instructions):
-                    response_forwarding = (
-                        self.conv_template.mid_response_forwarding.replace(
-                            self.spec_tokens.next_prompt, instructions[turn]
-                        )
-                    )
-                else:
-                    response_forwarding = (
-                        self.conv_template.response_forwarding.replace(
-                            self.spec_tokens.next_prompt, ""
-                        )
-                    )
-
-                return self.conv_template.n_th_turn_input.replace(
-                    self.spec_tokens.user_msg,
-                    response_forwarding.replace(
-                        self.spec_tokens.response_placeholder, response_msg
-                    ).replace(
-                        self.spec_tokens.conv_stop_placeholder,
-                        self.spec_tokens.conv_stop_token,
-                    ),
-                )
-        elif self.role == "model_responder":
-            assert response_msg is not None, "response_msg cannot be None"
+    def release(self):
+        super().release()
+        self._tokenizer = None
 
-            if turn == 0:
-                return self.conv_template.first_turn_input.replace(
-                    self.spec_tokens.objective_placeholder,
-                    response_msg,
-                )
-            else:
-                return self.conv_template.n_th_turn_input.replace(
-                    self.spec_tokens.user_msg, response_msg
+    def generate(self, prompt: str, generate_cfg):
+        # an empty sampled response is sampled again at another temperature, at most empty_response_retries times
+        for num_retries in range(self.cfg.get("empty_response_retries", 3) + 1):
+            if num_retries:
+                self.tracker.increment("num_empty_retries")
+                generate_cfg = {**generate_cfg, "temperature": round(random.uniform(0.6, 1.0), 1)}
+            turn_response, model_output_template = self._generate(prompt, generate_cfg)
+            if turn_response or not self.does_sample(generate_cfg):
+                break
+        return turn_response, model_output_template
+
+    def _generate(self, prompt: str, generate_cfg):
+        history_ids, prompt_ids = self.get_input_ids(prompt)
+        input_ids = history_ids + prompt_ids
+
+        cache_key = self.get_cache_key(input_ids, generate_cfg)
+        response_ids = self.get_cached_response(cache_key)
+        if response_ids is None:
+            response_ids = self._generate_ids(input_ids, generate_cfg)
+            self.cache_response(cache_key, response_ids)
+        self.history.generation = (prompt, prompt_ids, response_ids)
+
+        with self.timer.stage("detokenize"):
+            turn_response = self.tokenizer.decode(response_ids, skip_special_tokens=True).strip()
+        return self.format_response(turn_response)
+
+    def _generate_ids(self, input_ids, generate_cfg):
+        history = self.history
+        # beam and contrastive search expand the cache per candidate, so it can't be reused for them
+        single_sequence = generate_cfg.get("num_beams", 1) in (None, 1) and not generate_cfg.get("penalty_alpha")
+        # assisted generation doesn't continue a cache passed to generate correctly, so with a draft model the whole
+        # conversation is prefilled on every turn
+        draft_model = self.get_draft_model(generate_cfg)
+        reuse_cache = self.cfg.get("kv_cache", True) and single_sequence and draft_model is None
+        past_key_values = self._get_past_key_values(input_ids) if reuse_cache else None
+
+        prompt_tokenized = torch.tensor([input_ids], device=self.model.device)
+        with torch.no_grad(), self.timer.generation() as generation_timer:
+            with self.count_forwards(self.model, draft_model) as num_forwards:
+                output = self.model.generate(
+                    prompt_tokenized,
+                    attention_mask=torch.ones_like(prompt_tokenized),
+                    past_key_values=past_key_values,
+                    return_dict_in_generate=True,
+                    stopping_criteria=self.get_stopping_criteria(len(input_ids), generate_cfg, generation_timer),
+                    assistant_model=draft_model,
+                    **generate_cfg,
                 )
+
+        response_ids = output.sequences[0][len(input_ids) :].tolist()
+        self.count_generated([response_ids])
+        self.count_drafted(num_forwards, len(response_ids))
+        if reuse_cache:
+            if self.prefix_cache is not None and not history:
+                self.prefix_cache.insert(input_ids, output.past_key_values)
+                self.tracker.set(f"prefix_cache_{self.role}", self.prefix_cache.stats())
+            history.past_key_values = output.past_key_values
+            num_cached = ModelCausalLanguage._cache_length(history.past_key_values)
+            history.cached_ids = (input_ids + response_ids)[:num_cached]
         else:
-            raise NotImplementedError(f"unknown role: {self.role}")
+            history.drop_cache()
+        return response_ids
+
+    def _get_past_key_values(self, input_ids):
+        """
+        Returns the key/value cache kept in the dialogue's history, cropped to the part of the conversation that didn't
+        change since it was computed, so that only the remaining tokens (usually just the new prompt) are prefilled.
+        E.g. update_history may store the prompt extracted from the output instead of the generated tokens.
+        """
+        history = self.history
+        if history.past_key_values is None:
+            # the first turn of a dialogue may start with a prefix that was already computed for another dialogue
+            if self.prefix_cache is not None and not history:
+                num_cached, past_key_values = self.prefix_cache.lookup(input_ids[:-1])
+                history.cached_ids = input_ids[:num_cached]
+                return past_key_values
+            return None
+
+        num_cached = len(history.cached_ids)
+        if input_ids[:num_cached] != history.cached_ids:
+            num_cached = next(
+                (
+                    idx
+                    for idx, (cached_id, input_id) in enumerate(zip(history.cached_ids, input_ids))
+                    if cached_id != input_id
+                ),
+                min(num_cached, len(input_ids)),
+            )
+        # generate needs at least one uncached input token to produce the next token's logits
+        num_cached = min(num_cached, len(input_ids) - 1)
+        if num_cached <= 0:
+            history.drop_cache()
+            return None
 
-    def generate(self, prompt: str, generate_cfg):
-        self.model.eval()
-        model_prompt = prompt
-        if self.history:
-            model_prompt = f'{"".join(self.history)}{prompt}'
-        prompt_tokenized = self.tokenizer.encode(model_prompt, return_tensors="pt").to(
-            self.model.device
-        )
-
-        with torch.no_grad():
-            output_tokenized = self.model.generate(prompt_tokenized, **generate_cfg)
-
-        output = self.tokenizer.decode(output_tokenized[0], skip_special_tokens=True)
-
-        output_o = (
-            output.replace(str(self.tokenizer.bos_token), "")
-            .replace(str(self.tokenizer.eos_token), "")
-            .strip()
-        )
-
-        model_prompt_o = (
-            model_prompt.replace(str(self.tokenizer.bos_token), "")
-            .replace(str(self.tokenizer.eos_token), "")
-            .strip()
-        )
-
-        turn_response = output_o.replace(model_prompt_o, "", 1)
-
-        # ----------------------------------- prevent potential self-reply -----------------------------------
-        for self_reply_token in ModelCausalLanguage.SELF_REPLY_TOKENS.values():
-            if self_reply_token in turn_response:
-                turn_response = turn_response.split(self_reply_token)[0]
-                self.aim_run["num_self_replies"] += 1
-
-        turn_response = turn_response.lstrip()
-        model_output_template = self.conv_template.model_output.replace(
-            self.spec_tokens.model_answer, turn_response
-        )
-
-        del output_tokenized
-
-        if not turn_response:
-            print(turn_response)
-            generate_cfg["temperature"] = round(random.uniform(0.6, 1.0), 1)
-            self.generate(prompt, generate_cfg)
+        history.cached_ids = history.cached_ids[:num_cached]
+        return ModelCausalLanguage._crop_cache(history.past_key_values, num_cached)
 
-        return turn_response, model_output_template
+    @staticmethod
+    def _cache_length(past_key_values) -> int:
+        if hasattr(past_key_values, "get_seq_length"):
+            return past_key_values.get_seq_length()
+        return past_key_values[0][0].shape[-2]
+
+    @staticmethod
+    def _crop_cache(past_key_values, length: int):
+        if hasattr(past_key_values, "crop"):
+            past_key_values.crop(length)
+            return past_key_values
+        return tuple((key[:, :, :length, :], value[:, :, :length, :]) for key, value in past_key_values)
+
+    def generate_batch(self, prompts, histories, generate_cfg):
+        if len(prompts) == 1:
+            return super().generate_batch(prompts, histories, generate_cfg)
+
+        return self.generate_ids_batch(self.model, prompts, histories, generate_cfg)
+
+    def generate_candidates(self, prompt, generate_cfg, num_candidates, accept):
+        return self.generate_candidates_ids(self.model, prompt, generate_cfg, num_candidates, accept)
 
     def update_history(self, prompt, output_extract):
         if self.role == "model_inquirer":
-            self.history.append(f'{prompt} "{output_extract}"')
+            message = f'{prompt} "{output_extract}"'
         elif self.role == "model_responder":
-            self.history.append(f"{prompt}{output_extract}")
+            message = f"{prompt}{output_extract}"
         else:
             raise NotImplementedError(f"unknown role: {self.role}")
+
+        self.history.append(message, token_ids=self.get_message_ids(prompt, message))
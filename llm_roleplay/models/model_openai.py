@@ -1,119 +1,195 @@
+import asyncio
+import functools
+import logging
+import random
+import threading
 from typing import Tuple, Union
 
+import openai
 import tiktoken
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from langchain_openai import AzureChatOpenAI
-from transformers import AutoModelForCausalLM
 
+from llm_roleplay.common.history import History
 from llm_roleplay.common.model import Model
+from llm_roleplay.common.rate_limiter import RateLimiter
 
 
 class ModelOpenAI(Model):
+    SUPPORTS_BATCHING = True
+    # the persona and the conv stop token go into the system prompt of the inquirer
+    TEMPLATE_PLACEHOLDERS = {
+        **Model.TEMPLATE_PLACEHOLDERS,
+        "model_inquirer": {
+            **Model.TEMPLATE_PLACEHOLDERS["model_inquirer"],
+            "system_prompt": ("persona_placeholder", "conv_stop_placeholder"),
+        },
+    }
+
     def __init__(self, cfg, role) -> None:
         super().__init__(cfg, role)
+        self._loop = None
+        self._semaphore = None
+        self._rate_limiter = None
 
     @property
-    def model(self) -> AutoModelForCausalLM:
+    def model(self) -> AzureChatOpenAI:
         if self._model is None:
+            # the default temperature of the client unless it's configured
+            sampling = {"temperature": self.cfg.temperature} if self.cfg.get("temperature") is not None else {}
             self._model = AzureChatOpenAI(
                 deployment_name=self.cfg.name,
                 openai_api_type=self.cfg.openai_api_type,
                 openai_api_version=self.cfg.openai_api_version,
                 azure_endpoint=self.cfg.azure_openai_endpoint,
                 openai_api_key=self.cfg.azure_openai_api_key,
+                # retries are handled by _request, with backoff shared across the concurrent requests
+                max_retries=0,
+                **sampling,
             )
         return self._model
 
-    def get_prompt(self, turn, response_msg, persona=None, instructions=None):
-        if self.role == "model_inquirer":
+    def warm_up(self):
+        # the client and the encoding that counts the tokens of the history, there is no tokenizer to load
+        try:
+            with self.timer.stage(f"warm_up_{self.role}"):
+                self.model
+                get_encoding("gpt-3.5-turbo")
+        except Exception as e:
+            logging.warning(f"Warming up {self.role} failed: {e}")
+
+    def is_deterministic(self, generate_cfg) -> bool:
+        # the generate config isn't sent with the requests, the responses only repeat at a configured temperature of 0
+        return self.cfg.get("temperature") == 0
+
+    def get_prompt(self, turn, response_msg=None, persona=None, instructions=None):
+        if self.role == "model_inquirer" and turn == 0:
             assert persona is not None, "persona cannot be None"
-            assert instructions is not None, "instructions cannot be None"
-
-            if turn == 0:
-                self.sys_prompt = self.conv_template.system_prompt.replace(
-                    self.spec_tokens.persona_placeholder, persona
-                ).replace(
-                    self.spec_tokens.conv_stop_placeholder,
-                    self.spec_tokens.conv_stop_token,
-                )
-                prompt = self.conv_template.first_turn_input.replace(
-                    self.spec_tokens.objective_placeholder,
-                    f"{instructions[0]}",
-                    # f"{instructions[0][0].lower()}{instructions[0][1:]} {sample['input']}",
-                )
+            self.sys_prompt = self.templates["system_prompt"].render(
+                persona_placeholder=persona,
+                conv_stop_placeholder=self.spec_tokens.conv_stop_token,
+            )
+            # keep the system prompt with the dialogue, several dialogues may be in flight at the same time
+            if not self.history:
+                self.history.append(SystemMessage(content=self.sys_prompt))
+        return super().get_prompt(turn, response_msg, persona=persona, instructions=instructions)
 
-                return prompt
-            else:
-                if len(instructions) > 1 and turn < len(instructions):
-                    response_forwarding = (
-                        self.conv_template.mid_response_forwarding.replace(
-                            self.spec_tokens.next_prompt, instructions[turn]
-                        )
-                    )
-                else:
-                    response_forwarding = (
-                        self.conv_template.response_forwarding.replace(
-                            self.spec_tokens.next_prompt, ""
-                        )
-                    )
-
-                return self.conv_template.n_th_turn_input.replace(
-                    self.spec_tokens.user_msg,
-                    response_forwarding.replace(
-                        self.spec_tokens.response_placeholder, response_msg
-                    ),
-                )
-        elif self.role == "model_responder":
-            if turn == 0:
-                return self.conv_template.first_turn_input.replace(
-                    self.spec_tokens.objective_placeholder,
-                    response_msg,
-                )
-            else:
-                return self.conv_template.n_th_turn_input.replace(
-                    self.spec_tokens.user_msg, response_msg
+    def generate(self, prompt: Union[str, Tuple[str, str]], generate_cfg):
+        return self._run(self._agenerate(self.history, prompt, generate_cfg))
+
+    def generate_batch(self, prompts, histories, generate_cfg):
+        async def generate_all():
+            return await asyncio.gather(
+                *(
+                    self._agenerate(history, prompt, generate_cfg)
+                    for prompt, history in zip(prompts, histories)
                 )
-        else:
-            raise NotImplementedError(f"unknown role: {self.role}")
+            )
 
-    def generate(self, prompt: Union[str, Tuple[str, str]], generate_cfg):
-        if not self.history:
-            self.history = [
-                SystemMessage(content=self.sys_prompt),
-                HumanMessage(content=prompt),
-            ]
-        else:
-            self.history.append(HumanMessage(content=prompt))
+        return self._run(generate_all())
 
-        num_history_words = sum(
-            [self._get_num_tokens(item.content) for item in self.history]
-        )
-        if generate_cfg.max_new_tokens + num_history_words > self.cfg.context_length:
-            delta = (
-                generate_cfg.max_new_tokens
-                + num_history_words
-                - self.cfg.context_length
+    def generate_candidates(self, prompt, generate_cfg, num_candidates, accept):
+        # the prompt is added to the history once, every candidate is another response to the same messages
+        async def generate_all():
+            with self.timer.stage("tokenize"):
+                num_tokens = self._add_prompt(self.history, prompt, generate_cfg)
+            for num_generated in range(1, num_candidates + 1):
+                turn_response, model_output_template = await self._arespond(self.history, num_tokens, generate_cfg)
+                if accept(turn_response):
+                    break
+            return turn_response, model_output_template, num_generated
+
+        return self._run(generate_all())
+
+    def _run(self, coroutine):
+        """
+        Runs the coroutine on the event loop of this model. The loop lives in a background thread for the whole run,
+        so the async client, the semaphore and the rate limiter are always used from the same loop.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, daemon=True).start()
+            self._semaphore = asyncio.Semaphore(self.cfg.get("concurrency", 8))
+            self._rate_limiter = RateLimiter(
+                requests_per_minute=self.cfg.get("requests_per_minute"),
+                tokens_per_minute=self.cfg.get("tokens_per_minute"),
             )
-            i = 1
-            while delta > 0:
-                len_human_utterance = self._get_num_tokens(self.history[i].content)
-                len_aiassistant_utterance = self._get_num_tokens(
-                    self.history[i + 1].content
-                )
-                delta -= len_human_utterance + len_aiassistant_utterance
-                i += 2
-            del self.history[1:i]
-        try:
-            turn_response = self.model(self.history)
-        except Exception as e:
-            print(e)
-            return None, None
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
 
-        model_output_template = self.conv_template.model_output.replace(
-            self.spec_tokens.model_answer, turn_response.content
-        )
+    def _add_prompt(self, history, prompt, generate_cfg) -> int:
+        if not history:
+            history.append(SystemMessage(content=self.sys_prompt))
+        history.append(HumanMessage(content=prompt))
+
+        # drop the oldest human/AI pairs after the system prompt until the response fits into the context
+        max_history_tokens = self.cfg.context_length - generate_cfg.max_new_tokens
+        while history.num_tokens > max_history_tokens and len(history) > 3:
+            history.evict_pair(start=1)
+        return history.num_tokens
+
+    async def _agenerate(self, history, prompt, generate_cfg):
+        with self.timer.stage("tokenize"):
+            num_tokens = self._add_prompt(history, prompt, generate_cfg)
+        return await self._arespond(history, num_tokens, generate_cfg)
+
+    async def _arespond(self, history, num_tokens: int, generate_cfg):
+        cache_key = self.get_cache_key(self.dump_history(history), generate_cfg)
+        content = self.get_cached_response(cache_key)
+        if content is None:
+            try:
+                turn_response = await self._request(list(history), num_tokens + generate_cfg.max_new_tokens)
+            except Exception as e:
+                logging.error(f"Request to {self.cfg.name} failed: {e}")
+                return None, None
+            content = turn_response.content
+            self.cache_response(cache_key, content)
+
+        model_output_template = self.templates["model_output"].render(model_answer=content)
+
+        return content, model_output_template
 
-        return turn_response.content, model_output_template
+    async def _request(self, messages, num_tokens: int):
+        """
+        Sends the messages once the concurrency and rate limits allow it, and retries rate limited (429), server side
+        (5xx) and connection errors with jittered exponential backoff.
+        """
+        max_retries = self.cfg.get("max_retries", 6)
+        backoff_base = self.cfg.get("backoff_base", 1.0)
+        backoff_max = self.cfg.get("backoff_max", 60.0)
+
+        async with self._semaphore:
+            for attempt in range(max_retries + 1):
+                with self.timer.stage("rate_limit"):
+                    await self._rate_limiter.acquire(num_tokens)
+                try:
+                    with self.timer.stage("request"):
+                        return await self.model.ainvoke(messages)
+                except Exception as e:
+                    if attempt == max_retries or not ModelOpenAI._is_retryable(e):
+                        raise
+                    delay = min(backoff_max, backoff_base * 2**attempt) * random.uniform(0.5, 1.0)
+                    retry_after = ModelOpenAI._get_retry_after(e)
+                    if retry_after is not None:
+                        delay = max(delay, retry_after)
+                    logging.warning(f"Request to {self.cfg.name} failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        status_code = getattr(error, "status_code", None)
+        return status_code is not None and (status_code == 429 or status_code >= 500)
+
+    @staticmethod
+    def _get_retry_after(error: Exception):
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
 
     def update_history(self, prompt, output_extract):
         if self.role == "model_inquirer":
@@ -123,7 +199,26 @@ class ModelOpenAI(Model):
         else:
             raise NotImplementedError(f"unknown role: {self.role}")
 
+    def dump_history(self, history: History):
+        return [{"type": message.type, "content": message.content} for message in history]
+
+    def load_history(self, messages) -> History:
+        message_types = {"system": SystemMessage, "human": HumanMessage, "ai": AIMessage}
+        return super().load_history(
+            [message_types[message["type"]](content=message["content"]) for message in messages]
+        )
+
+    def new_history(self) -> History:
+        # every message is counted once when it is added, the history keeps the running total
+        return History(count_tokens=lambda message: self._get_num_tokens(message.content))
+
     def _get_num_tokens(self, string: str, encoding_name: str = "gpt-3.5-turbo") -> int:
-        encoding = tiktoken.encoding_for_model(encoding_name)
+        encoding = get_encoding(encoding_name)
         num_tokens = len(encoding.encode(string))
         return num_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str):
+    # loading the encoding is far more expensive than encoding a message, so it's loaded once per process
+    return tiktoken.encoding_for_model(encoding_name)
@@ -1,4 +1,5 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+import torch
+from transformers import pipeline
 from urartu.common.device import Device
 from urartu.utils.dtype import eval_dtype
 
@@ -10,6 +11,7 @@ class ModelPipeline(Model):
         "llama": "[INST",
         "vicuna": "### Human:",
     }
+    SUPPORTS_BATCHING = True
 
     def __init__(self, cfg, role) -> None:
         super().__init__(cfg, role)
@@ -18,14 +20,8 @@ class ModelPipeline(Model):
     @property
     def model(self):
         if self._model is None:
-            clm_model = AutoModelForCausalLM.from_pretrained(
-                self.cfg.name,
-                cache_dir=self.cfg.cache_dir,
-                device_map=Device.get_device(),
-                torch_dtype=eval_dtype(self.cfg.dtype),
-                token=self.cfg.api_token,
-            )
-
+            # the pipeline is a light wrapper, only the weights it wraps are shared with the other role
+            clm_model = self.load_causal_lm()
             self._model = pipeline(
                 "text-generation",
                 model=clm_model,
@@ -39,105 +35,65 @@ class ModelPipeline(Model):
     @property
     def tokenizer(self):
         if self._tokenizer is None:
-            self._tokenizer = AutoTokenizer.from_pretrained(self.cfg.name)
+            self._tokenizer = self.load_tokenizer()
         return self._tokenizer
 
-    def get_prompt(self, turn, response_msg=None, persona=None, instructions=None):
-        if self.role == "model_inquirer":
-            assert persona is not None, "persona cannot be None"
-            assert instructions is not None, "instructions cannot be None"
-
-            if turn == 0:
-                return (
-                    self.conv_template.first_turn_input.replace(
-                        self.spec_tokens.persona_placeholder, persona
-                    )
-                    .replace(
-                        self.spec_tokens.objective_placeholder,
-                        f"{instructions[0]}",
-                        # f"{instructions[0][0].lower()}{instructions[0][1:]} {sample['input']}",
-                    )
-                    .replace(
-                        self.spec_tokens.conv_stop_placeholder,
-                        self.spec_tokens.conv_stop_token,
-                    )
-                )
-            else:
-                assert response_msg is not None, "response_msg cannot be None"
-
-                if len(instructions) > 1 and turn < len(instructions):
-                    response_forwarding = (
-                        self.conv_template.mid_response_forwarding.replace(
-                            self.spec_tokens.next_prompt, instructions[turn]
-                        )
-                    )
-                else:
-                    response_forwarding = (
-                        self.conv_template.response_forwarding.replace(
-                            self.spec_tokens.next_prompt, ""
-                        )
-                    )
-
-                return self.conv_template.n_th_turn_input.replace(
-                    self.spec_tokens.user_msg,
-                    response_forwarding.replace(
-                        self.spec_tokens.response_placeholder, response_msg
-                    ),
-                )
-        elif self.role == "model_responder":
-            assert response_msg is not None, "response_msg cannot be None"
-
-            if turn == 0:
-                return self.conv_template.first_turn_input.replace(
-                    self.spec_tokens.objective_placeholder,
-                    response_msg,
-                )
-            else:
-                return self.conv_template.n_th_turn_input.replace(
-                    self.spec_tokens.user_msg, response_msg
-                )
-        else:
-            raise NotImplementedError(f"unknown role: {self.role}")
+    def release(self):
+        super().release()
+        self._tokenizer = None
 
     def generate(self, prompt: str, generate_cfg):
-        model_prompt = prompt
-        if self.history:
-            model_prompt = f'{"".join(self.history)}{prompt}'
-
-        output = self.model(model_prompt, **generate_cfg)
-        output = output[0]["generated_text"]
-
-        output_o = (
-            output.replace(str(self.tokenizer.bos_token), "")
-            .replace(str(self.tokenizer.eos_token), "")
-            .strip()
-        )
-
-        model_prompt_o = (
-            model_prompt.replace(str(self.tokenizer.bos_token), "")
-            .replace(str(self.tokenizer.eos_token), "")
-            .strip()
-        )
+        # the text-generation pipeline only takes text, so generate with its underlying model to keep the history as
+        # token ids and to take the response by slicing off the prompt instead of replacing it in the decoded output
+        history_ids, prompt_ids = self.get_input_ids(prompt)
+        input_ids = history_ids + prompt_ids
+
+        cache_key = self.get_cache_key(input_ids, generate_cfg)
+        response_ids = self.get_cached_response(cache_key)
+        if response_ids is None:
+            response_ids = self._generate_ids(input_ids, generate_cfg)
+            self.cache_response(cache_key, response_ids)
+        self.history.generation = (prompt, prompt_ids, response_ids)
+
+        with self.timer.stage("detokenize"):
+            turn_response = self.tokenizer.decode(response_ids, skip_special_tokens=True).strip()
+        return self.format_response(turn_response)
+
+    def _generate_ids(self, input_ids, generate_cfg):
+        causal_lm = self.model.model
+        draft_model = self.get_draft_model(generate_cfg)
+        prompt_tokenized = torch.tensor([input_ids], device=causal_lm.device)
+        with torch.no_grad(), self.timer.generation() as generation_timer:
+            with self.count_forwards(causal_lm, draft_model) as num_forwards:
+                output_tokenized = causal_lm.generate(
+                    prompt_tokenized,
+                    attention_mask=torch.ones_like(prompt_tokenized),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    stopping_criteria=self.get_stopping_criteria(len(input_ids), generate_cfg, generation_timer),
+                    assistant_model=draft_model,
+                    **generate_cfg,
+                )
 
-        turn_response = output_o.replace(model_prompt_o, "", 1)
+        response_ids = output_tokenized[0][len(input_ids) :].tolist()
+        self.count_generated([response_ids])
+        self.count_drafted(num_forwards, len(response_ids))
+        return response_ids
 
-        # ----------------------------------- prevent potential self-reply -----------------------------------
-        for self_reply_token in ModelPipeline.SELF_REPLY_TOKENS.values():
-            if self_reply_token in turn_response:
-                turn_response = turn_response.split(self_reply_token)[0]
-                self.aim_run["num_self_replies"] += 1
+    def generate_batch(self, prompts, histories, generate_cfg):
+        if len(prompts) == 1:
+            return super().generate_batch(prompts, histories, generate_cfg)
 
-        turn_response = turn_response.lstrip()
-        model_output_template = self.conv_template.model_output.replace(
-            self.spec_tokens.model_answer, turn_response
-        )
+        return self.generate_ids_batch(self.model.model, prompts, histories, generate_cfg)
 
-        return turn_response, model_output_template
+    def generate_candidates(self, prompt, generate_cfg, num_candidates, accept):
+        return self.generate_candidates_ids(self.model.model, prompt, generate_cfg, num_candidates, accept)
 
     def update_history(self, prompt, output_extract):
         if self.role == "model_inquirer":
-            self.history.append(f'{prompt} "{output_extract}"')
+            message = f'{prompt} "{output_extract}"'
         elif self.role == "model_responder":
-            self.history.append(f"{prompt}{output_extract}")
+            message = f"{prompt}{output_extract}"
         else:
             raise NotImplementedError(f"unknown role: {self.role}")
+
+        self.history.append(message, token_ids=self.get_message_ids(prompt, message))
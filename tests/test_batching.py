@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+
+from urartu.common.device import Device
+
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from llm_roleplay.models.model_pipeline import ModelPipeline
+from tests.tiny_model import WORDS, create_tiny_model, create_word_tokenizer, get_model
+
+# dialogues of prompts of different lengths, so that the batch is left padded
+DIALOGUES = [
+    ["hello world how are you", "are you"],
+    ["hello", "how are you hello world"],
+    ["you are", "world"],
+]
+
+
+class TestBatching(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        create_tiny_model(cls.model_dir.name, create_word_tokenizer(WORDS + [f"word{idx}" for idx in range(58)]))
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def get_responses(self, model, batched):
+        generate_cfg = {"max_new_tokens": 8, "min_new_tokens": 8, "do_sample": False}
+        histories = [model.new_history() for _ in DIALOGUES]
+        responses = [[] for _ in DIALOGUES]
+        try:
+            for turn in range(len(DIALOGUES[0])):
+                prompts = [dialogue[turn] for dialogue in DIALOGUES]
+                if batched:
+                    outputs = model.generate_batch(prompts, histories, generate_cfg)
+                else:
+                    outputs = []
+                    for prompt, history in zip(prompts, histories):
+                        model.history = history
+                        outputs.append(model.generate(prompt, generate_cfg))
+                for prompt, history, (response, _), dialogue_responses in zip(prompts, histories, outputs, responses):
+                    model.history = history
+                    model.update_history(prompt, response)
+                    dialogue_responses.append(response)
+        finally:
+            model.release()
+        return responses
+
+    def test_greedy_output(self):
+        for model_cls in (ModelCausalLanguage, ModelPipeline):
+            expected = self.get_responses(get_model(self.model_dir.name, model_cls), batched=False)
+            self.assertEqual(
+                self.get_responses(get_model(self.model_dir.name, model_cls), batched=True),
+                expected,
+                f"The left padded batch of {model_cls.__name__} should give the responses of the dialogues one by one",
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from urartu.common.device import Device
+
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from llm_roleplay.models.model_pipeline import ModelPipeline
+from tests.tiny_model import WORDS, create_tiny_draft, create_tiny_model, create_word_tokenizer, get_model
+
+
+class TestDraft(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.models_dir = tempfile.TemporaryDirectory()
+        cls.model_dir = os.path.join(cls.models_dir.name, "model")
+        cls.draft_dir = os.path.join(cls.models_dir.name, "draft")
+        cls.copy_dir = os.path.join(cls.models_dir.name, "copy")
+        cls.other_dir = os.path.join(cls.models_dir.name, "other")
+
+        words = WORDS + [f"word{idx}" for idx in range(250)]
+        create_tiny_model(cls.model_dir, create_word_tokenizer(words))
+        # the same words in another order, so that the vocabularies differ
+        create_tiny_model(cls.other_dir, create_word_tokenizer(words[:1] + words[:0:-1]))
+        # the first layer of the model drafts for it, so that some of the drafted tokens are accepted
+        create_tiny_draft(cls.draft_dir, cls.model_dir)
+        shutil.copytree(cls.model_dir, cls.copy_dir)
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.models_dir.cleanup()
+
+    def get_model(self, draft_dir, model_cls=ModelCausalLanguage):
+        return get_model(self.model_dir, model_cls, draft_model={"name": draft_dir} if draft_dir else None)
+
+    def get_responses(self, model):
+        # the later turns continue the history of the first ones, which is where drafting could diverge
+        generate_cfg = {"max_new_tokens": 24, "min_new_tokens": 24, "do_sample": False}
+        responses = []
+        try:
+            for prompt in ("hello world how", "are you", "hello you", "how are"):
+                response, _ = model.generate(prompt, generate_cfg)
+                model.update_history(prompt, response)
+                responses.append(response)
+        finally:
+            model.release()
+        return responses
+
+    def test_greedy_output(self):
+        for model_cls in (ModelCausalLanguage, ModelPipeline):
+            expected = self.get_responses(self.get_model(None, model_cls))
+            model = self.get_model(self.draft_dir, model_cls)
+            self.assertEqual(
+                self.get_responses(model), expected, f"Drafting should keep the greedy output of {model_cls.__name__}"
+            )
+            self.assertGreater(model.tracker.counters["num_drafted_tokens_model_responder"], 0, "Nothing was drafted")
+            acceptance_rate = model.tracker.params["draft_acceptance_rate"]["model_responder"]
+            self.assertTrue(0 <= acceptance_rate <= 1, f"Acceptance rate out of range: {acceptance_rate}")
+
+    def test_acceptance_rate(self):
+        model = self.get_model(self.copy_dir)
+        self.get_responses(model)
+        self.assertEqual(
+            model.tracker.params["draft_acceptance_rate"]["model_responder"],
+            1.0,
+            "Every token drafted by the same weights should be accepted",
+        )
+
+    def test_other_tokenizer(self):
+        model = self.get_model(self.other_dir)
+        try:
+            with self.assertRaises(ValueError):
+                model.draft_model
+        finally:
+            model.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
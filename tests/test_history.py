@@ -0,0 +1,91 @@
+import unittest
+
+from omegaconf import OmegaConf
+
+from llm_roleplay.common.history import History
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+
+
+class WordTokenizer:
+    # one token per word, with a bos token for the start of the conversation
+    def encode(self, text, add_special_tokens=True):
+        return [0] * add_special_tokens + [len(word) for word in text.split()]
+
+
+class TestHistory(unittest.TestCase):
+    def test_list_behaviour(self):
+        history = History()
+        self.assertFalse(history, "A new history should be empty")
+
+        history.append("[INST] hi [/INST]")
+        history.append("hello")
+        self.assertEqual(len(history), 2, "History length does not match the number of appended messages")
+        self.assertEqual("".join(history), "[INST] hi [/INST]hello", "Joined history does not match the messages")
+
+        del history[0]
+        self.assertEqual(list(history), ["hello"], "Deleting a message did not remove it from the history")
+
+    def test_token_ids(self):
+        history = History()
+        history.append("first", token_ids=[1, 10, 11])
+        history.append("second", token_ids=[12])
+        self.assertEqual(history.token_ids, [1, 10, 11, 12], "Token ids should be the concatenated message ids")
+
+        del history[1]
+        self.assertEqual(history.token_ids, [1, 10, 11], "Deleting a message did not remove its token ids")
+
+        history.append("untokenized")
+        self.assertIsNone(history.token_ids, "Token ids should be dropped once a message is stored without them")
+
+    def test_token_count_and_eviction(self):
+        history = History(count_tokens=lambda message: len(message.split()))
+        history.extend(["system prompt", "first question", "first answer here", "second question", "second answer"])
+        self.assertEqual(history.num_tokens, 11, "Running token total does not match the messages")
+
+        num_evicted = history.evict_pair(start=1)
+        self.assertEqual(num_evicted, 5, "Evicted token count does not match the evicted pair")
+        self.assertEqual(history.num_tokens, 6, "Running token total was not updated on eviction")
+        self.assertEqual(
+            list(history),
+            ["system prompt", "second question", "second answer"],
+            "Eviction should drop the oldest pair after the pinned message",
+        )
+
+    def test_history_window(self):
+        cfg = OmegaConf.create(
+            {
+                "conv_template": {},
+                "history_window": {"max_tokens": 12, "low_watermark": 0.85},
+            }
+        )
+        model = ModelCausalLanguage(cfg, role="model_responder")
+        model._tokenizer = WordTokenizer()
+        model.history = model.new_history()
+        model.history.append("persona and objective", token_ids=WordTokenizer().encode("persona and objective"))
+        for turn in range(1, 4):
+            model.history.append(f"question {turn} answer {turn}")
+        self.assertEqual(model.history.num_tokens, 16, "Token counts of the messages should be kept")
+
+        history_ids, prompt_ids = model.get_input_ids("next question")
+        self.assertEqual(
+            list(model.history),
+            ["persona and objective", "question 3 answer 3"],
+            "Oldest turns should be evicted down to the low watermark, the first one stays pinned",
+        )
+        self.assertLessEqual(len(history_ids) + len(prompt_ids), 10, "Input should fit into the low watermark")
+        self.assertEqual(model.tracker.counters["num_turns_evicted"], 2, "Evicted turns were not counted")
+
+        model.get_input_ids("a much longer question than the budget of the window allows")
+        self.assertEqual(list(model.history), ["persona and objective"], "The first turn should never be evicted")
+
+    def test_drop_cache(self):
+        history = History()
+        history.past_key_values = object()
+        history.cached_ids = [1, 2, 3]
+        history.drop_cache()
+        self.assertIsNone(history.past_key_values, "Key/value cache was not dropped")
+        self.assertEqual(history.cached_ids, [], "Cached token ids were not dropped")
+
+
+if __name__ == "__main__":
+    unittest.main()
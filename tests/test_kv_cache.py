@@ -0,0 +1,72 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from urartu.common.device import Device
+
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from tests.tiny_model import WORDS, create_tiny_model, create_word_tokenizer, get_model
+
+
+class TestKVCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        create_tiny_model(cls.model_dir.name, create_word_tokenizer(WORDS + [f"word{idx}" for idx in range(58)]))
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def get_responses(self, kv_cache, extract=lambda response: response):
+        # the history stores the extract of every response, the later turns continue the cache of the earlier ones
+        model = get_model(self.model_dir.name, kv_cache=kv_cache)
+        generate_cfg = {"max_new_tokens": 8, "min_new_tokens": 8, "do_sample": False}
+        responses = []
+        try:
+            for prompt in ("hello world how", "are you", "hello you", "how are"):
+                response, _ = model.generate(prompt, generate_cfg)
+                model.update_history(prompt, extract(response))
+                responses.append(response)
+            self.assertEqual(
+                model.history.past_key_values is not None, kv_cache, "The cache should only be kept with kv_cache"
+            )
+        finally:
+            model.release()
+        return responses
+
+    def test_greedy_output(self):
+        self.assertEqual(
+            self.get_responses(kv_cache=True),
+            self.get_responses(kv_cache=False),
+            "Reusing the cache across turns should keep the greedy output",
+        )
+
+    def test_extract(self):
+        def extract(response):
+            return " ".join(response.split()[:3])
+
+        # (cached tokens, tokens kept) of every reuse of the cache
+        crops = []
+        crop_cache = ModelCausalLanguage._crop_cache
+
+        def record_crop(past_key_values, length):
+            crops.append((ModelCausalLanguage._cache_length(past_key_values), length))
+            return crop_cache(past_key_values, length)
+
+        with patch.object(ModelCausalLanguage, "_crop_cache", side_effect=record_crop):
+            responses = self.get_responses(kv_cache=True, extract=extract)
+        self.assertTrue(
+            any(length < num_cached for num_cached, length in crops),
+            f"The cache past the stored extract should be cropped: {crops}",
+        )
+        self.assertEqual(
+            responses,
+            self.get_responses(kv_cache=False, extract=extract),
+            "Cropping the cache to the stored extract should keep the greedy output",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
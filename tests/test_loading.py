@@ -0,0 +1,58 @@
+import tempfile
+import unittest
+
+import torch
+from omegaconf import OmegaConf
+from urartu.common.device import Device
+
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from tests.tiny_model import create_tiny_model
+
+
+class TestLoading(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        create_tiny_model(cls.model_dir.name, vocab_size=64, num_hidden_layers=1)
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def get_model(self, **loading):
+        cfg = OmegaConf.create(
+            {
+                "name": self.model_dir.name,
+                "cache_dir": None,
+                "dtype": "torch.float16",
+                "api_token": None,
+                "conv_template": {},
+                **loading,
+            }
+        )
+        return ModelCausalLanguage(cfg, role="model_inquirer")
+
+    def test_int8_dynamic(self):
+        model = self.get_model(quantization="int8_dynamic", low_cpu_mem_usage=True)
+        try:
+            causal_lm = model.model
+            self.assertEqual(
+                causal_lm.model.layers[0].mlp.down_proj.weight().dtype,
+                torch.qint8,
+                "Linear layers should be quantized to int8",
+            )
+            loading = model.tracker.params["model_loading"]["model_inquirer"]
+            self.assertEqual(loading["quantization"], "int8_dynamic", "Loading mode was not reported")
+            self.assertGreater(loading["seconds"], 0, "Load time was not reported")
+            self.assertGreater(loading["rss_mb"], 0, "Resident memory was not reported")
+        finally:
+            model.release()
+
+    def test_unknown_quantization(self):
+        with self.assertRaises(ValueError):
+            self.get_model(quantization="int3").model
+
+
+if __name__ == "__main__":
+    unittest.main()
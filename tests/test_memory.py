@@ -0,0 +1,43 @@
+import unittest
+from unittest.mock import patch
+
+from llm_roleplay.common.memory import MemoryManager
+
+
+class TestMemoryManager(unittest.TestCase):
+    def count_frees(self, num_turns, **kwargs):
+        memory_manager = MemoryManager(**kwargs)
+        with patch("torch.cuda.empty_cache") as mock_empty_cache:
+            for _ in range(num_turns):
+                memory_manager.step()
+        self.assertEqual(
+            memory_manager.tracker.counters["num_cache_frees"], mock_empty_cache.call_count, "Frees were not counted"
+        )
+        return mock_empty_cache.call_count
+
+    def test_policies(self):
+        self.assertEqual(self.count_frees(6), 6, "The cache should be freed every turn by default")
+        self.assertEqual(
+            self.count_frees(6, policy="every", every_n_turns=4), 1, "The cache should be freed every 4 turns"
+        )
+        self.assertEqual(self.count_frees(6, policy="never"), 0, "The cache should never be freed")
+        with patch("torch.cuda.is_available", return_value=False):
+            self.assertEqual(
+                self.count_frees(6, policy="threshold", threshold_mb=0), 0, "Nothing is reserved without an accelerator"
+            )
+        with self.assertRaises(ValueError):
+            MemoryManager(policy="threshold")
+
+    def test_peaks(self):
+        memory_manager = MemoryManager(policy="never")
+        stats = memory_manager.step()
+        self.assertGreater(stats["rss_peak_mb"], 0, "The peak RSS of the process should be measured")
+
+        peaks = MemoryManager.merge_peaks({}, {"rss_mb": 10.0, "accelerator_peak_mb": None})
+        peaks = MemoryManager.merge_peaks(peaks, {"rss_mb": 8.0, "accelerator_peak_mb": 3.0})
+        self.assertEqual(peaks, {"rss_peak_mb": 10.0, "accelerator_peak_mb": 3.0}, "Peaks should be kept across turns")
+        self.assertEqual(memory_manager.tracker.params["memory"], memory_manager.peaks, "Run peaks were not set")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from omegaconf import OmegaConf
+
+from llm_roleplay.models.model_openai import ModelOpenAI
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Answers Azure OpenAI chat completion requests, rejecting the first `num_rate_limited` of them with 429.
+    """
+
+    lock = threading.Lock()
+    num_requests = 0
+    num_rate_limited = 0
+    in_flight = 0
+    max_in_flight = 0
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        cls = StubOpenAIHandler
+        with cls.lock:
+            cls.num_requests += 1
+            rate_limited = cls.num_requests <= cls.num_rate_limited
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(cls.latency)
+        with cls.lock:
+            cls.in_flight -= 1
+
+        if rate_limited:
+            body = {"error": {"code": "429", "message": "Rate limit is exceeded."}}
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+        else:
+            body = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": '"How fast did I run?"'},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+            self.send_response(200)
+        payload = json.dumps(body).encode()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestModelOpenAI(unittest.TestCase):
+    def setUp(self):
+        StubOpenAIHandler.num_requests = 0
+        StubOpenAIHandler.num_rate_limited = 0
+        StubOpenAIHandler.max_in_flight = 0
+        StubOpenAIHandler.latency = 0.0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        # tiktoken would download its encoding, a word is a token is enough for the stub server
+        num_tokens = patch.object(ModelOpenAI, "_get_num_tokens", lambda self, string, *args: len(string.split()))
+        num_tokens.start()
+        self.addCleanup(num_tokens.stop)
+
+        self.cfg = OmegaConf.create(
+            {
+                "name": "gpt-35-turbo",
+                "openai_api_type": "azure",
+                "openai_api_version": "2023-05-15",
+                "azure_openai_endpoint": f"http://127.0.0.1:{self.server.server_port}",
+                "azure_openai_api_key": "stub",
+                "context_length": 8192,
+                "concurrency": 4,
+                "max_retries": 3,
+                "backoff_base": 0.01,
+                "backoff_max": 0.05,
+                "generate": {"max_new_tokens": 100},
+                "conv_template": {"model_output": "<MODEL_ANSWER>"},
+            }
+        )
+        self.model = ModelOpenAI(self.cfg, role="model_responder")
+        self.model.spec_tokens = OmegaConf.create({"model_answer": "<MODEL_ANSWER>"})
+        self.model.sys_prompt = "You are a helpful assistant."
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retry_on_rate_limit(self):
+        StubOpenAIHandler.num_rate_limited = 2
+
+        turn_response, _ = self.model.generate("How fast did I run?", self.cfg.generate)
+
+        self.assertEqual(turn_response, '"How fast did I run?"', "Response of the stub server was not returned")
+        self.assertEqual(StubOpenAIHandler.num_requests, 3, "Rate limited requests were not retried")
+
+    def test_concurrent_batch(self):
+        StubOpenAIHandler.latency = 0.2
+        histories = [self.model.new_history() for _ in range(4)]
+
+        outputs = self.model.generate_batch(
+            prompts=[f"Question {idx}" for idx in range(len(histories))],
+            histories=histories,
+            generate_cfg=self.cfg.generate,
+        )
+
+        self.assertEqual(len(outputs), len(histories), "Every dialogue should get a response")
+        for turn_response, _ in outputs:
+            self.assertEqual(turn_response, '"How fast did I run?"', "Response of the stub server was not returned")
+        self.assertGreater(StubOpenAIHandler.max_in_flight, 1, "Requests of the batch were not sent concurrently")
+        for history in histories:
+            self.assertEqual(len(history), 2, "Every history should hold the system prompt and its own prompt")
+
+    def test_generate_candidates(self):
+        history = self.model.new_history()
+        self.model.history = history
+
+        turn_response, _, num_generated = self.model.generate_candidates(
+            "How fast did I run?", self.cfg.generate, num_candidates=4, accept=lambda candidate: False
+        )
+
+        self.assertEqual(turn_response, '"How fast did I run?"', "Response of the stub server was not returned")
+        self.assertEqual(num_generated, 4, "Every rejected candidate should be requested")
+        self.assertEqual(StubOpenAIHandler.num_requests, 4, "Every candidate should be its own request")
+        self.assertEqual([message.type for message in history], ["system", "human"], "The prompt should be added once")
+
+
+if __name__ == "__main__":
+    unittest.main()
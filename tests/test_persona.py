@@ -0,0 +1,89 @@
+import time
+import unittest
+from collections import Counter
+
+from omegaconf import OmegaConf
+
+from llm_roleplay.common.persona import Persona
+
+
+class TestPersona(unittest.TestCase):
+    def get_cfg(self, num_personas, **sampling):
+        return OmegaConf.create(
+            {
+                "num_personas": num_personas,
+                "prompt": "<AGE>-year-old <GENDER> with <EDUCATION>",
+                "features": {
+                    "age": [str(age) for age in range(18, 68)],
+                    "gender": ["woman", "man", "nonbinary person"],
+                    "education": ["a master's degree", "a doctoral degree"],
+                },
+                **sampling,
+            }
+        )
+
+    def test_fixed(self):
+        persona_cfg = OmegaConf.create(
+            {
+                "prompt": "<AGE>-year-old <GENDER>",
+                "fixed": [
+                    {"person": {"age": "30", "gender": "woman"}},
+                    {"person": {"age": "40", "gender": "man"}},
+                    {"person": {"gender": "woman", "age": "30"}},
+                ],
+            }
+        )
+        personas = Persona.get_personas(persona_cfg)
+        self.assertEqual(
+            [persona for persona, _ in personas],
+            ["30-year-old woman", "40-year-old man"],
+            "A persona listed twice, in any feature order, should be kept once",
+        )
+        self.assertEqual(
+            personas[0][1],
+            Persona.get_hash({"gender": "woman", "age": "30"}),
+            "The hash should not depend on the order of the features",
+        )
+
+    def test_random(self):
+        personas = Persona.get_personas(self.get_cfg(200), seed=0)
+        self.assertEqual(len(personas), 200, "Wrong number of personas")
+        self.assertEqual(
+            len({persona_hash for _, persona_hash in personas}), 200, "Sampled personas should be distinct"
+        )
+        self.assertEqual(
+            list(Persona.get_personas(self.get_cfg(200), seed=0)),
+            list(personas),
+            "The same seed should sample the same personas",
+        )
+        self.assertNotEqual(
+            list(Persona.get_personas(self.get_cfg(200), seed=1)), list(personas), "Another seed should sample others"
+        )
+        self.assertEqual(len(Persona.get_personas(self.get_cfg(1000), seed=0)), 300, "Only 300 personas are distinct")
+
+    def test_stratified(self):
+        personas = Persona.get_personas(self.get_cfg(100, sampling="stratified", stratify_by=["gender"]), seed=0)
+        self.assertEqual(
+            len({persona_hash for _, persona_hash in personas}), 100, "Sampled personas should be distinct"
+        )
+        genders = Counter(persona.split("-year-old ")[1].split(" with")[0] for persona, _ in personas)
+        self.assertEqual(sorted(genders.values()), [33, 33, 34], "Personas should be spread evenly across the genders")
+        with self.assertRaises(ValueError):
+            Persona.get_personas(self.get_cfg(100, sampling="stratified", stratify_by=["race"]))
+        with self.assertRaises(ValueError):
+            Persona.get_personas(self.get_cfg(100, sampling="systematic"))
+
+    def test_millions(self):
+        persona_cfg = self.get_cfg(2_000_000)
+        persona_cfg.prompt = "<AGE> <GENDER> <EDUCATION> <HOBBY> <CITY>"
+        persona_cfg.features.hobby = [f"hobby{idx}" for idx in range(1000)]
+        persona_cfg.features.city = [f"city{idx}" for idx in range(1000)]
+        start = time.perf_counter()
+        personas = Persona.get_personas(persona_cfg, seed=0)
+        self.assertEqual(len(personas), 2_000_000, "Wrong number of personas")
+        self.assertLess(time.perf_counter() - start, 10, "Sampling millions of personas should take seconds")
+        self.assertNotIn("<", personas[-1][0], "Persona was not rendered")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import tempfile
+import unittest
+
+import torch
+from urartu.common.device import Device
+
+from llm_roleplay.common.prefix_cache import PrefixCache
+from tests.tiny_model import WORDS, create_tiny_model, create_word_tokenizer, get_model
+
+
+def get_past_key_values(token_ids, num_layers=2):
+    # keys/values of shape (batch, heads, seq, dim) holding the token id, so that blocks can be told apart
+    states = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return tuple((states.clone(), states.clone()) for _ in range(num_layers))
+
+
+class TestPrefixCache(unittest.TestCase):
+    def test_shared_prefix_hit(self):
+        prefix_cache = PrefixCache(max_memory_mb=1, block_size=4)
+        first = list(range(100, 120))
+        second = list(range(100, 108)) + list(range(200, 212))
+
+        num_tokens, _ = prefix_cache.lookup(first)
+        self.assertEqual(num_tokens, 0, "Empty prefix cache should miss")
+        prefix_cache.insert(first, get_past_key_values(first))
+
+        num_tokens, past_key_values = prefix_cache.lookup(second)
+        self.assertEqual(num_tokens, 8, "Only the two shared blocks should be reused")
+        self.assertEqual(
+            PrefixCache.to_layers(past_key_values)[0][0].flatten().tolist(),
+            [float(token_id) for token_id in second[:8]],
+            "Reused key/value states do not belong to the shared prefix",
+        )
+        self.assertEqual(prefix_cache.stats()["hits"], 1, "Hit was not counted")
+        self.assertEqual(prefix_cache.stats()["misses"], 1, "Miss was not counted")
+
+    def test_lru_eviction_keeps_shared_prefix(self):
+        # every block takes 2 layers * (key + value) * 4 tokens * 4 bytes = 64 bytes, the budget fits 3 blocks
+        prefix_cache = PrefixCache(max_memory_mb=192 / (1024 * 1024), block_size=4)
+        first = list(range(100, 108))
+        second = list(range(100, 104)) + list(range(200, 208))
+
+        prefix_cache.insert(first, get_past_key_values(first))
+        prefix_cache.insert(second, get_past_key_values(second))
+
+        self.assertLessEqual(prefix_cache.memory, prefix_cache.max_memory, "Memory budget was exceeded")
+        num_tokens, _ = prefix_cache.lookup(second)
+        self.assertEqual(num_tokens, 12, "Recently used blocks were evicted")
+        num_tokens, _ = prefix_cache.lookup(first)
+        self.assertEqual(num_tokens, 4, "The shared prefix block should outlive the evicted continuation")
+
+
+class TestPrefixCacheGeneration(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        create_tiny_model(cls.model_dir.name, create_word_tokenizer(WORDS + [f"word{idx}" for idx in range(58)]))
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def get_responses(self, model):
+        # dialogues whose first prompts share their first blocks, of two turns each
+        generate_cfg = {"max_new_tokens": 8, "min_new_tokens": 8, "do_sample": False}
+        responses = []
+        try:
+            for first_prompt in ("hello world how are you hello", "hello world how are you world", "hello world how"):
+                model.history = model.new_history()
+                for prompt in (first_prompt, "are you"):
+                    response, _ = model.generate(prompt, generate_cfg)
+                    model.update_history(prompt, response)
+                    responses.append(response)
+        finally:
+            model.release()
+        return responses
+
+    def test_greedy_output(self):
+        expected = self.get_responses(get_model(self.model_dir.name))
+        model = get_model(self.model_dir.name, prefix_cache={"max_memory_mb": 1, "block_size": 2})
+        self.assertEqual(self.get_responses(model), expected, "Reusing a cached prefix should keep the greedy output")
+        stats = model.prefix_cache.stats()
+        self.assertEqual(stats["hits"], 2, "The later dialogues should reuse the prefix of the first one")
+        self.assertGreater(stats["hit_tokens"], 0, "No prefix tokens were reused")
+
+
+if __name__ == "__main__":
+    unittest.main()
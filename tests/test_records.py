@@ -0,0 +1,53 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from llm_roleplay.common.records import RecordWriter, read_records, record_files
+
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.records_dir = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_compression_and_rotation(self):
+        records = [{"sample_idx": idx, "dialog": [os.urandom(500).hex()]} for idx in range(50)]
+        with RecordWriter(self.records_dir, 42, compression="gzip", max_file_size_mb=0.001, flush_every=5) as writer:
+            for record in records:
+                writer.write(record)
+
+        files = record_files(self.records_dir, 42)
+        self.assertGreater(len(files), 1, "Records were not rotated to new files")
+        self.assertEqual(files[0].name, "42.jsonl.gz", "First record file should keep the seed name")
+        self.assertEqual(list(read_records(self.records_dir, 42)), records, "Read records do not match the written")
+
+    def test_resume_appends(self):
+        with RecordWriter(self.records_dir, 42) as writer:
+            writer.write({"sample_idx": 0})
+        # a record cut off by a killed job
+        with (self.records_dir / "42.jsonl").open("a", encoding="utf-8") as file:
+            file.write('{"sample_idx": \n')
+        with RecordWriter(self.records_dir, 42) as writer:
+            writer.write({"sample_idx": 1})
+
+        self.assertEqual(
+            [record["sample_idx"] for record in read_records(self.records_dir, 42)],
+            [0, 1],
+            "Resumed writer should append to the existing records, skipping the cut off one",
+        )
+
+    def test_flush_interval(self):
+        writer = RecordWriter(self.records_dir, 42, flush_every=100, flush_interval=0.05)
+        writer.write({"sample_idx": 0})
+        time.sleep(0.5)
+        self.assertEqual(len(list(read_records(self.records_dir, 42))), 1, "Pending record was not flushed in time")
+        writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
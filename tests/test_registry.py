@@ -0,0 +1,95 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from omegaconf import OmegaConf
+
+from llm_roleplay.common.registry import ModelRegistry
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from llm_roleplay.models.model_pipeline import ModelPipeline
+
+
+class TestModelRegistry(unittest.TestCase):
+    def test_refcount(self):
+        load = MagicMock(side_effect=lambda: object())
+        first = ModelRegistry.acquire(("test", "a"), load)
+        second = ModelRegistry.acquire(("test", "a"), load)
+        other = ModelRegistry.acquire(("test", "b"), load)
+
+        self.assertIs(first, second, "The same key should give the same instance")
+        self.assertIsNot(first, other, "A different key should give another instance")
+        self.assertEqual(load.call_count, 2, "An instance should be loaded once per key")
+
+        ModelRegistry.release(("test", "a"))
+        self.assertEqual(ModelRegistry.refcount(("test", "a")), 1, "The instance is still in use")
+        ModelRegistry.release(("test", "a"))
+        ModelRegistry.release(("test", "b"))
+        self.assertEqual(ModelRegistry.refcount(("test", "a")), 0, "The instance should be dropped")
+        self.assertIsNot(ModelRegistry.acquire(("test", "a"), load), first, "A dropped instance should be reloaded")
+        ModelRegistry.release(("test", "a"))
+
+    def test_concurrent_loads(self):
+        def load():
+            time.sleep(0.5)
+            return object()
+
+        load = MagicMock(side_effect=load)
+        keys = [("test", "a"), ("test", "b"), ("test", "a")]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+            instances = list(executor.map(lambda key: ModelRegistry.acquire(key, load), keys))
+        seconds = time.perf_counter() - start
+
+        self.assertLess(seconds, 0.9, "Different keys should be loaded concurrently")
+        self.assertEqual(load.call_count, 2, "Callers of the same key should wait for its load")
+        self.assertIs(instances[0], instances[2], "Callers of the same key should get the same instance")
+        self.assertIsNot(instances[0], instances[1], "A different key should give another instance")
+        for key in keys:
+            ModelRegistry.release(key)
+        self.assertEqual(ModelRegistry.refcount(("test", "a")), 0, "The instance should be dropped")
+
+    def test_failed_load(self):
+        with self.assertRaises(OSError):
+            ModelRegistry.acquire(("test", "a"), MagicMock(side_effect=OSError("no such model")))
+        self.assertIsNotNone(ModelRegistry.acquire(("test", "a"), object), "A failed load should be retried")
+        ModelRegistry.release(("test", "a"))
+
+    @patch("llm_roleplay.models.model_pipeline.pipeline")
+    @patch("transformers.AutoTokenizer")
+    @patch("transformers.AutoModelForCausalLM")
+    def test_roles_share_weights(self, auto_model, auto_tokenizer, pipeline):
+        auto_model.from_pretrained.side_effect = lambda *args, **kwargs: MagicMock()
+        auto_tokenizer.from_pretrained.side_effect = lambda *args, **kwargs: MagicMock()
+
+        def get_cfg(dtype):
+            return OmegaConf.create(
+                {
+                    "name": "stub",
+                    "cache_dir": "",
+                    "dtype": dtype,
+                    "api_token": None,
+                    "conv_template": {},
+                }
+            )
+
+        inquirer = ModelCausalLanguage(get_cfg("torch.float16"), role="model_inquirer")
+        responder = ModelPipeline(get_cfg("torch.float16"), role="model_responder")
+        other = ModelCausalLanguage(get_cfg("torch.float32"), role="model_responder")
+
+        responder.model
+        self.assertIs(
+            inquirer.model, pipeline.call_args.kwargs["model"], "Roles of the same checkpoint should share the weights"
+        )
+        self.assertIs(inquirer.tokenizer, responder.tokenizer, "Roles of the same checkpoint should share a tokenizer")
+        self.assertIsNot(inquirer.model, other.model, "Another dtype should load other weights")
+        self.assertEqual(auto_model.from_pretrained.call_count, 2, "Shared weights should be loaded once")
+        self.assertIsNot(inquirer.history, responder.history, "Histories should stay per role")
+
+        for model in (inquirer, responder, other):
+            model.release()
+        self.assertEqual(ModelRegistry._entries, {}, "Released instances should be dropped")
+
+
+if __name__ == "__main__":
+    unittest.main()
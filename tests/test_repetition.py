@@ -0,0 +1,77 @@
+import random
+import unittest
+
+from llm_roleplay.common.repetition import RepetitionDetector, has_repetition
+
+
+def is_non_coherent_reference(text, max_n, r):
+    # the n-gram comparison that Model.is_non_coherent used before the detector
+    words = text.split()
+    for n in range(2, max_n + 1):
+        n_grams = []
+        for i in range(len(words)):
+            n_gram = tuple(words[i : i + n])
+            if n_grams and len(n_grams) >= max(r, n):
+                if n_grams[-1] == n_gram or n_grams[-n] == n_gram:
+                    last_rs = n_grams[-r:]
+                    if len(last_rs) == r and len(set(last_rs)) == 1:
+                        return True
+                    last_rs = n_grams[-n::-n][:r]
+                    if len(last_rs) == r and len(set(last_rs)) == 1:
+                        return True
+            n_grams.append(n_gram)
+    return False
+
+
+class TestRepetitionDetector(unittest.TestCase):
+    def random_text(self, rng):
+        words = []
+        for _ in range(rng.randint(0, 40)):
+            if words and rng.random() < 0.3:
+                words += words[-rng.randint(1, min(6, len(words))) :]
+            else:
+                words.append(rng.choice("abcd"[: rng.randint(1, 4)]))
+        return " ".join(words)
+
+    def test_same_verdicts(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            text, max_n, r = self.random_text(rng), rng.randint(2, 6), rng.randint(1, 4)
+            expected = is_non_coherent_reference(text, max_n, r)
+            self.assertEqual(
+                has_repetition(text.split(), max_n, r),
+                expected,
+                f"Verdict differs from is_non_coherent for {text!r}, max_n={max_n}, r={r}",
+            )
+            self.assertEqual(
+                RepetitionDetector(max_n, r).add_words(text.split()),
+                expected,
+                f"Detector verdict differs from is_non_coherent for {text!r}, max_n={max_n}, r={r}",
+            )
+
+    def test_incremental(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            text, max_n, r = self.random_text(rng), rng.randint(2, 6), rng.randint(1, 4)
+            detector = RepetitionDetector(max_n, r)
+            start = 0
+            while start < len(text):
+                end = start + rng.randint(1, 5)
+                detector.add_text(text[start:end])
+                start = end
+            self.assertEqual(
+                detector.finish(),
+                is_non_coherent_reference(text, max_n, r),
+                f"Incremental verdict differs from is_non_coherent for {text!r}, max_n={max_n}, r={r}",
+            )
+
+    def test_detects_while_decoding(self):
+        detector = RepetitionDetector(max_n=4, r=2)
+        self.assertFalse(detector.add_text("How fast did I run the race? "), "Coherent text should not be flagged")
+        self.assertTrue(
+            detector.add_text("I ran and ran and ran and ran "), "Repetition should be flagged as soon as it's decoded"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
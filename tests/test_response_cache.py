@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+
+from transformers import GenerationConfig
+from urartu.common.device import Device
+
+from llm_roleplay.common.response_cache import ResponseCache
+from tests.tiny_model import WORDS, create_tiny_model, create_word_tokenizer, get_model
+
+
+class TestResponseCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        words = WORDS + [f"word{idx}" for idx in range(58)]
+        create_tiny_model(cls.model_dir.name, create_word_tokenizer(words), num_hidden_layers=1)
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.cache_dir.name, "responses.sqlite")
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def get_model(self, response_cache):
+        model = get_model(self.model_dir.name)
+        model.response_cache = response_cache
+        return model
+
+    def run_dialogues(self, response_cache, generate_cfg):
+        # two dialogues of two turns, the first turn in a padded batch and the second one by one
+        model = self.get_model(response_cache)
+        histories = [model.new_history(), model.new_history()]
+        prompts = ["hello world", "how are you"]
+        try:
+            responses = [response for response, _ in model.generate_batch(prompts, histories, generate_cfg)]
+            for history, prompt, response in zip(histories, prompts, responses):
+                model.history = history
+                model.update_history(prompt, response)
+                responses.append(model.generate("are you", generate_cfg)[0])
+        finally:
+            model.release()
+        return responses, model.tracker.counters
+
+    def test_lru(self):
+        response_cache = ResponseCache(self.path, max_size_mb=30 / 2**20)
+        for key in ("a", "b", "c"):
+            response_cache.put(key, "x" * 8)  # 10 bytes as JSON
+        self.assertEqual(response_cache.get("a"), "x" * 8, "A stored response should be found")
+        response_cache.put("d", "x" * 8)
+        self.assertIsNone(response_cache.get("b"), "The least recently used response should be evicted")
+        self.assertEqual(response_cache.stats()["num_entries"], 3, "The cache should stay within its size")
+        response_cache.close()
+
+        response_cache = ResponseCache(self.path)
+        self.assertEqual(response_cache.get("a"), "x" * 8, "Stored responses should be kept across runs")
+        response_cache.close()
+
+    def test_total_size(self):
+        response_cache = ResponseCache(self.path, max_size_mb=30 / 2**20)
+        other_worker = ResponseCache(self.path, max_size_mb=30 / 2**20)
+        response_cache.put("a", "x" * 8)
+        other_worker.put("b", "x" * 3)
+        response_cache.put("a", "x" * 4)  # replaced, 6 bytes instead of 10
+        self.assertEqual(response_cache.stats()["size_mb"] * 2**20, 11, "Replaced responses should be counted once")
+        other_worker.put("c", "x" * 18)  # 20 bytes, evicts b
+        self.assertIsNone(response_cache.get("b"), "The least recently used response should be evicted")
+        self.assertEqual(response_cache.stats()["size_mb"] * 2**20, 26, "Evicted responses should not be counted")
+        other_worker.close()
+
+        # a database written before the total was kept
+        response_cache.connection.execute("DROP TABLE total_size")
+        response_cache.close()
+        response_cache = ResponseCache(self.path)
+        self.assertEqual(response_cache.stats()["size_mb"] * 2**20, 26, "The total should be summed once")
+        response_cache.close()
+
+    def test_rerun(self):
+        generate_cfg = {"max_new_tokens": 8, "min_new_tokens": 8, "do_sample": False}
+        response_cache = ResponseCache(self.path)
+        responses, counters = self.run_dialogues(response_cache, generate_cfg)
+        self.assertEqual(counters["num_response_cache_misses_model_responder"], 4, "Every response should be missed")
+        response_cache.close()
+
+        response_cache = ResponseCache(self.path)
+        rerun_responses, counters = self.run_dialogues(response_cache, generate_cfg)
+        self.assertEqual(rerun_responses, responses, "A rerun should give the stored responses")
+        self.assertEqual(counters["num_response_cache_hits_model_responder"], 4, "Every response should be found")
+        self.assertEqual(counters["num_generated_tokens_model_responder"], 0, "Nothing should be generated again")
+
+        _, counters = self.run_dialogues(response_cache, {**generate_cfg, "do_sample": True})
+        self.assertEqual(counters["num_response_cache_bypassed_model_responder"], 4, "Sampling should bypass it")
+        self.assertEqual(counters["num_response_cache_hits_model_responder"], 0, "Sampled responses can't be reused")
+        response_cache.close()
+
+    def test_generation_config(self):
+        # a checkpoint that samples by default, like llama-2-chat
+        with tempfile.TemporaryDirectory() as model_dir:
+            create_tiny_model(model_dir, create_word_tokenizer(WORDS), num_hidden_layers=1)
+            generation_config = GenerationConfig.from_pretrained(model_dir)
+            generation_config.do_sample = True
+            generation_config.save_pretrained(model_dir)
+            model = get_model(model_dir, empty_response_retries=0)
+            model.response_cache = ResponseCache(self.path)
+            try:
+                model.generate("hello world", {"max_new_tokens": 4})
+                self.assertTrue(model.is_deterministic({"do_sample": False}), "An explicit do_sample should win")
+            finally:
+                model.release()
+                model.response_cache.close()
+        self.assertEqual(model.tracker.counters["num_response_cache_bypassed_model_responder"], 1, "It should bypass")
+        self.assertNotIn("num_response_cache_misses_model_responder", model.tracker.counters)
+
+
+if __name__ == "__main__":
+    unittest.main()
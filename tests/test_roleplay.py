@@ -5,7 +5,8 @@ from unittest.mock import patch
 
 from aim import Run
 from aim.storage.context import Context
-from llm_roleplay.actions.dialogue_generator import DialogueGenerator
+from llm_roleplay.actions.dialogue_generator import DialogueGenerator, generate_shard
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
 from omegaconf import OmegaConf
 from urartu.common.device import Device
 
@@ -108,6 +109,40 @@ class TestRoleplay(unittest.TestCase):
         self.aim_run = Run(repo=self.cfg.aim.repo, experiment=self.cfg.action_config.experiment_name)
         self.aim_run.set("cfg", self.cfg, strict=False)
 
+    def start_patch(self, target):
+        patcher = patch(target)
+        mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock
+
+    def patch_generate_batch(self, inquirer_output, responder_output):
+        """
+        Patches the models of both roles, every prompt of a batch gets inquirer_output from the inquirer and
+        responder_output from the responder. Returns the mocked generate_batch of the inquirer and of the responder.
+        """
+        self.start_patch("llm_roleplay.models.model_causal_language.ModelCausalLanguage.model")
+        self.start_patch("llm_roleplay.models.model_pipeline.ModelPipeline.model")
+        mock_generate_batch_clm = self.start_patch(
+            "llm_roleplay.models.model_causal_language.ModelCausalLanguage.generate_batch"
+        )
+        mock_generate_batch_clm.side_effect = lambda prompts, histories, generate_cfg: [
+            (inquirer_output, None)
+        ] * len(prompts)
+        mock_generate_batch_pipe = self.start_patch("llm_roleplay.models.model_pipeline.ModelPipeline.generate_batch")
+        mock_generate_batch_pipe.side_effect = lambda prompts, histories, generate_cfg: [
+            (responder_output, None)
+        ] * len(prompts)
+        return mock_generate_batch_clm, mock_generate_batch_pipe
+
+    def set_fixed_personas(self, ages=("a 18 to 24", "a 25 to 34", "a 35 to 44")):
+        # the fixed persona of the config at every age
+        person = self.cfg.action_config.task.persona.fixed[0].person
+        self.cfg.action_config.task.persona.fixed = [{"person": {**person, "age": age}} for age in ages]
+
+    def read_records(self, records_dir):
+        with (records_dir / f"{self.cfg.seed}.jsonl").open("r", encoding="utf-8") as file:
+            return [json.loads(line) for line in file]
+
     def test_tracking_calls(self):
         dialogue_generator = DialogueGenerator(self.cfg, self.aim_run)
         self.assertEqual(
@@ -278,6 +313,170 @@ class TestRoleplay(unittest.TestCase):
             "Responder model was not called the expected number of times",
         )
 
+    def test_batched_dialogue_generation(self):
+        self.cfg.action_config.task.batch_size = 2
+        self.set_fixed_personas()
+        mock_generate_batch_clm, mock_generate_batch_pipe = self.patch_generate_batch(
+            self.sample_inquirer_output, self.sample_responder_output
+        )
+
+        dialogue_generator = DialogueGenerator(self.cfg, self.aim_run)
+        dialogue_generator.initialize()
+        records = self.read_records(dialogue_generator.generate())
+
+        self.assertEqual(
+            len(records),
+            len(self.cfg.action_config.task.persona.fixed),
+            "Generated line count does not match the number of fixed personas",
+        )
+        for record in records:
+            self.assertEqual(
+                record["num_turns"],
+                self.cfg.action_config.task.num_turns,
+                "Number of turns in dialogue does not match expected number",
+            )
+        self.assertEqual(
+            max(len(call.kwargs["prompts"]) for call in mock_generate_batch_clm.call_args_list),
+            self.cfg.action_config.task.batch_size,
+            "Inquirer prompts were not generated in batches",
+        )
+        self.assertEqual(
+            sum(len(call.kwargs["prompts"]) for call in mock_generate_batch_pipe.call_args_list),
+            len(records) * self.cfg.action_config.task.num_turns,
+            "Responder model was not called the expected number of times",
+        )
+
+    def test_resume(self):
+        self.set_fixed_personas()
+        mock_generate_batch_clm, _ = self.patch_generate_batch(self.sample_inquirer_output, self.sample_responder_output)
+
+        dialogue_generator = DialogueGenerator(self.cfg, self.aim_run)
+        dialogue_generator.initialize()
+        records_dir = dialogue_generator.generate()
+        records_file = records_dir / f"{self.cfg.seed}.jsonl"
+
+        # keep the first dialogue, interrupt the second after its first turn and lose the third
+        records = self.read_records(records_dir)
+        records_file.write_text(json.dumps(records[0]) + "\n", encoding="utf-8")
+        personas = dialogue_generator.personas
+        dialogue_generator.checkpoints.save(
+            (0, 1),
+            {
+                "sample_idx": 0,
+                "persona_idx": 1,
+                "persona_hash": personas[1][1],
+                "turn": 1,
+                "dialog": records[1]["dialog"][:1],
+                "responder_output": records[1]["dialog"][0]["model_responder"],
+                "inquirer_history": ["[INST] first prompt [/INST]", "question"],
+                "responder_history": ["[INST] question [/INST]", "answer"],
+            },
+        )
+        mock_generate_batch_clm.reset_mock()
+
+        self.cfg.action_config.resume_dir = str(records_dir)
+        resumed_generator = DialogueGenerator(self.cfg, self.aim_run)
+        resumed_generator.initialize()
+        self.assertEqual(resumed_generator.records_dir, records_dir, "Resumed run should continue the records directory")
+        resumed_generator.generate()
+
+        records = self.read_records(records_dir)
+        self.assertEqual(
+            sorted(record["persona_hash"] for record in records),
+            sorted(persona_hash for _, persona_hash in personas),
+            "Every persona should be recorded exactly once after resuming",
+        )
+        for record in records:
+            self.assertEqual(record["sample_idx"], 0, "Record does not carry its sample index")
+            self.assertEqual(
+                record["num_turns"],
+                self.cfg.action_config.task.num_turns,
+                "Number of turns in dialogue does not match expected number",
+            )
+        self.assertEqual(
+            sum(len(call.kwargs["prompts"]) for call in mock_generate_batch_clm.call_args_list),
+            1 + self.cfg.action_config.task.num_turns,
+            "Resumed run should only generate the turns that were not recorded",
+        )
+        self.assertEqual(
+            resumed_generator.checkpoints.load_all(), {}, "Checkpoints of recorded dialogues should be removed"
+        )
+
+    def test_sharded(self):
+        self.set_fixed_personas()
+        self.patch_generate_batch(self.sample_inquirer_output, self.sample_responder_output)
+
+        dialogue_generator = DialogueGenerator(self.cfg, self.aim_run)
+        dialogue_generator.initialize()
+        expected = self.read_records(dialogue_generator.generate())
+
+        # run the workers in this process, in the reverse order, so that they share the patched models
+        self.cfg.action_config.resume_dir = str(dialogue_generator.records_dir.joinpath("sharded"))
+        sharded_generator = DialogueGenerator(self.cfg, self.aim_run)
+        sharded_generator.initialize()
+        units = [(dialogue.idx, dialogue.persona_idx) for dialogue in sharded_generator.get_work()]
+        for shard_idx in reversed(range(2)):
+            records_dir = str(sharded_generator.records_dir)
+            counters = generate_shard(self.cfg, records_dir, shard_idx, units[shard_idx::2], "cpu")
+            self.assertIn("num_multiple_prompts", counters, "Worker should return its counters")
+        sharded_generator.merge_shards()
+
+        records = self.read_records(sharded_generator.records_dir)
+        self.assertEqual(
+            [(record["sample_idx"], record["persona_idx"], record["dialog"]) for record in records],
+            [(record["sample_idx"], record["persona_idx"], record["dialog"]) for record in expected],
+            "Merged records should be in the order of a single process",
+        )
+        self.assertEqual(
+            list(sharded_generator.get_work(sharded_generator.get_completed_work())),
+            [],
+            "Merged records should count as completed work",
+        )
+
+    def test_regenerate_candidates(self):
+        self.cfg.action_config.task.model_inquirer.regenerate_tries = 2
+        self.cfg.action_config.task.model_inquirer.regenerate_candidates = 4
+        self.patch_generate_batch("I would ask how to measure my speed", self.sample_responder_output)
+        mock_generate_candidates = self.start_patch(
+            "llm_roleplay.models.model_causal_language.ModelCausalLanguage.generate_candidates"
+        )
+
+        def generate_candidates(prompt, generate_cfg, num_candidates, accept):
+            self.assertNotIn("num_beams", generate_cfg, "Candidates should be sampled without beam search")
+            candidates = ["", "Still no quoted prompt", self.sample_inquirer_output, "FINISH"][:num_candidates]
+            for num_generated, candidate in enumerate(candidates, start=1):
+                if accept(candidate):
+                    return candidate, None, num_generated
+            return candidate, None, num_generated
+
+        mock_generate_candidates.side_effect = generate_candidates
+
+        dialogue_generator = DialogueGenerator(self.cfg, self.aim_run)
+        dialogue_generator.initialize()
+        records = self.read_records(dialogue_generator.generate())
+        num_turns = self.cfg.action_config.task.num_turns
+        self.assertEqual(records[0]["num_turns"], num_turns, "Regenerated prompts should continue the dialogue")
+        counters = dialogue_generator.tracker.counters
+        self.assertEqual(
+            (counters["num_regenerations"], counters["num_regenerate_worked"], counters["num_regenerate_candidates"]),
+            (num_turns, num_turns, 3 * num_turns),
+            "Every turn should regenerate once and stop at its first candidate with a prompt",
+        )
+
+    @patch("llm_roleplay.models.model_causal_language.ModelCausalLanguage._generate")
+    def test_empty_response_retries(self, mock_generate):
+        model = ModelCausalLanguage(self.cfg.action_config.task.model_inquirer, role="model_inquirer")
+        mock_generate.side_effect = [("", ""), ("", ""), ("answer", "answer")]
+        self.assertEqual(model.generate("prompt", {"do_sample": True}), ("answer", "answer"), "Retry was discarded")
+        self.assertEqual(model.tracker.counters["num_empty_retries"], 2, "Retries were not counted")
+
+        mock_generate.reset_mock(side_effect=True)
+        mock_generate.return_value = ("", "")
+        model.generate("prompt", {"do_sample": True})
+        self.assertEqual(mock_generate.call_count, 4, "Empty responses should be retried at most 3 times")
+        model.generate("prompt", {"do_sample": False})
+        self.assertEqual(mock_generate.call_count, 5, "Greedy decoding would give the same empty response again")
+
 
 if __name__ == "__main__":
     unittest.main()
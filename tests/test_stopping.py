@@ -0,0 +1,109 @@
+import unittest
+
+import torch
+from omegaconf import OmegaConf
+
+from llm_roleplay.common.stopping import DialogueStoppingCriteria
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+
+
+class CharTokenizer:
+    # one token per character
+    all_special_ids = []
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(map(chr, token_ids))
+
+
+class TestStoppingCriteria(unittest.TestCase):
+    def setUp(self):
+        self.cfg = OmegaConf.create(
+            {
+                "name": "stub",
+                "non_coherent_max_n": 4,
+                "non_coherent_r": 2,
+                "generate": {"max_new_tokens": 1000},
+                "conv_template": {"model_output": "<MODEL_ANSWER>"},
+            }
+        )
+        self.prompt_ids = [ord(char) for char in "[INST] prompt [/INST]"]
+
+    def get_model(self, role):
+        model = ModelCausalLanguage(self.cfg, role=role)
+        model._tokenizer = CharTokenizer()
+        model.spec_tokens = OmegaConf.create({"conv_stop_token": "FINISH", "model_answer": "<MODEL_ANSWER>"})
+        return model
+
+    def decode_until_stopped(self, model, responses):
+        """
+        Feeds the responses to the criteria one token per step, returns the number of tokens each was stopped after.
+        """
+        criteria = model.get_stopping_criteria(len(self.prompt_ids), self.cfg.generate)[0]
+        stopped_at = [None] * len(responses)
+        for step in range(1, max(map(len, responses)) + 1):
+            input_ids = torch.tensor(
+                [self.prompt_ids + [ord(char) for char in response.ljust(step)[:step]] for response in responses]
+            )
+            for idx, stopped in enumerate(criteria(input_ids, None).tolist()):
+                if stopped and stopped_at[idx] is None:
+                    stopped_at[idx] = step
+        return stopped_at
+
+    def test_self_reply(self):
+        model = self.get_model("model_responder")
+        response = "You can divide the distance by the time. [INST] Thanks, and for calories? [/INST] You burn"
+        stopped_at = self.decode_until_stopped(model, [response])
+
+        self.assertEqual(stopped_at[0], response.index("[INST") + len("[INST"), "Should stop at the self-reply marker")
+        self.assertEqual(model.tracker.counters["num_stopped_self_reply"], 1, "Stop was not counted")
+        self.assertEqual(
+            model.tracker.counters["num_tokens_saved"], 1000 - stopped_at[0], "Saved tokens were not counted"
+        )
+
+    def test_conv_stop_and_repetition(self):
+        model = self.get_model("model_inquirer")
+        responses = [
+            "FINISH. I got everything I needed from the assistant, thanks for all of the help.",
+            '"How fast did I run?" I ran and ran and ran and ran and ran and ran and ran.',
+            '"How many calories did I burn in each of the three races?" Please be precise.',
+        ]
+        stopped_at = self.decode_until_stopped(model, responses)
+
+        self.assertEqual(stopped_at[0], len("FINISH. "), "Should stop once the first word is the conv stop token")
+        self.assertLess(stopped_at[1], len(responses[1]), "Should stop once the response repeats itself")
+        self.assertTrue(model.is_non_coherent(responses[1][: stopped_at[1]]), "Stopped response should be flagged")
+        self.assertIsNone(stopped_at[2], "A coherent response should be generated to the end")
+
+    def test_stream_prompt(self):
+        self.cfg.stream_prompt = True
+        model = self.get_model("model_inquirer")
+        responses = [
+            '"How fast did I run the 100-meter race?" I also want to know about the calories.',
+            'Let me ask "how fast did I run?" I will then ask "how many calories did I burn?" and so on.',
+        ]
+
+        stopped_at = self.decode_until_stopped(model, responses)
+        self.assertEqual(stopped_at[0], responses[0].index("?") + 2, "Should stop once the quoted prompt is closed")
+
+        self.cfg.conv_template.idx_of_possible_prompt = 1
+        model = self.get_model("model_inquirer")
+        stopped_at = self.decode_until_stopped(model, responses)
+        self.assertIsNone(stopped_at[0], "Should wait for the second prompt that extract_prompt selects")
+        self.assertEqual(stopped_at[1], responses[1].rindex('"') + 1, "Should stop once the second prompt is closed")
+        self.assertEqual(
+            model.extract_prompt(responses[1][: stopped_at[1]]),
+            model.extract_prompt(responses[1]),
+            "Prompt extracted from the stopped response should be the same",
+        )
+
+        # the last prompt is only known once the response is complete
+        self.cfg.conv_template.idx_of_possible_prompt = -1
+        model = self.get_model("model_inquirer")
+        stopped_at = self.decode_until_stopped(model, responses)
+        self.assertEqual(stopped_at, [None, None], "Should not stop before the last prompt is known")
+        with self.assertRaises(ValueError):
+            DialogueStoppingCriteria(model, len(self.prompt_ids), prompt_idx=-1)
+
+
+if __name__ == "__main__":
+    unittest.main()
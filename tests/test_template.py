@@ -0,0 +1,82 @@
+import unittest
+
+from omegaconf import OmegaConf
+
+from llm_roleplay.common.persona import Persona
+from llm_roleplay.common.template import Template
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+
+SPEC_TOKENS = {
+    "persona_placeholder": "<PERSONA>",
+    "objective_placeholder": "<OBJECTIVE>",
+    "response_placeholder": "<RESPONSE>",
+    "conv_stop_placeholder": "<CONV_STOP>",
+    "conv_stop_token": "FINISH",
+    "user_msg": "<USER_MSG>",
+    "model_answer": "<MODEL_ANSWER>",
+    "next_prompt": "<NEXT_PROMPT>",
+    "bos_token": "<BOS>",
+    "sep_token": "<SEP>",
+}
+
+
+class TestTemplate(unittest.TestCase):
+    def get_model(self, conv_template, role="model_inquirer"):
+        model = ModelCausalLanguage(OmegaConf.create({"conv_template": conv_template}), role=role)
+        model.spec_tokens = OmegaConf.create(SPEC_TOKENS)
+        return model
+
+    def test_render(self):
+        template = Template("<<SYS>> You are <PERSONA>, say <CONV_STOP>. <PERSONA>", {"persona": "<PERSONA>"})
+        self.assertEqual(
+            template.render(persona="a <RESPONSE> fan"),
+            "<<SYS>> You are a <RESPONSE> fan, say <CONV_STOP>. a <RESPONSE> fan",
+            "Only the given placeholders should be filled, their values are inserted as they are",
+        )
+        self.assertEqual(Template("no placeholders", {}).render(), "no placeholders", "Plain text should be kept")
+
+    def test_get_prompt(self):
+        model = self.get_model(
+            {
+                "first_turn_input": '[INST] <<SYS>> You are <PERSONA>, say "<CONV_STOP>". <</SYS>> <OBJECTIVE> [/INST]',
+                "n_th_turn_input": "[INST] <USER_MSG> [/INST]",
+                "response_forwarding": 'Ask more.<NEXT_PROMPT> Assistant response: "<RESPONSE>".',
+                "mid_response_forwarding": "Now ask: <NEXT_PROMPT>. Assistant response: <RESPONSE>",
+                "model_output": "<MODEL_ANSWER>",
+            }
+        )
+        self.assertEqual(
+            model.get_prompt(turn=0, persona="a runner", instructions=["Measure speed", "Count calories"]),
+            '[INST] <<SYS>> You are a runner, say "FINISH". <</SYS>> Measure speed [/INST]',
+            "First turn prompt does not match the template",
+        )
+        self.assertEqual(
+            model.get_prompt(turn=1, response_msg="Use a stopwatch", persona="a runner", instructions=["a", "b"]),
+            "[INST] Now ask: b. Assistant response: Use a stopwatch [/INST]",
+            "Turns with an instruction left should forward the response with it",
+        )
+        self.assertEqual(
+            model.get_prompt(turn=2, response_msg="Done", persona="a runner", instructions=["a", "b"]),
+            '[INST] Ask more. Assistant response: "Done". [/INST]',
+            "Later turns should forward the response",
+        )
+        self.assertEqual(model.format_response(" answer"), ("answer", "answer"), "Model output was not rendered")
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "<RESPONSE>"):
+            self.get_model({"first_turn_input": "<OBJECTIVE> <RESPONSE>"}, role="model_responder")
+
+        persona_cfg = OmegaConf.create(
+            {"prompt": "<AGE>-year-old <GENDER>", "fixed": [{"person": {"age": "30", "gender": "woman"}}]}
+        )
+        self.assertEqual(Persona.get_personas(persona_cfg)[0][0], "30-year-old woman", "Persona was not rendered")
+        persona_cfg.fixed.append({"person": {"age": "40"}})
+        with self.assertRaisesRegex(ValueError, "gender"):
+            Persona.get_personas(persona_cfg)
+        persona_cfg.prompt = "<AGE>-year-old <RACE>"
+        with self.assertRaisesRegex(ValueError, "<RACE>"):
+            Persona.get_personas(persona_cfg)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+
+from llm_roleplay.common.timing import Timer
+
+
+class TestTimer(unittest.TestCase):
+    def test_stages(self):
+        timer = Timer()
+        dialogues = [SimpleNamespace(timing={}), SimpleNamespace(timing={})]
+        for _ in range(3):
+            with timer.stage("generate_inquirer", dialogues):
+                time.sleep(0.002)
+        with timer.stage("extract_prompt", dialogues[:1]):
+            pass
+
+        summary = timer.summary()
+        self.assertEqual(summary["generate_inquirer"]["count"], 3, "Every stage run should be counted")
+        self.assertGreaterEqual(summary["generate_inquirer"]["p50_ms"], 2, "Quantile should bound the durations")
+        self.assertEqual(sum(summary["generate_inquirer"]["histogram"].values()), 3, "Histogram misses durations")
+        self.assertAlmostEqual(
+            dialogues[1].timing["generate_inquirer"],
+            summary["generate_inquirer"]["total_ms"],
+            msg="A batched stage should count fully for every dialogue of the batch",
+        )
+        self.assertNotIn("extract_prompt", dialogues[1].timing, "Stage should only count for its dialogues")
+
+    def test_disabled(self):
+        timer = Timer(enabled=False)
+        dialogue = SimpleNamespace(timing={})
+        with timer.stage("get_prompt", [dialogue]), timer.generation() as generation_timer:
+            pass
+        self.assertIsNone(generation_timer, "A disabled timer should not time generate calls")
+        self.assertEqual((timer.summary(), dialogue.timing), ({}, {}), "A disabled timer should not time anything")
+
+    def test_generation_and_profile(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            timer = Timer(profile_every_n_turns=2, profile_dir=profile_dir)
+            for turn_idx in range(3):
+                with timer.profile(turn_idx), timer.generation() as generation_timer:
+                    input_ids = torch.zeros((2, 4), dtype=torch.long)
+                    for _ in range(3):
+                        with timer.stage("decode_step"):
+                            stopped = generation_timer(input_ids, None)
+                        self.assertFalse(stopped.any(), "Generation timer should never stop a sequence")
+
+            summary = timer.summary()
+            self.assertEqual((summary["prefill"]["count"], summary["decode"]["count"]), (3, 3), "Calls not split")
+            self.assertEqual(
+                sorted(path.name for path in Path(profile_dir).iterdir()),
+                ["turn_0.json", "turn_2.json"],
+                "Only the sampled turns should be profiled",
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from urartu.common.device import Device
+
+from llm_roleplay.common.model import Model
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+from llm_roleplay.models.model_pipeline import ModelPipeline
+from tests.tiny_model import WORDS, create_tiny_model, create_word_tokenizer, get_model
+
+# extra spaces and unknown words, which don't come back from decoding the prompt's tokens
+PROMPTS = ["hello   world  howdy", "are you   there"]
+
+
+class TestTokenIds(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        create_tiny_model(cls.model_dir.name, create_word_tokenizer(WORDS + [f"word{idx}" for idx in range(58)]))
+        cls.tokenizer = AutoTokenizer.from_pretrained(cls.model_dir.name)
+        Device.set_device("cpu")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def test_response_slicing(self):
+        generate_cfg = {"max_new_tokens": 8, "min_new_tokens": 8, "do_sample": False}
+        causal_lm = AutoModelForCausalLM.from_pretrained(self.model_dir.name)
+        for model_cls in (ModelCausalLanguage, ModelPipeline):
+            model = get_model(self.model_dir.name, model_cls)
+            input_ids = []
+            try:
+                for prompt in PROMPTS:
+                    prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=not input_ids)
+                    self.assertNotEqual(self.tokenizer.decode(prompt_ids), prompt, "The prompt should not round-trip")
+                    input_ids += prompt_ids
+
+                    response, _ = model.generate(prompt, generate_cfg)
+                    with torch.no_grad():
+                        output_ids = causal_lm.generate(torch.tensor([input_ids]), **generate_cfg)[0].tolist()
+                    response_ids = output_ids[len(input_ids) :]
+                    self.assertEqual(
+                        response,
+                        self.tokenizer.decode(response_ids, skip_special_tokens=True).strip(),
+                        f"The response of {model_cls.__name__} should be the decoded new tokens only",
+                    )
+                    model.update_history(prompt, response)
+                    input_ids += response_ids
+            finally:
+                model.release()
+
+    def test_collate_token_ids(self):
+        model = get_model(self.model_dir.name)
+        try:
+            # the tokenizer as the model loads it, which pads on the left
+            tokenizer = model.tokenizer
+            prompts_ids = [tokenizer.encode(prompt) for prompt in ("hello world how are you", "hello you")]
+            tokenized = Model.collate_tokenize(
+                [{"input": prompt_ids} for prompt_ids in prompts_ids], tokenizer, input_key="input", device="cpu"
+            )
+        finally:
+            model.release()
+        self.assertEqual(
+            tokenized["input_ids"].tolist(),
+            [prompts_ids[0], [tokenizer.pad_token_id] * 3 + prompts_ids[1]],
+            "Token id prompts should be left padded to the longest one",
+        )
+        self.assertEqual(tokenized["attention_mask"].tolist(), [[1] * 5, [0] * 3 + [1] * 2], "Padding should be masked")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from aim import Run
+from aim.storage.context import Context
+
+from llm_roleplay.common.tracker import Tracker
+
+
+class TestTracker(unittest.TestCase):
+    def setUp(self):
+        self.aim_run = Run(repo="tmp", experiment="test experiment for tracker")
+
+    def test_full(self):
+        tracker = Tracker(self.aim_run, level="full", flush_interval=60.0)
+        tracker.increment("num_no_prompts")
+        tracker.increment("num_no_prompts")
+        tracker.set("personas", "a persona", key="hash")
+        tracker.track("a prompt", name="test_tracker_input", context={})
+        self.assertIsNone(self.aim_run.get("num_no_prompts"), "Counters should only reach the run when flushed")
+
+        tracker.close()
+        self.assertEqual(self.aim_run["num_no_prompts"], 2, "Counter was not flushed to the run")
+        self.assertEqual(self.aim_run["personas"], {"hash": "a persona"}, "Run parameter was not flushed to the run")
+        text_seq = self.aim_run.get_text_sequence("test_tracker_input", context=Context({}))
+        self.assertIsNotNone(next(iter(text_seq.data), None), "Text was not flushed to the run")
+
+    def test_counters(self):
+        tracker = Tracker(self.aim_run, level="counters", flush_interval=60.0)
+        tracker.increment("num_self_replies")
+        tracker.track("a prompt", name="test_tracker_counters", context={})
+        tracker.close()
+
+        self.assertEqual(self.aim_run["num_self_replies"], 1, "Counter was not flushed to the run")
+        text_seq = self.aim_run.get_text_sequence("test_tracker_counters", context=Context({}))
+        self.assertTrue(
+            text_seq is None or next(iter(text_seq.data), None) is None,
+            "Texts should not be tracked at the counters level",
+        )
+
+    def test_off(self):
+        tracker = Tracker(self.aim_run, level="off")
+        tracker.increment("num_self_replies")
+        tracker.close()
+
+        self.assertIsNone(self.aim_run.get("num_self_replies"), "Nothing should reach the run when tracking is off")
+        self.assertEqual(tracker.counters["num_self_replies"], 1, "Counters should still be kept locally")
+
+
+if __name__ == "__main__":
+    unittest.main()
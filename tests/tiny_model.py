@@ -0,0 +1,83 @@
+"""
+Tiny randomly initialized llamas saved to a local directory, so that the hf backends can be run end to end in the
+tests and the benchmarks without downloading a model.
+"""
+from pathlib import Path
+
+import torch
+from omegaconf import OmegaConf
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from llm_roleplay.models.model_causal_language import ModelCausalLanguage
+
+WORDS = ["<eos>", "hello", "world", "how", "are", "you"]
+
+
+def create_word_tokenizer(words) -> PreTrainedTokenizerFast:
+    # a token per whitespace separated word, the first word is the eos token and stands for unknown words
+    tokenizer = Tokenizer(models.WordLevel({word: idx for idx, word in enumerate(words)}, unk_token=words[0]))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token=words[0])
+
+
+def create_bpe_tokenizer(texts, vocab_size: int = 1024) -> PreTrainedTokenizerFast:
+    # byte-level BPE trained on the texts, so that they take a realistic number of tokens
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(texts, trainer=trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|endoftext|>", eos_token="<|endoftext|>")
+
+
+def create_tiny_model(
+    path, tokenizer: PreTrainedTokenizerFast = None, vocab_size: int = None, seed: int = 0, **config
+):
+    """
+    Saves a randomly initialized llama of the given config to path, with the tokenizer if given, whose eos token is
+    then the bos and eos token of the model.
+    """
+    if tokenizer is not None:
+        tokenizer.save_pretrained(path)
+        vocab_size = len(tokenizer)
+        config = {"bos_token_id": tokenizer.eos_token_id, "eos_token_id": tokenizer.eos_token_id, **config}
+    config = {"hidden_size": 32, "intermediate_size": 64, "num_hidden_layers": 2, "num_attention_heads": 2, **config}
+    torch.manual_seed(seed)
+    LlamaForCausalLM(LlamaConfig(vocab_size=vocab_size, **config)).save_pretrained(path)
+
+
+def create_tiny_draft(path, model_path):
+    # the first layer of the model, with its embeddings and head, drafts for the whole model
+    model = LlamaForCausalLM.from_pretrained(model_path)
+    config = model.config
+    config.num_hidden_layers = 1
+    if getattr(config, "layer_types", None):
+        config.layer_types = config.layer_types[:1]
+    draft = LlamaForCausalLM(config)
+    draft.load_state_dict(model.state_dict(), strict=False)
+    draft.save_pretrained(path)
+    AutoTokenizer.from_pretrained(model_path).save_pretrained(path)
+
+
+def get_model(model_path, model_cls=ModelCausalLanguage, role="model_responder", **cfg):
+    """
+    Returns a model of the tiny llama at model_path, in float32 on the configured device, whose response is its whole
+    output.
+    """
+    cfg = OmegaConf.create(
+        {
+            "name": str(Path(model_path)),
+            "cache_dir": None,
+            "dtype": "torch.float32",
+            "api_token": None,
+            "stop_early": False,
+            "conv_template": {"model_output": "<MODEL_ANSWER>"},
+            **cfg,
+        }
+    )
+    model = model_cls(cfg, role=role)
+    model.spec_tokens = OmegaConf.create({"model_answer": "<MODEL_ANSWER>"})
+    return model